@@ -0,0 +1,92 @@
+"""
+Measure how many files per second DICOMFileStore indexes from a
+directory tree of synthetic CT files, with headers read in this process
+and in pools of worker processes, how fast an unchanged tree is
+re-indexed, and how fast frames are then served from the files.
+
+  python file-index.py [fileCount] [workers ...]
+
+Note: creating the ctkDICOM database downloads the schema, so network
+access is needed.
+"""
+import numpy as np
+import os
+import pydicom
+import pydicom.uid
+import sys
+import tempfile
+import time
+
+import DICOMLogic
+from DICOMLogic.stores import DICOMFileStore
+
+fileCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+workerCounts = [int(workers) for workers in sys.argv[2:]] \
+                    or sorted(set([0, 2, 4, os.cpu_count() - 1]))
+instancesPerSeries = 200
+
+# a subset of the tags Slicer precaches by default
+tagsToPrecache = ("0008,0008", "0008,0016", "0008,0060", "0008,103E",
+                  "0010,0010", "0018,0050", "0020,000E", "0020,0011",
+                  "0020,0013", "0020,0032", "0020,0037", "0028,0030")
+
+def writeInstance(path, index):
+    seriesIndex = index // instancesPerSeries
+    ds = pydicom.Dataset()
+    ds.PatientName = f"Patient^{seriesIndex // 4}"
+    ds.PatientID = f"P{seriesIndex // 4}"
+    ds.StudyInstanceUID = f"1.2.3.{seriesIndex // 4}"
+    ds.SeriesInstanceUID = f"1.2.3.{seriesIndex // 4}.{seriesIndex}"
+    ds.SOPInstanceUID = f"1.2.3.{seriesIndex // 4}.{seriesIndex}.{index}"
+    ds.SOPClassUID = pydicom.uid.CTImageStorage
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.Modality = "CT"
+    ds.SeriesDescription = f"Series {seriesIndex}"
+    ds.Manufacturer = "ACME"
+    ds.SeriesNumber = str(seriesIndex)
+    ds.InstanceNumber = str(index % instancesPerSeries)
+    ds.ImagePositionPatient = ["-250.0", "-250.0", str(-1.25 * index)]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = np.full((512, 512), index % 1000, dtype="<i2").tobytes()
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+dicomDirectory = tempfile.mkdtemp()
+for index in range(fileCount):
+    seriesDirectory = os.path.join(dicomDirectory, f"series{index // instancesPerSeries}")
+    os.makedirs(seriesDirectory, exist_ok=True)
+    writeInstance(os.path.join(seriesDirectory, f"{index}.dcm"), index)
+print(f"Wrote {fileCount} files to {dicomDirectory}")
+
+for workers in workerCounts:
+    db = DICOMLogic.databases.ctkSQLite(tempfile.mkdtemp(), tagsToPrecache=tagsToPrecache)
+    store = DICOMFileStore(db)
+    result = store.indexDirectory(dicomDirectory, workers=workers)
+    print(f"{workers:3} workers: {result['files'] / result['seconds']:8.1f} files/s "
+          f"({result['instances']} instances)")
+
+result = store.indexDirectory(dicomDirectory, workers=workerCounts[-1])
+print(f"  unchanged: {result['files'] / result['seconds']:8.1f} files/s "
+      f"({result['skipped']} skipped)")
+
+for seriesInstanceUID in db.seriesForStudy("1.2.3.0")[:1]:
+    urls = list(db.urlsForSeries(seriesInstanceUID).values())
+    startTime = time.time()
+    store.startRequest(urls)
+    framesByURL = store.getFrames(urls)
+    checksum = sum([int(frame[0]) for frame in framesByURL.values()])
+    elapsed = time.time() - startTime
+    print(f"     frames: {len(framesByURL) / elapsed:8.1f} frames/s memory mapped "
+          f"(checksum {checksum})")
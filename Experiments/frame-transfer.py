@@ -0,0 +1,161 @@
+"""
+Compare retrieving frames uncompressed and in compressed transfer
+syntaxes from a local stub DICOMweb server, with frames decoded in the
+calling thread or in thread and process pools.
+
+  python frame-transfer.py [frameCount] [megabitsPerSecond]
+
+The stub server limits each response to the given bandwidth so the
+network cost of a frame is similar to a remote server.  It answers with
+the first transfer syntax in the Accept header that it can encode, and
+gzips uncompressed frames when asked (the "deflate" rows).
+Compressing the synthetic frames needs imagecodecs for JPEG-LS and HTJ2K.
+"""
+import gzip
+import http.server
+import numpy as np
+import sys
+import threading
+import time
+
+try:
+    import imagecodecs
+except ModuleNotFoundError:
+    imagecodecs = None
+
+from DICOMLogic.stores import DICOMFrameDecoder, DICOMwebStore
+
+frameCount = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+megabitsPerSecond = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+rows, columns = 512, 512
+distinctFrames = 8
+
+def phantomFrame(index):
+    """CT like 12 bit frame: a noisy disk on a background"""
+    y, x = np.mgrid[0:rows, 0:columns]
+    radius = np.hypot(x - columns / 2, y - rows / 2)
+    frame = np.where(radius < 200 - index, 1040, 24).astype("float32")
+    frame += 200 * np.exp(-((x - 200 - index) ** 2 + (y - 300) ** 2) / 800)
+    frame += np.random.default_rng(index).normal(0, 8, (rows, columns))
+    return np.clip(frame, 0, 4095).astype("<u2")
+
+def packBitsEncode(data):
+    out = bytearray()
+    index = 0
+    while index < len(data):
+        end = index + 1
+        while end < len(data) and end - index < 128 and data[end] == data[index]:
+            end += 1
+        if end - index > 1:
+            out += bytes((257 - (end - index), data[index]))
+        else:
+            while end < len(data) and end - index < 128 and \
+                    not (end + 1 < len(data) and data[end] == data[end + 1]):
+                end += 1
+            out += bytes((end - index - 1,)) + data[index:end]
+        index = end
+    return bytes(out)
+
+def rleEncode(frame):
+    planes = frame.view("uint8").reshape(-1, 2)
+    segments = [packBitsEncode(planes[:, 1].tobytes()), packBitsEncode(planes[:, 0].tobytes())]
+    offsets = [64, 64 + len(segments[0])]
+    header = np.zeros(16, dtype="<u4")
+    header[0] = 2
+    header[1:3] = offsets
+    return header.tobytes() + b"".join(segments)
+
+encoders = {"1.2.840.10008.1.2.1": lambda frame: frame.tobytes(),
+            "1.2.840.10008.1.2.5": rleEncode}
+if imagecodecs is not None:
+    encoders["1.2.840.10008.1.2.4.80"] = imagecodecs.jpegls_encode
+    encoders["1.2.840.10008.1.2.4.201"] = imagecodecs.htj2k_encode
+
+def multipartBody(transferSyntaxUID, frame):
+    mediaType = DICOMFrameDecoder.MediaTypes[transferSyntaxUID]
+    body = (f"--{Boundary}\r\nContent-Type: {mediaType}; "
+            f"transfer-syntax={transferSyntaxUID}\r\n\r\n").encode()
+    return body + frame + f"\r\n--{Boundary}--\r\n".encode()
+
+# responses are prepared up front so the stub server costs little time
+Boundary = "stub-boundary"
+frames = [phantomFrame(index) for index in range(distinctFrames)]
+bodies = {uid: [multipartBody(uid, encoder(frame)) for frame in frames]
+          for uid,encoder in encoders.items()}
+gzippedBodies = [gzip.compress(body) for body in bodies["1.2.840.10008.1.2.1"]]
+bytesSent = [0]
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        frameIndex = int(self.path.split("/instances/")[1].split("/")[0]) % distinctFrames
+        transferSyntaxUID = "1.2.840.10008.1.2.1"
+        for mediaRange in self.headers.get("Accept", "").split(","):
+            _, parameters = DICOMFrameDecoder.contentTypeParameters(mediaRange)
+            if parameters.get("transfer-syntax") in bodies:
+                transferSyntaxUID = parameters["transfer-syntax"]
+                break
+        body = bodies[transferSyntaxUID][frameIndex]
+        mediaType = DICOMFrameDecoder.MediaTypes[transferSyntaxUID]
+        self.send_response(200)
+        self.send_header("Content-Type", f'multipart/related; type="{mediaType}"; '
+                                         f'boundary={Boundary}')
+        if self.server.gzip and transferSyntaxUID == "1.2.840.10008.1.2.1" \
+                and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzippedBodies[frameIndex]
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        time.sleep(8 * len(body) / (megabitsPerSecond * 1e6))
+        self.wfile.write(body)
+        bytesSent[0] += len(body)
+
+class FrameInfoDatabase:
+    """Stands in for the TagCache lookups of the frame geometry"""
+    def instanceValues(self, sopInstanceUID, tags):
+        values = {"0028,0010": rows, "0028,0011": columns, "0028,0002": 1,
+                  "0028,0100": 16, "0028,0101": 12, "0028,0103": 0}
+        return {tag: str(values[tag]) for tag in tags}
+
+def retrieve(url, transferSyntaxes, decodeWorkers, decodeExecutor):
+    store = DICOMwebStore(FrameInfoDatabase(), url, transferSyntaxes=transferSyntaxes,
+                          decodeWorkers=decodeWorkers, decodeExecutor=decodeExecutor)
+    urls = [f"{url}/studies/1/series/1/instances/{index}/frames/1"
+            for index in range(frameCount)]
+    bytesSent[0] = 0
+    startTime = time.time()
+    store.startRequest(urls)
+    framesByURL = {}
+    while len(framesByURL) < len(urls):
+        framesByURL.update(store.getFrames(urls))
+        time.sleep(0.001)
+    elapsed = time.time() - startTime
+    store.shutdown()
+    for index,url in enumerate(urls):
+        if not np.array_equal(framesByURL[url], frames[index % distinctFrames].reshape(-1)):
+            raise RuntimeError(f"Frame {index} differs after decoding")
+    return elapsed, bytesSent[0]
+
+if __name__ == "__main__":
+    servers = {}
+    for useGzip in (False, True):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        server.gzip = useGzip
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[useGzip] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    syntaxes = [("uncompressed", None, False), ("deflate", None, True), ("rle", ["rle"], False)]
+    if imagecodecs is not None:
+        syntaxes += [("jpegls", ["jpegls"], False), ("htj2k", ["htj2k"], False)]
+    print(f"{frameCount} frames of {rows}x{columns} at {megabitsPerSecond} Mbit/s")
+    for name,transferSyntaxes,useGzip in syntaxes:
+        for decodeWorkers,decodeExecutor in ((0, None), (8, "thread"), (8, "process")):
+            elapsed, byteCount = retrieve(servers[useGzip], transferSyntaxes,
+                                          decodeWorkers, decodeExecutor)
+            workers = f"{decodeWorkers} x {decodeExecutor}" if decodeWorkers else "inline"
+            print(f"{name:>12} {workers:>11}: {frameCount / elapsed:7.1f} frames/s, "
+                  f"{byteCount / frameCount / 1e3:7.1f} kB/frame")
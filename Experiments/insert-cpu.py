@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the per-instance CPU cost of preparing a dataset
+for ctkSQLite.insert, comparing the previous approach (resolving
+keywords and formatting tags for every instance) with the tag plan
+that ctkSQLite compiles once per database.
+
+  python insert-cpu.py [instanceCount]
+"""
+import datetime
+import pydicom
+import sys
+import tempfile
+import time
+
+import DICOMLogic
+from DICOMLogic.databases import DICOMDatabase, ctkSQLite
+
+instanceCount = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+# a subset of the tags Slicer precaches by default
+tagsToPrecache = ("0008,0008", "0008,0016", "0008,0060", "0008,103E",
+                  "0010,0010", "0018,0050", "0020,000E", "0020,0011",
+                  "0020,0013", "0020,0032", "0020,0037", "0028,0030")
+
+def instanceDataset(index):
+    ds = pydicom.Dataset()
+    ds.PatientName = "Patient^Test"
+    ds.PatientID = "P1"
+    ds.StudyInstanceUID = "1.2.3"
+    ds.SeriesInstanceUID = f"1.2.3.{index // 500}"
+    ds.SOPInstanceUID = f"1.2.3.{index // 500}.{index}"
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.Modality = "CT"
+    ds.Manufacturer = "ACME"
+    ds.InstanceNumber = str(index)
+    ds.ImagePositionPatient = ["-250.0", "-250.0", str(-1.25 * index)]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.BitsAllocated = 16
+    return ds
+
+def previousPreparation(db, ds, seriesThisBatch):
+    """the per-instance work done by insert before the tag plan"""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    for tag in ctkSQLite.RequiredTags:
+        if tag not in ds:
+            setattr(ds, tag, "")
+    cacheTagValues = []
+    extraTags = [DICOMDatabase.dicomTagWithComma(k) for k in ctkSQLite.ExtraKeys]
+    tagsToCache = db.tagsToPrecache + tuple(extraTags)
+    for tag in tagsToCache:
+        dsTag = tag.replace(',','').upper()
+        if dsTag in ds:
+            value = ds[dsTag]._value
+            if value == "":
+                value = ctkSQLite.ValueIsEmptyString
+            elif ds[dsTag].VR == 'DS' and ds[dsTag].VM > 1:
+                value = "\\".join(map(str, list(value)))
+        else:
+            value = ctkSQLite.TagNotInInstance
+        if tag in db.tagsToExcludeFromStorage:
+            value = ctkSQLite.ValueIsNotStored
+        cacheTagValues.append((str(ds.SOPInstanceUID), tag.upper(), str(value)))
+    if ds.SeriesInstanceUID not in seriesThisBatch:
+        seriesThisBatch.append(ds.SeriesInstanceUID)
+    return cacheTagValues
+
+def currentPreparation(db, ds, seriesThisBatch):
+    values = db.datasetValues(ds)
+    cacheTagValues = db.tagCacheValues(ds, str(values.SOPInstanceUID))
+    if values.SeriesInstanceUID not in seriesThisBatch:
+        seriesThisBatch.add(values.SeriesInstanceUID)
+    return cacheTagValues
+
+db = ctkSQLite(tempfile.mkdtemp(), tagsToPrecache=tagsToPrecache)
+datasets = [instanceDataset(index) for index in range(instanceCount)]
+
+startTime = time.process_time()
+seriesThisBatch = []
+for ds in datasets:
+    previousPreparation(db, ds, seriesThisBatch)
+previous = (time.process_time() - startTime) / instanceCount
+
+datasets = [instanceDataset(index) for index in range(instanceCount)]
+startTime = time.process_time()
+seriesThisBatch = set()
+for ds in datasets:
+    currentPreparation(db, ds, seriesThisBatch)
+current = (time.process_time() - startTime) / instanceCount
+
+print(f"previous: {1e6 * previous:.1f} us per instance")
+print(f" current: {1e6 * current:.1f} us per instance ({previous / current:.1f}x)")
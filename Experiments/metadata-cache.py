@@ -0,0 +1,158 @@
+"""
+Check each tier of the DICOMweb metadata cache against a local stub
+DICOMweb server that answers conditional requests: values precached
+in the TagCache, series metadata kept in memory, on disk, revalidated
+with the server once older than the ttl, and evicted when the disk
+tier grows beyond maxBytes.
+
+  python metadata-cache.py [seriesCount] [instancesPerSeries]
+
+Note: creating the ctkDICOM database downloads the schema, so network
+access is needed.
+"""
+import hashlib
+import http.server
+import json
+import os
+import pydicom
+import sys
+import tempfile
+import threading
+import urllib.parse
+
+import DICOMLogic
+from DICOMLogic.stores import DICOMwebMetadataCache, DICOMwebStore
+
+seriesCount = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+instancesPerSeries = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+studyInstanceUID = "1.2.3"
+
+def instanceJSON(seriesIndex, index, kernel="STANDARD"):
+    ds = pydicom.Dataset()
+    ds.PatientName = "Patient^0"
+    ds.PatientID = "P0"
+    ds.StudyInstanceUID = studyInstanceUID
+    ds.SeriesInstanceUID = f"{studyInstanceUID}.{seriesIndex}"
+    ds.SOPInstanceUID = f"{studyInstanceUID}.{seriesIndex}.{index}"
+    ds.SOPClassUID = pydicom.uid.CTImageStorage
+    ds.Modality = "CT"
+    ds.SeriesNumber = str(seriesIndex)
+    ds.InstanceNumber = str(index)
+    ds.SliceThickness = "1.25"
+    ds.ConvolutionKernel = kernel
+    ds.Rows = 512
+    ds.Columns = 512
+    return ds.to_json_dict()
+
+def seriesBody(seriesIndex, kernel="STANDARD"):
+    return json.dumps([instanceJSON(seriesIndex, index, kernel)
+                       for index in range(instancesPerSeries)]).encode()
+
+bodiesBySeries = {f"{studyInstanceUID}.{seriesIndex}": seriesBody(seriesIndex)
+                  for seriesIndex in range(seriesCount)}
+requestsByStatus = {200: 0, 304: 0}
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        resource = urllib.parse.urlparse(self.path).path.split("/studies/")[1].split("/")
+        if resource[-1] == "metadata" and len(resource) == 2:
+            body = b"[" + b",".join([body[1:-1] for body in bodiesBySeries.values()]) + b"]"
+        else:
+            body = bodiesBySeries[resource[2]]
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            requestsByStatus[304] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        requestsByStatus[200] += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/dicom+json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def requestCount():
+    return requestsByStatus[200] + requestsByStatus[304]
+
+def frameURL(url, seriesIndex, index=0):
+    return (f"{url}/studies/{studyInstanceUID}/series/{studyInstanceUID}.{seriesIndex}"
+            f"/instances/{studyInstanceUID}.{seriesIndex}.{index}/frames/1")
+
+def check(name, statistics, expected):
+    for key, value in expected.items():
+        assert statistics[key] == value, f"{name}: {key} is {statistics[key]}, not {value}"
+    print(f"{name:>12}: {statistics}")
+
+if __name__ == "__main__":
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    cacheDirectory = tempfile.mkdtemp()
+    seriesBytes = len(bodiesBySeries[f"{studyInstanceUID}.0"])
+
+    db = DICOMLogic.databases.ctkSQLite(tempfile.mkdtemp(), tagsToPrecache=("0018,0050",))
+    cache = DICOMwebMetadataCache(cacheDirectory)
+    store = DICOMwebStore(db, url, metadataCache=cache)
+    store.indexStudy(studyInstanceUID)
+
+    # precached tags are answered by the TagCache without a request
+    indexRequests = requestCount()
+    for index in range(instancesPerSeries):
+        assert store.fileValue(frameURL(url, 0, index), "0018,0050") == "1.25"
+    assert requestCount() == indexRequests
+    check("TagCache", cache.report(), {"tagCacheHits": instancesPerSeries, "networkFetches": 0})
+
+    # other tags fetch the series metadata once, then are read from memory
+    for index in range(instancesPerSeries):
+        assert store.fileValue(frameURL(url, 0, index), "0018,1210") == "STANDARD"
+    assert requestCount() == indexRequests + 1
+    check("memory", cache.report(), {"networkFetches": 1, "bytesFromNetwork": seriesBytes,
+                                     "memoryHits": instancesPerSeries - 1, "bytesSaved": 0})
+
+    # a new cache on the same directory, as in a later process, reads it from disk
+    cache = DICOMwebMetadataCache(cacheDirectory)
+    store.metadataCache = cache
+    for index in range(instancesPerSeries):
+        store.fileValue(frameURL(url, 0, index), "0018,1210")
+    assert requestCount() == indexRequests + 1
+    check("disk", cache.report(), {"diskHits": 1, "networkFetches": 0,
+                                   "bytesSaved": seriesBytes})
+
+    # entries older than the ttl are revalidated, and refetched when changed
+    cache = DICOMwebMetadataCache(cacheDirectory, ttl=0)
+    store.metadataCache = cache
+    store.fileValue(frameURL(url, 0), "0018,1210")
+    assert requestsByStatus[304] == 1
+    check("revalidated", cache.report(), {"revalidations": 1, "diskHits": 1,
+                                          "networkFetches": 0, "bytesSaved": seriesBytes})
+    bodiesBySeries[f"{studyInstanceUID}.0"] = seriesBody(0, kernel="BONE")
+    cache = DICOMwebMetadataCache(cacheDirectory, ttl=0)
+    store.metadataCache = cache
+    assert store.fileValue(frameURL(url, 0), "0018,1210") == "BONE"
+    check("changed", cache.report(), {"revalidations": 1, "diskHits": 0,
+                                      "networkFetches": 1, "bytesSaved": 0})
+
+    # the least recently used entries are evicted beyond maxBytes
+    compressedBytes = os.path.getsize(cache.entryPaths(
+            f"{url}/studies/{studyInstanceUID}/series/{studyInstanceUID}.0/metadata")[0])
+    cache = DICOMwebMetadataCache(cacheDirectory, maxBytes=int(2.5 * compressedBytes),
+                                  memorySeries=0)
+    store.metadataCache = cache
+    for seriesIndex in range(seriesCount):
+        store.fileValue(frameURL(url, seriesIndex), "0018,1210")
+    entries = [name for name in os.listdir(cacheDirectory) if name.endswith(".json.gz")]
+    assert len(entries) == 2 and cache.diskBytes <= cache.maxBytes, entries
+    store.fileValue(frameURL(url, seriesCount - 1), "0018,1210")
+    store.fileValue(frameURL(url, 0), "0018,1210")
+    check("evicted", cache.report(), {"diskHits": 2, "networkFetches": seriesCount})
+    server.shutdown()
+    print("Finish")
@@ -0,0 +1,161 @@
+"""
+Compare indexing studies from the full WADO-RS metadata with indexing
+from QIDO-RS instance queries for only the stored fields, served by a
+local stub DICOMweb server.
+
+  python qido-indexing.py [studyCount] [instancesPerStudy] [megabitsPerSecond]
+
+The synthetic metadata resembles that of scanner CT: besides the indexed
+tags each instance has a referenced image sequence, acquisition details
+and a few kilobytes of private tags, all of which the database discards.
+The stub server answers QIDO-RS queries with only the includefield tags,
+in pages of at most 500 instances whatever limit is asked for.
+
+Note: creating the ctkDICOM database downloads the schema, so network
+access is needed.
+"""
+import base64
+import http.server
+import json
+import os
+import pydicom
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import DICOMLogic
+from DICOMLogic.stores import DICOMwebStore
+
+studyCount = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+instancesPerStudy = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+megabitsPerSecond = float(sys.argv[3]) if len(sys.argv) > 3 else 100
+maximumPageSize = 500
+
+# a subset of the tags Slicer precaches by default
+tagsToPrecache = ("0008,0008", "0008,0016", "0008,0060", "0008,103E",
+                  "0010,0010", "0018,0050", "0020,000E", "0020,0011",
+                  "0020,0013", "0020,0032", "0020,0037", "0028,0030")
+
+def instanceJSON(studyIndex, index):
+    seriesIndex = index // 100
+    ds = pydicom.Dataset()
+    ds.PatientName = f"Patient^{studyIndex}"
+    ds.PatientID = f"P{studyIndex}"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.StudyInstanceUID = f"1.2.3.{studyIndex}"
+    ds.StudyDate = "20240101"
+    ds.StudyTime = "120000"
+    ds.StudyDescription = "CT CHEST"
+    ds.AccessionNumber = f"A{studyIndex}"
+    ds.SeriesInstanceUID = f"1.2.3.{studyIndex}.{seriesIndex}"
+    ds.SOPInstanceUID = f"1.2.3.{studyIndex}.{seriesIndex}.{index}"
+    ds.SOPClassUID = pydicom.uid.CTImageStorage
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.Modality = "CT"
+    ds.Manufacturer = "ACME"
+    ds.SeriesDescription = f"Series {seriesIndex}"
+    ds.SeriesNumber = str(seriesIndex)
+    ds.InstanceNumber = str(index % 100)
+    ds.SliceThickness = "1.25"
+    ds.ImagePositionPatient = ["-250.0", "-250.0", str(-1.25 * index)]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.SamplesPerPixel = 1
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.PixelRepresentation = 0
+    ds.RescaleIntercept = "-1024"
+    ds.RescaleSlope = "1"
+    ds.WindowCenter = "40"
+    ds.WindowWidth = "400"
+    # discarded by the database
+    ds.KVP = "120"
+    ds.ExposureTime = "500"
+    ds.XRayTubeCurrent = "300"
+    ds.ConvolutionKernel = "STANDARD"
+    ds.ReconstructionDiameter = "360"
+    ds.ReferencedImageSequence = [pydicom.Dataset() for _ in range(3)]
+    for item in ds.ReferencedImageSequence:
+        item.ReferencedSOPClassUID = ds.SOPClassUID
+        item.ReferencedSOPInstanceUID = f"1.2.3.{studyIndex}.99.{index}"
+    ds.add_new(0x00091010, "LO", "ACME PRIVATE")
+    ds.add_new(0x00091011, "OB", os.urandom(3000))
+    instance = ds.to_json_dict()
+    instance["00091011"] = {"vr": "OB", "InlineBinary":
+                            base64.b64encode(ds[0x00091011].value).decode()}
+    return instance
+
+metadataByStudy = {f"1.2.3.{studyIndex}": [instanceJSON(studyIndex, index)
+                                           for index in range(instancesPerStudy)]
+                   for studyIndex in range(studyCount)}
+bodiesByStudy = {uid: json.dumps(metadata).encode() for uid,metadata in metadataByStudy.items()}
+bytesSent = [0]
+requestCount = [0]
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        studyInstanceUID, *resource = parsed.path.split("/studies/")[1].split("/")
+        if resource == ["metadata"]:
+            body = bodiesByStudy[studyInstanceUID]
+        elif resource[-1] == "metadata":
+            seriesInstanceUID = resource[1]
+            body = json.dumps([instance for instance in metadataByStudy[studyInstanceUID]
+                               if instance["0020000E"]["Value"][0] == seriesInstanceUID]).encode()
+        else:
+            query = urllib.parse.parse_qs(parsed.query)
+            fields = set(query.get("includefield", []))
+            offset = int(query["offset"][0])
+            limit = min(int(query["limit"][0]), maximumPageSize)
+            page = metadataByStudy[studyInstanceUID][offset:offset+limit]
+            instances = [{tag: value for tag,value in instance.items() if tag in fields}
+                         for instance in page]
+            body = json.dumps(instances).encode() if instances else b""
+        self.send_response(200 if body else 204)
+        self.send_header("Content-Type", "application/dicom+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        time.sleep(8 * len(body) / (megabitsPerSecond * 1e6))
+        self.wfile.write(body)
+        bytesSent[0] += len(body)
+        requestCount[0] += 1
+
+def index(url, minimalMetadata):
+    db = DICOMLogic.databases.ctkSQLite(tempfile.mkdtemp(), tagsToPrecache=tagsToPrecache)
+    store = DICOMwebStore(db, url, minimalMetadata=minimalMetadata)
+    bytesSent[0] = requestCount[0] = 0
+    startTime = time.time()
+    instanceCount = 0
+    for studyInstanceUID in metadataByStudy:
+        instanceCount += store.indexStudy(studyInstanceUID)
+    elapsed = time.time() - startTime
+    return store, db, instanceCount, elapsed, bytesSent[0], requestCount[0]
+
+if __name__ == "__main__":
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"{studyCount} studies of {instancesPerStudy} instances at {megabitsPerSecond} Mbit/s")
+    for name,minimalMetadata in (("metadata", False), ("qido", True)):
+        store, db, instanceCount, elapsed, byteCount, requests = index(url, minimalMetadata)
+        print(f"{name:>9}: {instanceCount / elapsed:8.1f} instances/s, "
+              f"{byteCount / instanceCount / 1e3:6.2f} kB/instance, {requests} requests")
+
+    # a tag that was not indexed is read from the series metadata once
+    frameURL = list(db.urlsForSeries("1.2.3.0.0").values())[0]
+    bytesSent[0] = requestCount[0] = 0
+    kernel = store.fileValue(frameURL, "0018,1210")
+    thickness = store.fileValue(frameURL, "0018,0050")
+    print(f"   lazily: ConvolutionKernel {kernel} with {requestCount[0]} request, "
+          f"SliceThickness {thickness} from the TagCache")
@@ -0,0 +1,87 @@
+"""
+Compare rebuilding a ctkSQLite database by re-indexing (inserting every
+dataset, as indexing does once the metadata has arrived, so this leaves
+out all network time) with loading it from a columnar snapshot, and
+time writing the snapshot.
+
+  python snapshot-load.py [instanceCount] [format]
+
+where format is parquet (default) or arrow.
+
+Note: creating the ctkDICOM database downloads the schema, so network
+access is needed.
+"""
+import os
+import pydicom
+import sys
+import tempfile
+import time
+
+from DICOMLogic.databases import ctkColumnarSnapshot, ctkSQLite
+
+instanceCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+format = sys.argv[2] if len(sys.argv) > 2 else "parquet"
+batchSize = 1000
+
+# a subset of the tags Slicer precaches by default
+tagsToPrecache = ("0008,0008", "0008,0016", "0008,0060", "0008,103E",
+                  "0010,0010", "0018,0050", "0020,000E", "0020,0011",
+                  "0020,0013", "0020,0032", "0020,0037", "0028,0030")
+
+def instanceDataset(index):
+    studyIndex = index // 2000
+    seriesIndex = index // 500
+    ds = pydicom.Dataset()
+    ds.PatientName = f"Patient^{studyIndex}"
+    ds.PatientID = f"P{studyIndex}"
+    ds.StudyInstanceUID = f"1.2.3.{studyIndex}"
+    ds.StudyDescription = "CT CHEST"
+    ds.SeriesInstanceUID = f"1.2.3.{studyIndex}.{seriesIndex}"
+    ds.SeriesDescription = f"Series {seriesIndex}"
+    ds.SeriesNumber = str(seriesIndex)
+    ds.SOPInstanceUID = f"1.2.3.{studyIndex}.{seriesIndex}.{index}"
+    ds.SOPClassUID = pydicom.uid.CTImageStorage
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.Modality = "CT"
+    ds.Manufacturer = "ACME"
+    ds.SliceThickness = "1.25"
+    ds.InstanceNumber = str(index % 500)
+    ds.ImagePositionPatient = ["-250.0", "-250.0", str(-1.25 * (index % 500))]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.Rows = 512
+    ds.Columns = 512
+    return ds
+
+datasets = [instanceDataset(index) for index in range(instanceCount)]
+print(f"{instanceCount} instances, {format} snapshot")
+
+db = ctkSQLite(tempfile.mkdtemp(), tagsToPrecache=tagsToPrecache)
+startTime = time.time()
+for start in range(0, instanceCount, batchSize):
+    with db.batch() as batch:
+        for ds in datasets[start:start+batchSize]:
+            batch.insert(ds, f"file:///{ds.SOPInstanceUID}.dcm")
+reindexTime = time.time() - startTime
+print(f"re-index: {reindexTime:6.2f}s, {instanceCount / reindexTime:8.0f} instances/s")
+
+snapshot = ctkColumnarSnapshot(tempfile.mkdtemp(), format=format)
+startTime = time.time()
+snapshot.export(db)
+exportTime = time.time() - startTime
+snapshotBytes = sum([os.path.getsize(os.path.join(directory, name))
+                     for directory, _, names in os.walk(snapshot.directory)
+                     for name in names])
+print(f"  export: {exportTime:6.2f}s, {snapshotBytes / 1e6:.1f} MB")
+
+startTime = time.time()
+loaded = snapshot.load(tempfile.mkdtemp(), tagsToPrecache=tagsToPrecache)
+loadTime = time.time() - startTime
+print(f"    load: {loadTime:6.2f}s, {instanceCount / loadTime:8.0f} instances/s "
+      f"({reindexTime / loadTime:.1f}x faster than re-indexing)")
+
+for key in ("Patients", "Studies", "Series", "Images", "TagCache"):
+    assert loaded.statistics()[key] == db.statistics()[key], key
+sopInstanceUID = datasets[-1].SOPInstanceUID
+assert loaded.instanceValues(sopInstanceUID, tagsToPrecache) == \
+        db.instanceValues(sopInstanceUID, tagsToPrecache)
@@ -0,0 +1,83 @@
+"""
+Compare the size of the TagCache database in the default
+and the compact storage modes for a synthetic dataset.
+
+  python tagcache-size.py [seriesCount] [instancesPerSeries]
+
+Note: creating the ctkDICOM database downloads the schema, so network
+access is needed.
+"""
+import os
+import pydicom
+import sys
+import tempfile
+import time
+
+import DICOMLogic
+
+seriesCount = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+instancesPerSeries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+# a subset of the tags Slicer precaches by default
+tagsToPrecache = ("0008,0008", "0008,0016", "0008,0060", "0008,103E",
+                  "0008,1090", "0010,0010", "0010,0020", "0018,0050",
+                  "0018,0088", "0020,000D", "0020,000E", "0020,0011",
+                  "0020,0013", "0020,0032", "0020,0037", "0020,1041",
+                  "0028,0004", "0028,0030", "0028,0100", "0028,0101",
+                  "0028,0102", "0028,0103", "0028,1050", "0028,1051")
+
+def instanceDataset(seriesIndex, instanceIndex):
+    ds = pydicom.Dataset()
+    ds.PatientName = f"Patient^{seriesIndex // 4}"
+    ds.PatientID = f"P{seriesIndex // 4}"
+    ds.StudyInstanceUID = f"1.2.3.{seriesIndex // 4}"
+    ds.SeriesInstanceUID = f"1.2.3.{seriesIndex // 4}.{seriesIndex}"
+    ds.SOPInstanceUID = f"1.2.3.{seriesIndex // 4}.{seriesIndex}.{instanceIndex}"
+    ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.Modality = "CT"
+    ds.SeriesDescription = f"Series {seriesIndex}"
+    ds.Manufacturer = "ACME"
+    ds.ManufacturerModelName = "Scanner 3000"
+    ds.SliceThickness = "1.25"
+    ds.SpacingBetweenSlices = "1.25"
+    ds.SeriesNumber = str(seriesIndex)
+    ds.InstanceNumber = str(instanceIndex)
+    ds.ImagePositionPatient = ["-250.0", "-250.0", str(-1.25 * instanceIndex)]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.SliceLocation = str(-1.25 * instanceIndex)
+    ds.ContentDate = "20231101"
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 1
+    ds.WindowCenter = "40"
+    ds.WindowWidth = "400"
+    ds.RescaleIntercept = "-1024"
+    ds.RescaleSlope = "1"
+    return ds
+
+sizes = {}
+for compact in (False, True):
+    dbDirectory = tempfile.mkdtemp()
+    db = DICOMLogic.databases.ctkSQLite(dbDirectory,
+                                        tagsToPrecache=tagsToPrecache,
+                                        compactTagCache=compact)
+    startTime = time.time()
+    for seriesIndex in range(seriesCount):
+        db.startBatchInsert()
+        for instanceIndex in range(instancesPerSeries):
+            db.insert(instanceDataset(seriesIndex, instanceIndex), "")
+        db.endBatchInsert()
+    elapsed = time.time() - startTime
+    sizes[compact] = os.path.getsize(db.tagCacheFilePath)
+    statistics = db.statistics()
+    mode = "compact" if compact else "default"
+    print(f"{mode:>8}: {statistics['TagCache']} tag values, "
+          f"{sizes[compact] / 1e6:.2f} MB, inserted in {elapsed:.1f}s")
+
+print(f"Compact TagCache is {100 * (1 - sizes[True] / sizes[False]):.0f}% smaller")
@@ -41,11 +41,6 @@ if sys.argv[1] == "--index":
     slicer.dicomDatabase.openDatabase(dbDirectory + "/ctkDICOM.sql")
     print(f"Opening time = {time.time() - startTime}")
 
-    print("Updating Display:")
-    startTime = time.time()
-    slicer.dicomDatabase.updateDisplayedFields()
-    print(f"Updating time = {time.time() - startTime}")
-
     print("Selecting module:")
     startTime = time.time()
     slicer.util.selectModule("DICOM")
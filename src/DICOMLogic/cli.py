@@ -0,0 +1,722 @@
+"""
+Command line entry point for running DICOMLogic outside of Slicer.
+
+  dicomlogic index dicomweb URL --db DIR [--concurrency N] [--incremental] [--minimal-metadata]
+  dicomlogic index ahi DATASTOREID --db DIR [--resume FILE]
+  dicomlogic index files DIRECTORY --db DIR [--workers N]
+  dicomlogic index dimse HOST PORT --db DIR [--aet AETITLE] [--concurrency N]
+  dicomlogic fetch --db DIR --study UID [--format nrrd]
+  dicomlogic stats --db DIR
+  dicomlogic export --db DIR SNAPSHOTDIR [--format arrow]
+  dicomlogic import SNAPSHOTDIR --db DIR
+
+Indexing fetches metadata with a pool of worker threads while the main
+thread inserts into the ctkSQLite database, so many such processes can
+be run side by side (e.g. one per --offset/--limit page range per node).
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import numpy as np
+
+from DICOMLogic.databases import DICOMDatabase, ctkSQLite, ctkColumnarSnapshot
+
+
+class Progress:
+    """Prints per-item progress and overall throughput"""
+
+    def __init__(self, label, total=None, stream=sys.stdout):
+        self.label = label
+        self.total = total
+        self.stream = stream
+        self.startTime = time.time()
+        self.itemCount = 0
+        self.instanceCount = 0
+        self.failureCount = 0
+
+    def update(self, key, instanceCount):
+        self.itemCount += 1
+        self.instanceCount += instanceCount
+        elapsed = time.time() - self.startTime
+        of = f"/{self.total}" if self.total else ""
+        rate = self.instanceCount / elapsed if elapsed > 0 else 0
+        print(f"[{self.itemCount}{of}] {self.label} {key}: "
+              f"{instanceCount} instances, "
+              f"{self.instanceCount} total in {elapsed:.1f}s "
+              f"({rate:.1f} instances/s)", file=self.stream, flush=True)
+
+    def fail(self, key, error):
+        self.failureCount += 1
+        print(f"FAILED {self.label} {key}: {error}", file=self.stream, flush=True)
+
+    def finish(self):
+        elapsed = time.time() - self.startTime
+        rate = self.instanceCount / elapsed if elapsed > 0 else 0
+        print(f"Finished {self.itemCount} {self.label} items "
+              f"({self.failureCount} failed), {self.instanceCount} instances "
+              f"in {elapsed:.1f}s ({rate:.1f} instances/s)",
+              file=self.stream, flush=True)
+
+
+class ResumeLog:
+    """
+    A text file with one completed key (study or image set) per line,
+    appended as work completes so that an interrupted job can be restarted.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.completed = set()
+        if path and os.path.exists(path):
+            with open(path) as fp:
+                self.completed = set(line.strip() for line in fp if line.strip())
+
+    def record(self, key):
+        self.completed.add(key)
+        if self.path:
+            with open(self.path, "a") as fp:
+                fp.write(f"{key}\n")
+
+
+class Headers:
+    """
+    Request headers from --header options plus an optional bearer token
+    from --token-command (e.g. "gcloud auth print-access-token")
+    which is refreshed every half hour.
+    """
+
+    RefreshSeconds = 30 * 60
+
+    def __init__(self, headerOptions=(), tokenCommand=None):
+        self.headers = {}
+        for option in headerOptions:
+            name, value = option.split(":", 1)
+            self.headers[name.strip()] = value.strip()
+        self.tokenCommand = tokenCommand
+        self.tokenTime = None
+
+    def current(self):
+        if self.tokenCommand:
+            if self.tokenTime is None \
+                    or time.time() - self.tokenTime > Headers.RefreshSeconds:
+                tokenProcess = subprocess.run(self.tokenCommand, capture_output=True,
+                                              shell=True, text=True, check=True)
+                self.headers["Authorization"] = f"Bearer {tokenProcess.stdout.strip()}"
+                self.tokenTime = time.time()
+        return dict(self.headers)
+
+
+def openDatabase(args):
+    tagsToPrecache = []
+    for tag in args.precache_tag:
+        tagsToPrecache.append(tag.upper())
+    if args.precache_file:
+        with open(args.precache_file) as fp:
+            tagsToPrecache += [line.strip().upper() for line in fp if line.strip()]
+    os.makedirs(args.db, exist_ok=True)
+    return ctkSQLite(args.db, tagsToPrecache=tuple(tagsToPrecache),
+                     compactTagCache=args.compact_tag_cache)
+
+
+def pagedKeys(pageFunction, pageSize, offset, limit):
+    """Generate keys from a function returning a page given (limit, offset)"""
+    produced = 0
+    while limit is None or produced < limit:
+        page = pageFunction(pageSize, offset)
+        if not page:
+            break
+        for key in page:
+            if limit is not None and produced >= limit:
+                break
+            yield key
+            produced += 1
+        offset += len(page)
+
+
+def runIndexJobs(keys, fetch, index, progress, resume, concurrency, skip=()):
+    """
+    Fetch metadata for each key with a thread pool and index the results
+    in this thread as they complete.  At most 2*concurrency fetches are
+    outstanding so that memory use stays bounded on large archives.
+    """
+    keyIterator = iter(keys)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+
+        def submitMore():
+            while len(pending) < 2 * concurrency:
+                key = next(keyIterator, None)
+                if key is None:
+                    return
+                if key in resume.completed or key in skip:
+                    continue
+                pending[executor.submit(fetch, key)] = key
+
+        submitMore()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    instanceCount = index(future.result())
+                except Exception as error:
+                    logging.debug("indexing failed", exc_info=True)
+                    progress.fail(key, error)
+                    continue
+                resume.record(key)
+                progress.update(key, instanceCount)
+            submitMore()
+    progress.finish()
+    return progress.failureCount == 0
+
+
+def metadataCache(args):
+    from DICOMLogic.stores import DICOMwebMetadataCache
+    return DICOMwebMetadataCache(args.metadata_cache)
+
+
+def printCacheReport(cache):
+    print("Metadata cache: " + ", ".join([f"{key} {value}"
+                                          for key, value in cache.report().items()]))
+
+
+def indexDICOMweb(args, db):
+    from DICOMLogic.stores import DICOMwebStore
+    headers = Headers(args.header, args.token_command)
+    cache = metadataCache(args)
+    store = DICOMwebStore(db, args.url, headers=headers.current(),
+                          metadataCache=cache, minimalMetadata=args.minimal_metadata)
+
+    if args.study:
+        keys = args.study
+    else:
+        def studyPage(limit, offset):
+            store.headers = headers.current()
+            return store.studyInstanceUIDs(limit=limit, offset=offset)
+        keys = pagedKeys(studyPage, args.page_size, args.offset, args.limit)
+
+    skip = set(db.studies()) if args.incremental else set()
+
+    def fetch(studyInstanceUID):
+        return store.studyIndexMetadata(studyInstanceUID)
+
+    def index(studyMetadata):
+        store.headers = headers.current()
+        return store.indexStudyMetadata(studyMetadata)
+
+    progress = Progress("study", total=len(keys) if args.study else None)
+    succeeded = runIndexJobs(keys, fetch, index, progress, ResumeLog(args.resume),
+                             args.concurrency, skip)
+    printCacheReport(cache)
+    return succeeded
+
+
+def indexAHI(args, db):
+    from DICOMLogic.stores import DICOMAHIStore
+    store = DICOMAHIStore(db, args.datastore_id)
+
+    if args.image_set:
+        keys = args.image_set
+    else:
+        def imageSetIDs():
+            summaries = store.imageSetSummaries(pageSize=args.page_size)
+            for position, summary in enumerate(summaries):
+                if position < args.offset:
+                    continue
+                if args.limit is not None and position >= args.offset + args.limit:
+                    break
+                yield summary['imageSetId']
+        keys = imageSetIDs()
+
+    skip = set()
+    if args.incremental:
+        # frame urls are ahi://datastoreId/imageSetId/series/instance/frame
+        rows = db.query(db.databaseFilePath,
+                        "SELECT URL FROM Images WHERE URL LIKE 'ahi://%'")
+        for (url,) in rows:
+            parts = url.split("/")
+            if len(parts) > 3:
+                skip.add(parts[3])
+
+    progress = Progress("image set", total=len(keys) if args.image_set else None)
+    return runIndexJobs(keys, store.imageSetMetadata, store.indexImageSet,
+                        progress, ResumeLog(args.resume), args.concurrency, skip)
+
+
+def indexFiles(args, db):
+    from DICOMLogic.stores import DICOMFileStore
+    store = DICOMFileStore(db)
+    succeeded = True
+    for directory in args.directory:
+        if not os.path.isdir(directory):
+            logging.error(f"{directory} is not a directory")
+            succeeded = False
+            continue
+        result = store.indexDirectory(directory, workers=args.workers)
+        rate = result["files"] / result["seconds"] if result["seconds"] else 0
+        print(f"{directory}: {result['instances']} instances from {result['read']} files read, "
+              f"{result['skipped']} unchanged files skipped ({rate:.0f} files/s)")
+    return succeeded
+
+
+def indexDIMSE(args, db):
+    from DICOMLogic.stores import DICOMDIMSEStore
+    store = DICOMDIMSEStore(db, args.host, args.port, calledAETitle=args.aet,
+                            callingAETitle=args.calling_aet,
+                            maxAssociations=args.concurrency)
+    try:
+        if args.study:
+            keys = args.study
+        else:
+            studyInstanceUIDs = store.studyInstanceUIDs()
+            end = None if args.limit is None else args.offset + args.limit
+            keys = studyInstanceUIDs[args.offset:end]
+        skip = set(db.studies()) if args.incremental else set()
+        progress = Progress("study", total=len(keys))
+        return runIndexJobs(keys, store.studyInstances, store.indexInstances,
+                            progress, ResumeLog(args.resume), args.concurrency, skip)
+    finally:
+        store.shutdown()
+
+
+def cachedValue(db, sopInstanceUID, keyword):
+    """Returns the tag cache value for the keyword, or None if not available"""
+    value = db.instanceValue(sopInstanceUID, DICOMDatabase.dicomTagWithComma(keyword))
+    if value in (None, ctkSQLite.TagNotInInstance,
+                 ctkSQLite.ValueIsEmptyString, ctkSQLite.ValueIsNotStored):
+        return None
+    return value
+
+
+def instanceValue(store, db, sopInstanceUID, url, keyword):
+    """
+    Returns the tag cache value for the keyword or, when it is not cached,
+    the value from the store's metadata if the store has any, else None
+    """
+    value = cachedValue(db, sopInstanceUID, keyword)
+    if value is None and hasattr(store, "fileValue"):
+        value = store.fileValue(url, DICOMDatabase.dicomTagWithComma(keyword)) or None
+    return value
+
+
+def numberOfFrames(db, sopInstanceUID):
+    try:
+        return int(cachedValue(db, sopInstanceUID, "NumberOfFrames") or 1)
+    except ValueError:
+        return 1
+
+
+def frameURL(url, frame):
+    """Returns the url of a frame of the instance whose first frame has the url"""
+    if frame == 1:
+        return url
+    if urllib.parse.urlparse(url).scheme == "file":
+        return f"{url}?frame={frame}"
+    if url.endswith("/frames/1"):
+        return url[:-len("1")] + str(frame)
+    raise ValueError(f"No url for frame {frame} of {url}")
+
+
+def functionalGroupValue(metadata, frame, sequenceTag, tag):
+    """
+    Returns the value of the tag in the item of the sequence in the
+    per-frame, else the shared, functional groups of DICOM JSON metadata
+    """
+    for groupsTag, index in (("52009230", frame - 1), ("52009229", 0)):
+        groups = metadata.get(groupsTag, {}).get("Value", [])
+        if index < len(groups):
+            items = groups[index].get(sequenceTag, {}).get("Value", [])
+            if items and "Value" in items[0].get(tag, {}):
+                return items[0][tag]["Value"]
+    return None
+
+
+def instanceGeometry(store, db, sopInstanceUID, url):
+    """
+    Returns (position, orientation, pixel spacing) arrays for each frame of
+    the instance.  Single frame instances use ImagePositionPatient,
+    ImageOrientationPatient and PixelSpacing from the tag cache or the
+    store's metadata, while multi-frame instances need the functional
+    groups in the store's DICOM JSON metadata.  Raises ValueError when
+    the geometry is not available.
+    """
+    frameCount = numberOfFrames(db, sopInstanceUID)
+    if frameCount == 1:
+        keywords = ("ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing")
+        values = [instanceValue(store, db, sopInstanceUID, url, keyword) for keyword in keywords]
+        missing = [keyword for keyword, value in zip(keywords, values) if value is None]
+        if missing:
+            raise ValueError(f"{', '.join(missing)} not available for {sopInstanceUID}, "
+                             f"precache 0020,0032, 0020,0037 and 0028,0030 to write nrrd")
+        return [tuple([np.array(value.split("\\"), dtype=float) for value in values])]
+    if not hasattr(store, "instanceMetadata"):
+        raise ValueError(f"No per-frame geometry for multi-frame instance {sopInstanceUID}")
+    metadata = store.instanceMetadata(url)
+    geometry = []
+    for frame in range(1, frameCount + 1):
+        values = [functionalGroupValue(metadata, frame, "00209113", "00200032"),
+                  functionalGroupValue(metadata, frame, "00209116", "00200037"),
+                  functionalGroupValue(metadata, frame, "00289110", "00280030")]
+        if None in values:
+            raise ValueError(f"No plane position, orientation or pixel spacing "
+                             f"for frame {frame} of {sopInstanceUID}")
+        geometry.append(tuple([np.array(value, dtype=float) for value in values]))
+    return geometry
+
+
+def volumeGeometry(geometries):
+    """
+    Returns (slice order, space directions, space origin) for slices with
+    the (position, orientation, pixel spacing) geometries.  Raises ValueError
+    unless the slices share orientation and pixel spacing and, in order along
+    their normal, are evenly spaced to within 1% of the slice spacing.
+    """
+    orientation, pixelSpacing = geometries[0][1], geometries[0][2]
+    for _, sliceOrientation, slicePixelSpacing in geometries:
+        if not np.allclose(sliceOrientation, orientation, atol=1e-4) \
+                or not np.allclose(slicePixelSpacing, pixelSpacing, rtol=1e-4):
+            raise ValueError("Slices differ in orientation or pixel spacing")
+    rowDirection, columnDirection = orientation[:3], orientation[3:]
+    normal = np.cross(rowDirection, columnDirection)
+    positions = np.array([geometry[0] for geometry in geometries])
+    order = np.argsort(positions @ normal, kind="stable")
+    positions = positions[order]
+    if len(positions) > 1:
+        step = (positions[-1] - positions[0]) / (len(positions) - 1)
+        expected = positions[0] + np.outer(np.arange(len(positions)), step)
+        if step @ normal <= 1e-6 or \
+                np.abs(positions - expected).max() > 0.01 * np.linalg.norm(step):
+            raise ValueError("Slices are not evenly spaced along their normal "
+                             "(missing, repeated or irregular slices)")
+    else:
+        step = normal
+    directions = [rowDirection * pixelSpacing[1], columnDirection * pixelSpacing[0], step]
+    return order, directions, positions[0]
+
+
+def writeNRRD(path, volume, directions, origin):
+    """
+    Write a (slices, rows, columns) array as a raw nrrd file, with the
+    space directions of the columns, rows and slices and the origin in
+    DICOM patient coordinates
+    """
+    nrrdTypes = {"int8": "int8", "uint8": "uint8", "int16": "short",
+                 "uint16": "ushort", "int32": "int", "uint32": "uint",
+                 "float32": "float", "float64": "double"}
+    def vector(values):
+        return "(" + ",".join([f"{value:.10g}" for value in values]) + ")"
+    volume = np.ascontiguousarray(volume)
+    slices, rows, columns = volume.shape
+    header = "NRRD0004\n"
+    header += f"type: {nrrdTypes[volume.dtype.name]}\n"
+    header += "dimension: 3\n"
+    header += "space: left-posterior-superior\n"
+    header += f"sizes: {columns} {rows} {slices}\n"
+    header += f"space directions: {' '.join([vector(direction) for direction in directions])}\n"
+    header += "kinds: domain domain domain\n"
+    header += "encoding: raw\n"
+    header += f"endian: {'big' if volume.dtype.byteorder == '>' else 'little'}\n"
+    header += f"space origin: {vector(origin)}\n"
+    header += "\n"
+    with open(path, "wb") as fp:
+        fp.write(header.encode())
+        fp.write(volume.tobytes())
+
+
+def seriesVolume(store, db, frames):
+    """
+    Returns (volume, space directions, space origin) for the
+    (sopInstanceUID, frame number, frame) of a series
+    """
+    geometryByInstance = {}
+    geometries = []
+    slices = []
+    for sopInstanceUID, frameNumber, frame in frames:
+        if sopInstanceUID not in geometryByInstance:
+            url = db.urlForInstance(sopInstanceUID)
+            geometryByInstance[sopInstanceUID] = instanceGeometry(store, db, sopInstanceUID, url)
+        geometries.append(geometryByInstance[sopInstanceUID][frameNumber - 1])
+        rows = cachedValue(db, sopInstanceUID, "Rows")
+        columns = cachedValue(db, sopInstanceUID, "Columns")
+        if not (rows and columns):
+            raise ValueError(f"Rows and Columns not available for {sopInstanceUID}")
+        slices.append(frame.reshape(int(rows), int(columns)))
+    order, directions, origin = volumeGeometry(geometries)
+    return np.stack([slices[index] for index in order]), directions, origin
+
+
+def fetchSeries(store, db, seriesInstanceUID, timeout):
+    """
+    Request all frames of a series from the store and return a list of
+    (sopInstanceUID, frame number, frame) in InstanceNumber and frame order.
+    """
+    keyByURL = {}
+    for sopInstanceUID, url in db.urlsForSeries(seriesInstanceUID).items():
+        for frame in range(1, numberOfFrames(db, sopInstanceUID) + 1):
+            keyByURL[frameURL(url, frame)] = (sopInstanceUID, frame)
+    urls = list(keyByURL.keys())
+    framesByURL = {}
+    store.startRequest(urls)
+    startTime = time.time()
+    while len(framesByURL) < len(urls):
+        framesByURL.update(store.getFrames(urls))
+        if store.requestFinished():
+            framesByURL.update(store.getFrames(urls))
+            break
+        if time.time() - startTime > timeout:
+            break
+        time.sleep(0.01)
+    missing = len(urls) - len(framesByURL)
+    if missing:
+        logging.error(f"{missing} frames were not received for {seriesInstanceUID}")
+
+    def instanceNumber(url):
+        sopInstanceUID, frame = keyByURL[url]
+        value = cachedValue(db, sopInstanceUID, "InstanceNumber")
+        try:
+            return float(value), frame
+        except (TypeError, ValueError):
+            return 0, frame
+    orderedURLs = sorted(framesByURL.keys(), key=instanceNumber)
+    return [keyByURL[url] + (framesByURL[url],) for url in orderedURLs]
+
+
+def fetch(args, db):
+    headers = Headers(args.header, args.token_command)
+    seriesUIDs = list(args.series)
+    for studyInstanceUID in args.study:
+        seriesUIDs += db.seriesForStudy(studyInstanceUID)
+    outputDirectory = args.output or os.path.join(args.db, "frames")
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    storesByScheme = {}
+    cache = metadataCache(args)
+    def storeForURL(url):
+        scheme = urllib.parse.urlparse(url).scheme
+        if scheme not in storesByScheme:
+            if scheme == "ahi":
+                from DICOMLogic.stores import DICOMAHIStore
+                datastoreId = urllib.parse.urlparse(url).netloc
+                storesByScheme[scheme] = DICOMAHIStore(db, datastoreId)
+            elif scheme == "file":
+                from DICOMLogic.stores import DICOMFileStore
+                storesByScheme[scheme] = DICOMFileStore(db)
+            elif scheme == "dimse":
+                from DICOMLogic.stores import DICOMDIMSEStore
+                parsed = urllib.parse.urlparse(url)
+                storesByScheme[scheme] = DICOMDIMSEStore(db, parsed.hostname, parsed.port,
+                                                         calledAETitle=parsed.username)
+            elif scheme in ("http", "https"):
+                from DICOMLogic.stores import DICOMwebStore
+                storesByScheme[scheme] = DICOMwebStore(db, "", headers=headers.current(),
+                                                       metadataCache=cache)
+            else:
+                raise ValueError(f"No store for url scheme {scheme}")
+        return storesByScheme[scheme]
+
+    progress = Progress("series", total=len(seriesUIDs))
+    frameBytes = 0
+    for seriesInstanceUID in seriesUIDs:
+        urlsByInstance = db.urlsForSeries(seriesInstanceUID)
+        if not urlsByInstance:
+            progress.fail(seriesInstanceUID, "no instances in database")
+            continue
+        try:
+            store = storeForURL(next(iter(urlsByInstance.values())))
+            if hasattr(store, "headers"):
+                store.headers = headers.current()
+            frames = fetchSeries(store, db, seriesInstanceUID, args.timeout)
+            if args.format == "nrrd":
+                path = os.path.join(outputDirectory, f"{seriesInstanceUID}.nrrd")
+                writeNRRD(path, *seriesVolume(store, db, frames))
+            else:
+                seriesDirectory = os.path.join(outputDirectory, seriesInstanceUID)
+                os.makedirs(seriesDirectory, exist_ok=True)
+                for sopInstanceUID, frameNumber, frame in frames:
+                    name = sopInstanceUID
+                    if numberOfFrames(db, sopInstanceUID) > 1:
+                        name += f"-{frameNumber}"
+                    np.save(os.path.join(seriesDirectory, f"{name}.npy"), frame)
+        except Exception as error:
+            logging.debug("fetch failed", exc_info=True)
+            progress.fail(seriesInstanceUID, error)
+            continue
+        frameBytes += sum([frame.nbytes for _, _, frame in frames])
+        progress.update(seriesInstanceUID, len(frames))
+    progress.finish()
+    for store in storesByScheme.values():
+        if hasattr(store, "shutdown"):
+            store.shutdown()
+    elapsed = time.time() - progress.startTime
+    if elapsed > 0:
+        print(f"{frameBytes / elapsed / 1e6:.1f} MB/s of pixel data")
+    if "http" in storesByScheme or "https" in storesByScheme:
+        printCacheReport(cache)
+    return progress.failureCount == 0
+
+
+def stats(args, db):
+    statistics = db.statistics()
+    if args.json:
+        print(json.dumps(statistics, indent=2))
+    else:
+        for key,value in statistics.items():
+            print(f"{key:>16}: {value}")
+    return True
+
+
+def exportSnapshot(args, db):
+    startTime = time.time()
+    manifest = ctkColumnarSnapshot(args.snapshot, args.format).export(db)
+    for databaseName in ["ctkDICOM", "ctkDICOMTagCache"]:
+        for table,rowCount in manifest[databaseName]["tables"].items():
+            print(f"{databaseName}/{table}: {rowCount} rows")
+    print(f"Exported in {time.time() - startTime:.1f}s")
+    return True
+
+
+def importSnapshot(args, db):
+    startTime = time.time()
+    ctkColumnarSnapshot(args.snapshot, args.format).load(
+            args.db, tagsToPrecache=db.tagsToPrecache)
+    print(f"Imported in {time.time() - startTime:.1f}s")
+    return True
+
+
+def argumentParser():
+    parser = argparse.ArgumentParser(prog="dicomlogic", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verbose", "-v", action="count", default=0)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    databaseParser = argparse.ArgumentParser(add_help=False)
+    databaseParser.add_argument("--db", required=True,
+                                help="directory for ctkDICOM.sql and ctkDICOMTagCache.sql")
+    databaseParser.add_argument("--precache-tag", action="append", default=[],
+                                help="tag to precache, as gggg,eeee (repeatable)")
+    databaseParser.add_argument("--precache-file",
+                                help="file listing tags to precache, one per line")
+    databaseParser.add_argument("--compact-tag-cache", action="store_true",
+                                help="create new tag caches in compact form")
+
+    networkParser = argparse.ArgumentParser(add_help=False)
+    networkParser.add_argument("--header", action="append", default=[],
+                               help="request header as 'Name: value' (repeatable)")
+    networkParser.add_argument("--token-command",
+                               help="command printing a bearer token, "
+                                    "e.g. 'gcloud auth print-access-token'")
+    networkParser.add_argument("--metadata-cache",
+                               help="directory keeping DICOMweb series metadata "
+                                    "across runs, default is to keep it in memory only")
+
+    jobParser = argparse.ArgumentParser(add_help=False)
+    jobParser.add_argument("--concurrency", type=int, default=4,
+                           help="number of concurrent metadata requests")
+    jobParser.add_argument("--page-size", type=int, default=100,
+                           help="number of results per search request")
+    jobParser.add_argument("--offset", type=int, default=0,
+                           help="index of the first search result to process")
+    jobParser.add_argument("--limit", type=int, default=None,
+                           help="maximum number of search results to process")
+    jobParser.add_argument("--incremental", action="store_true",
+                           help="skip items already in the database")
+    jobParser.add_argument("--resume",
+                           help="file recording completed items; "
+                                "items listed there are skipped")
+
+    indexParser = subparsers.add_parser("index", help="index metadata into the database")
+    indexSubparsers = indexParser.add_subparsers(dest="source", required=True)
+    dicomwebParser = indexSubparsers.add_parser(
+            "dicomweb", parents=[databaseParser, networkParser, jobParser],
+            help="index studies from a DICOMweb server")
+    dicomwebParser.add_argument("url", help="DICOMweb service root")
+    dicomwebParser.add_argument("--study", action="append", default=[],
+                                help="StudyInstanceUID to index (repeatable), "
+                                     "default is all studies")
+    dicomwebParser.add_argument("--minimal-metadata", action="store_true",
+                                help="index from QIDO-RS instance queries for only "
+                                     "the stored fields instead of the full metadata")
+    dicomwebParser.set_defaults(function=indexDICOMweb)
+    ahiParser = indexSubparsers.add_parser(
+            "ahi", parents=[databaseParser, jobParser],
+            help="index image sets from an AWS HealthImaging datastore")
+    ahiParser.add_argument("datastore_id")
+    ahiParser.add_argument("--image-set", action="append", default=[],
+                           help="image set id to index (repeatable), "
+                                "default is all image sets")
+    ahiParser.set_defaults(function=indexAHI)
+    filesParser = indexSubparsers.add_parser(
+            "files", parents=[databaseParser],
+            help="index DICOM files in local directories; "
+                 "files unchanged since the last run are skipped")
+    filesParser.add_argument("directory", nargs="+")
+    filesParser.add_argument("--workers", type=int, default=None,
+                             help="processes reading headers, 0 to read in this process, "
+                                  "default is one less than the number of processors")
+    filesParser.set_defaults(function=indexFiles)
+    dimseParser = indexSubparsers.add_parser(
+            "dimse", parents=[databaseParser, jobParser],
+            help="index studies from a PACS with C-FIND (requires pynetdicom)")
+    dimseParser.add_argument("host")
+    dimseParser.add_argument("port", type=int)
+    dimseParser.add_argument("--aet", default="ANY-SCP", help="called AE title")
+    dimseParser.add_argument("--calling-aet", default="DICOMLOGIC", help="calling AE title")
+    dimseParser.add_argument("--study", action="append", default=[],
+                             help="StudyInstanceUID to index (repeatable), "
+                                  "default is all studies")
+    dimseParser.set_defaults(function=indexDIMSE)
+
+    fetchParser = subparsers.add_parser(
+            "fetch", parents=[databaseParser, networkParser],
+            help="download the frames of indexed studies or series")
+    fetchParser.add_argument("--study", action="append", default=[])
+    fetchParser.add_argument("--series", action="append", default=[])
+    fetchParser.add_argument("--output",
+                             help="output directory, default is the frames "
+                                  "directory of the database")
+    fetchParser.add_argument("--format", choices=["npy", "nrrd"], default="npy",
+                             help="one npy file per frame or one nrrd per series")
+    fetchParser.add_argument("--timeout", type=float, default=600,
+                             help="seconds to wait for the frames of a series")
+    fetchParser.set_defaults(function=fetch)
+
+    statsParser = subparsers.add_parser("stats", parents=[databaseParser],
+                                        help="print database statistics")
+    statsParser.add_argument("--json", action="store_true")
+    statsParser.set_defaults(function=stats)
+
+    exportParser = subparsers.add_parser(
+            "export", parents=[databaseParser],
+            help="write a parquet or arrow snapshot of the database")
+    exportParser.add_argument("snapshot", help="snapshot directory")
+    exportParser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    exportParser.set_defaults(function=exportSnapshot)
+
+    importParser = subparsers.add_parser(
+            "import", parents=[databaseParser],
+            help="create a new database from a parquet or arrow snapshot")
+    importParser.add_argument("snapshot", help="snapshot directory")
+    importParser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    importParser.set_defaults(function=importSnapshot)
+    return parser
+
+
+def main(argv=None):
+    args = argumentParser().parse_args(argv)
+    level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)]
+    logging.basicConfig(level=level)
+    db = openDatabase(args)
+    return 0 if args.function(args, db) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,5 +19,5 @@ class DICOMDatabase:
         noCommaTag = DICOMDatabase.dicomTagNoComma(keyword)
         return f"{noCommaTag[0:4]},{noCommaTag[4:8]}"
 
-    def insert(self, ds : pydicom.Dataset, frameURL : str):
+    def insert(self, ds : pydicom.Dataset, frameURL : str, filename : str = ""):
         raise NotImplementedError("Method needs to be defined by subclass")
@@ -1,7 +1,9 @@
 from .DICOMDatabase import *
 from .ctkSQLite import *
+from .ctkColumnarSnapshot import *
 
 __all__ = [
         "DICOMDatabase",
-        "ctkSQLite"
+        "ctkSQLite",
+        "ctkColumnarSnapshot"
 ]
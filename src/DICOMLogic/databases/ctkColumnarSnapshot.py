@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import pydicom
+import sqlite3
+import tempfile
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ModuleNotFoundError:
+    pyarrow = None
+
+from DICOMLogic.databases.ctkSQLite import ctkSQLite
+
+class ctkColumnarSnapshot:
+    """
+    Columnar (Parquet or Arrow IPC stream) snapshot of a ctkSQLite database.
+
+    Every table of ctkDICOM.sql and ctkDICOMTagCache.sql is written
+    column by column with integer columns typed as int64 and text stored as
+    dictionary encoded strings, so a snapshot can be loaded back into a new
+    ctkSQLite database much faster than re-indexing from the network.
+
+    In addition, the entity-attribute-value TagCache is pivoted into a
+    wide TagValues table with one row per instance and one column per
+    cached tag (named by keyword), typed according to the tag's VR.
+    This is intended for analytics (e.g. every ManufacturerModelName
+    by SliceThickness) and is not used when loading.
+
+    Requires pyarrow.
+    """
+
+    ManifestFileName = "manifest.json"
+    WideTableName = "TagValues"
+    ChunkSize = 100000
+    Formats = {"parquet": ".parquet", "arrow": ".arrows"}
+
+    IntegerVRs = ("IS", "SL", "SS", "SV", "UL", "US", "UV")
+    FloatVRs = ("DS", "FD", "FL")
+
+    def __init__(self, directory, format="parquet"):
+        if pyarrow is None:
+            raise ModuleNotFoundError("ctkColumnarSnapshot requires pyarrow")
+        if format not in ctkColumnarSnapshot.Formats:
+            raise ValueError(f"Unknown snapshot format {format}")
+        self.directory = directory
+        self.format = format
+
+    def tablePath(self, databaseName, tableName):
+        extension = ctkColumnarSnapshot.Formats[self.format]
+        return os.path.join(self.directory, databaseName, tableName + extension)
+
+    #
+    # writing
+    #
+
+    def writeBatches(self, path, schema, batches):
+        """
+        Write record batches one at a time to a parquet or arrow file,
+        returning row count.  Arrow is written in the IPC stream format,
+        which (unlike the IPC file format) lets each batch carry its
+        own dictionaries, so the table is never held in memory.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rowCount = 0
+        if self.format == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(path, schema, compression="zstd")
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression="zstd")
+            writer = pyarrow.ipc.new_stream(path, schema, options=options)
+        with writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rowCount += batch.num_rows
+        return rowCount
+
+    @staticmethod
+    def columnArray(values, columnType):
+        if pyarrow.types.is_dictionary(columnType):
+            return pyarrow.array(values, type=pyarrow.string()).dictionary_encode()
+        return pyarrow.array(values, type=columnType)
+
+    def tableSchema(self, connection, schemaName, tableName):
+        """
+        Column types are int64 or float64 when every stored value has that
+        storage class, otherwise dictionary encoded strings, so that values
+        round trip exactly.
+        """
+        fields = []
+        columns = connection.execute(
+                f"PRAGMA {schemaName}.table_info('{tableName}')").fetchall()
+        for column in columns:
+            name = column[1]
+            storageTypes = set([row[0] for row in connection.execute(
+                    f"SELECT DISTINCT typeof(\"{name}\") FROM {schemaName}.\"{tableName}\"")])
+            storageTypes.discard("null")
+            if storageTypes == {"integer"}:
+                columnType = pyarrow.int64()
+            elif storageTypes and storageTypes <= {"integer", "real"}:
+                columnType = pyarrow.float64()
+            else:
+                columnType = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+            fields.append(pyarrow.field(name, columnType))
+        return pyarrow.schema(fields)
+
+    def tableBatches(self, connection, schemaName, tableName, schema):
+        cursor = connection.execute(f"SELECT * FROM {schemaName}.\"{tableName}\"")
+        while True:
+            rows = cursor.fetchmany(ctkColumnarSnapshot.ChunkSize)
+            if not rows:
+                break
+            arrays = []
+            for index,field in enumerate(schema):
+                values = [row[index] for row in rows]
+                if pyarrow.types.is_dictionary(field.type):
+                    values = [None if value is None else str(value) for value in values]
+                arrays.append(ctkColumnarSnapshot.columnArray(values, field.type))
+            yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    @staticmethod
+    def tagColumn(tag):
+        """Returns (column name, arrow type, value parser) for a "gggg,eeee" tag"""
+        try:
+            tagValue = int(tag.replace(",", ""), 16)
+            keyword = pydicom.datadict.keyword_for_tag(tagValue)
+            vr = pydicom.datadict.dictionary_VR(tagValue)
+            vm = pydicom.datadict.dictionary_VM(tagValue)
+        except (KeyError, ValueError):
+            keyword, vr, vm = None, None, None
+        name = keyword if keyword else tag
+        if vm == "1" and vr in ctkColumnarSnapshot.IntegerVRs:
+            return name, pyarrow.int64(), int
+        if vm == "1" and vr in ctkColumnarSnapshot.FloatVRs:
+            return name, pyarrow.float64(), float
+        return name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()), str
+
+    def wideBatches(self, connection, tags, schema, parsers):
+        flags = (ctkSQLite.TagNotInInstance, ctkSQLite.ValueIsNotStored)
+        columns = ", ".join(["MAX(CASE WHEN Tag = ? THEN Value END)" for tag in tags])
+        cursor = connection.execute(f"""
+            SELECT SOPInstanceUID, {columns} FROM tagcache.TagCache GROUP BY SOPInstanceUID
+        """, tags)
+        while True:
+            rows = cursor.fetchmany(ctkColumnarSnapshot.ChunkSize)
+            if not rows:
+                break
+            arrays = [pyarrow.array([row[0] for row in rows], type=pyarrow.string())]
+            for index,parser in enumerate(parsers):
+                values = []
+                for row in rows:
+                    value = row[index+1]
+                    if value is None or value in flags:
+                        values.append(None)
+                    elif value == ctkSQLite.ValueIsEmptyString:
+                        values.append("" if parser is str else None)
+                    else:
+                        try:
+                            values.append(parser(value))
+                        except ValueError:
+                            values.append(None)
+                arrays.append(ctkColumnarSnapshot.columnArray(values, schema[index+1].type))
+            yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def exportDatabase(self, connection, schemaName, databaseName, manifest):
+        schemaRows = connection.execute(f"""
+            SELECT type, name, sql FROM {schemaName}.sqlite_master
+            WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            ORDER BY rowid
+        """).fetchall()
+        databaseManifest = {"schema": [row[2] for row in schemaRows],
+                            "tables": {}}
+        for objectType, name, _ in schemaRows:
+            if objectType != "table":
+                continue
+            schema = self.tableSchema(connection, schemaName, name)
+            rowCount = self.writeBatches(self.tablePath(databaseName, name), schema,
+                                         self.tableBatches(connection, schemaName, name, schema))
+            databaseManifest["tables"][name] = rowCount
+        manifest[databaseName] = databaseManifest
+
+    def exportWideTable(self, connection, manifest):
+        try:
+            tags = [row[0] for row in connection.execute(
+                        "SELECT DISTINCT Tag FROM tagcache.TagCache ORDER BY Tag")]
+        except sqlite3.OperationalError:
+            tags = []
+        if not tags:
+            logging.warning("TagCache is empty, no wide table written")
+            return
+        fields = [pyarrow.field("SOPInstanceUID", pyarrow.string())]
+        parsers = []
+        tagsByColumn = {}
+        for tag in tags:
+            name, columnType, parser = ctkColumnarSnapshot.tagColumn(tag)
+            if name in tagsByColumn or name == "SOPInstanceUID":
+                name = tag
+            fields.append(pyarrow.field(name, columnType))
+            parsers.append(parser)
+            tagsByColumn[name] = tag
+        schema = pyarrow.schema(fields)
+        extension = ctkColumnarSnapshot.Formats[self.format]
+        path = os.path.join(self.directory, ctkColumnarSnapshot.WideTableName + extension)
+        rowCount = self.writeBatches(path, schema,
+                                     self.wideBatches(connection, tags, schema, parsers))
+        manifest[ctkColumnarSnapshot.WideTableName] = {"rows": rowCount,
+                                                       "tagsByColumn": tagsByColumn}
+
+    def export(self, db):
+        """
+        Write the snapshot of the ctkSQLite database db.  A consistent copy
+        of both databases is taken first with db.snapshot, which batches
+        wait for only briefly, and the snapshot is written from the copy
+        without holding any lock on db.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = {"format": self.format,
+                    "schemaVersion": ctkSQLite.SchemaVersion}
+        with tempfile.TemporaryDirectory(dir=self.directory) as copyDirectory:
+            db.snapshot(copyDirectory)
+            connection = sqlite3.connect(os.path.join(copyDirectory, ctkSQLite.DatabaseFileName))
+            try:
+                connection.execute("ATTACH DATABASE ? AS tagcache",
+                                   (os.path.join(copyDirectory, ctkSQLite.TagCacheDatabaseFileName),))
+                self.exportDatabase(connection, "main", "ctkDICOM", manifest)
+                self.exportDatabase(connection, "tagcache", "ctkDICOMTagCache", manifest)
+                self.exportWideTable(connection, manifest)
+            finally:
+                connection.close()
+        with open(os.path.join(self.directory, ctkColumnarSnapshot.ManifestFileName), "w") as fp:
+            json.dump(manifest, fp, indent=2)
+        return manifest
+
+    #
+    # reading
+    #
+
+    @staticmethod
+    def columnValues(array):
+        """
+        Returns the values of the array as a list, decoding dictionary
+        arrays through their dictionary, which is much faster than
+        converting each value
+        """
+        if not pyarrow.types.is_dictionary(array.type):
+            return array.to_pylist()
+        dictionary = array.dictionary.to_pylist()
+        if array.null_count:
+            return [None if index is None else dictionary[index]
+                    for index in array.indices.to_pylist()]
+        return [dictionary[index] for index in array.indices.to_pylist()]
+
+    def readBatches(self, path):
+        if self.format == "parquet":
+            parquetFile = pyarrow.parquet.ParquetFile(path)
+            for batch in parquetFile.iter_batches(batch_size=ctkColumnarSnapshot.ChunkSize):
+                yield batch
+        else:
+            with pyarrow.ipc.open_stream(path) as reader:
+                for batch in reader:
+                    yield batch
+
+    def loadDatabase(self, databaseFilePath, databaseName, manifest):
+        if os.path.exists(databaseFilePath):
+            raise FileExistsError(f"Will not overwrite {databaseFilePath}")
+        temporaryFilePath = databaseFilePath + ".loading"
+        if os.path.exists(temporaryFilePath):
+            os.remove(temporaryFilePath)
+        connection = sqlite3.connect(temporaryFilePath)
+        try:
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            databaseManifest = manifest[databaseName]
+            # indexes, views and triggers are created after the rows are
+            # inserted, which is faster than updating indexes row by row
+            tableStatements = []
+            otherStatements = []
+            for statement in databaseManifest["schema"]:
+                if statement.lstrip().upper().startswith("CREATE TABLE"):
+                    tableStatements.append(statement)
+                else:
+                    otherStatements.append(statement)
+            for statement in tableStatements:
+                connection.execute(statement)
+            for tableName in databaseManifest["tables"]:
+                path = self.tablePath(databaseName, tableName)
+                for batch in self.readBatches(path):
+                    columns = batch.schema.names
+                    columnList = ", ".join([f'"{name}"' for name in columns])
+                    placeholders = ", ".join(["?"] * len(columns))
+                    connection.executemany(f"""
+                        INSERT INTO "{tableName}" ({columnList}) VALUES ({placeholders})
+                    """, zip(*[ctkColumnarSnapshot.columnValues(array) for array in batch.columns]))
+            for statement in otherStatements:
+                connection.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temporaryFilePath, databaseFilePath)
+
+    def load(self, dbDirectory, **kwargs):
+        """
+        Create a new ctkSQLite database in dbDirectory from the snapshot.
+        Extra keyword arguments are passed to the ctkSQLite constructor.
+        """
+        with open(os.path.join(self.directory, ctkColumnarSnapshot.ManifestFileName)) as fp:
+            manifest = json.load(fp)
+        if manifest["schemaVersion"] != ctkSQLite.SchemaVersion:
+            logging.warning(f"Snapshot schema version {manifest['schemaVersion']} "
+                            f"differs from {ctkSQLite.SchemaVersion}")
+        os.makedirs(dbDirectory, exist_ok=True)
+        db = ctkSQLite(dbDirectory, **kwargs)
+        self.loadDatabase(db.databaseFilePath, "ctkDICOM", manifest)
+        self.loadDatabase(db.tagCacheFilePath, "ctkDICOMTagCache", manifest)
+        return db
@@ -1,13 +1,18 @@
+import contextlib
 import datetime
 import json
 import logging
 import numpy
 import os
+import pathlib
 import pydicom
 import random
 import requests
 import sqlite3
+import threading
 import time
+import types
+import uuid
 
 from DICOMLogic.databases.DICOMDatabase import DICOMDatabase
 
@@ -24,6 +29,14 @@ class ctkSQLite(DICOMDatabase):
     the ctkDICOMDatabase schemas that are hard-coded with the ctkDICOM
     library.  These need to be kept in sync manually to ensure
     compatibility.
+
+    With inMemory, both databases are kept in memory (as shared-cache
+    in-memory databases, so every connection of this instance sees the
+    same data) and nothing is written to dbDirectory, which may be None.
+    They last as long as this instance.  SQLite does not wait for locks
+    between connections to in-memory databases, so batches and queries
+    take turns with a lock instead.  snapshot(directory) writes a
+    consistent copy to disk and load(directory) reads one into memory.
     """
 
     #SchemaURL = "https://raw.githubusercontent.com/commontk/CTK/master/Libs/DICOM/Core/Resources/dicom-schema.sql"
@@ -54,30 +67,231 @@ class ctkSQLite(DICOMDatabase):
                     "SeriesInstanceUID", "ContentDate",
                     "Manufacturer", "PatientPosition"]
 
+    # tags cached for every instance in addition to tagsToPrecache
+    ExtraKeys = ["StudyInstanceUID", "BitsAllocated", "BitsStored",
+                 "PixelRepresentation", "WindowCenter", "WindowWidth",
+                 "RescaleIntercept", "RescaleSlope", "ContentDate",
+                 "Manufacturer", "PatientPosition",
+                 "Rows", "Columns", "InstanceNumber", "SamplesPerPixel",
+                 "NumberOfFrames"]
+
+    # seconds to wait for a lock held by another connection and number
+    # of times to retry starting or committing a batch after that
+    BusyTimeout = 30
+    LockRetries = 5
+
+    # display fields filled in at the end of each batch for the rows it
+    # touched: table -> (key column, {column: SQL expression for the row}).
+    # Columns missing from the schema are skipped.  Size and frames come
+    # from the Rows (0028,0010), Columns (0028,0011) and NumberOfFrames
+    # (0028,0008) cached for the series' instances, skipping flag values.
+    DisplayedFieldExpressions = {
+        "Series": ("SeriesInstanceUID", {
+            "DisplayedCount": """(SELECT COUNT(*) FROM Images
+                                   WHERE Images.SeriesInstanceUID = Series.SeriesInstanceUID)""",
+            "DisplayedSize": """(SELECT ColumnsValue.Value || 'x' || RowsValue.Value FROM Images
+                                  JOIN tagcache.TagCache AS RowsValue
+                                    ON RowsValue.SOPInstanceUID = Images.SOPInstanceUID
+                                   AND RowsValue.Tag = '0028,0010'
+                                  JOIN tagcache.TagCache AS ColumnsValue
+                                    ON ColumnsValue.SOPInstanceUID = Images.SOPInstanceUID
+                                   AND ColumnsValue.Tag = '0028,0011'
+                                 WHERE Images.SeriesInstanceUID = Series.SeriesInstanceUID
+                                   AND RowsValue.Value GLOB '[0-9]*'
+                                   AND ColumnsValue.Value GLOB '[0-9]*'
+                                 LIMIT 1)""",
+            "DisplayedNumberOfFrames": """(SELECT COALESCE(MAX(CAST(FramesValue.Value AS INTEGER)), 1)
+                                             FROM Images
+                                             JOIN tagcache.TagCache AS FramesValue
+                                               ON FramesValue.SOPInstanceUID = Images.SOPInstanceUID
+                                              AND FramesValue.Tag = '0028,0008'
+                                            WHERE Images.SeriesInstanceUID = Series.SeriesInstanceUID
+                                              AND FramesValue.Value GLOB '[0-9]*')""",
+        }),
+        "Studies": ("StudyInstanceUID", {
+            "DisplayedNumberOfSeries": """(SELECT COUNT(*) FROM Series
+                                            WHERE Series.StudyInstanceUID = Studies.StudyInstanceUID)""",
+        }),
+        "Patients": ("UID", {
+            "DisplayedNumberOfStudies": """(SELECT COUNT(*) FROM Studies
+                                             WHERE Studies.PatientsUID = Patients.UID)""",
+            "DisplayedPatientsName": "displayedPatientName(COALESCE(PatientsName, ''))",
+        }),
+    }
+
+    # indexes that keep the display field counts proportional to the batch
+    IndexSchema = """
+        CREATE INDEX IF NOT EXISTS ImagesSeriesIndex ON Images (SeriesInstanceUID);
+        CREATE INDEX IF NOT EXISTS SeriesStudyIndex ON Series (StudyInstanceUID);
+        CREATE INDEX IF NOT EXISTS StudiesPatientIndex ON Studies (PatientsUID);
+    """
+
     DatabaseFileName = "ctkDICOM.sql"
     TagCacheDatabaseFileName = "ctkDICOMTagCache.sql"
+    MemoryDatabaseURI = "file:{name}-{id}?mode=memory&cache=shared"
+
+    # Compact tag cache storage: tags, values, series and instances are
+    # interned into integer ids and values that are constant over all
+    # instances of a series are stored once for the series.  The TagCache
+    # view (with insert and delete triggers) keeps the ctkDICOMDatabase
+    # (SOPInstanceUID, Tag, Value) interface working.
+    CompactTagCacheSchema = """
+        CREATE TABLE TagCacheTags (TagID INTEGER PRIMARY KEY, Tag TEXT UNIQUE NOT NULL);
+        CREATE TABLE TagCacheValues (ValueID INTEGER PRIMARY KEY, Value TEXT UNIQUE NOT NULL);
+        CREATE TABLE TagCacheSeries (SeriesID INTEGER PRIMARY KEY,
+                                     SeriesInstanceUID TEXT UNIQUE NOT NULL);
+        CREATE TABLE TagCacheInstances (InstanceID INTEGER PRIMARY KEY,
+                                        SOPInstanceUID TEXT UNIQUE NOT NULL,
+                                        SeriesID INTEGER);
+        CREATE INDEX TagCacheInstancesSeries ON TagCacheInstances (SeriesID);
+        CREATE TABLE TagCacheInstanceValues (InstanceID INTEGER, TagID INTEGER, ValueID INTEGER,
+                                             PRIMARY KEY (InstanceID, TagID)) WITHOUT ROWID;
+        CREATE TABLE TagCacheSeriesValues (SeriesID INTEGER, TagID INTEGER, ValueID INTEGER,
+                                           PRIMARY KEY (SeriesID, TagID)) WITHOUT ROWID;
+        CREATE VIEW TagCache (SOPInstanceUID, Tag, Value) AS
+            SELECT i.SOPInstanceUID, t.Tag, v.Value
+              FROM TagCacheInstanceValues iv
+              JOIN TagCacheInstances i ON i.InstanceID = iv.InstanceID
+              JOIN TagCacheTags t ON t.TagID = iv.TagID
+              JOIN TagCacheValues v ON v.ValueID = iv.ValueID
+            UNION ALL
+            SELECT i.SOPInstanceUID, t.Tag, v.Value
+              FROM TagCacheInstances i
+              JOIN TagCacheSeriesValues sv ON sv.SeriesID = i.SeriesID
+              JOIN TagCacheTags t ON t.TagID = sv.TagID
+              JOIN TagCacheValues v ON v.ValueID = sv.ValueID
+             WHERE NOT EXISTS (SELECT 1 FROM TagCacheInstanceValues iv
+                                WHERE iv.InstanceID = i.InstanceID AND iv.TagID = sv.TagID);
+        CREATE TRIGGER TagCacheInsert INSTEAD OF INSERT ON TagCache
+        BEGIN
+            INSERT INTO TagCacheTags (Tag) SELECT NEW.Tag
+                WHERE NOT EXISTS (SELECT 1 FROM TagCacheTags WHERE Tag = NEW.Tag);
+            INSERT INTO TagCacheValues (Value) SELECT NEW.Value
+                WHERE NOT EXISTS (SELECT 1 FROM TagCacheValues WHERE Value = NEW.Value);
+            INSERT INTO TagCacheInstances (SOPInstanceUID) SELECT NEW.SOPInstanceUID
+                WHERE NOT EXISTS (SELECT 1 FROM TagCacheInstances
+                                   WHERE SOPInstanceUID = NEW.SOPInstanceUID);
+            INSERT OR REPLACE INTO TagCacheInstanceValues VALUES (
+                (SELECT InstanceID FROM TagCacheInstances WHERE SOPInstanceUID = NEW.SOPInstanceUID),
+                (SELECT TagID FROM TagCacheTags WHERE Tag = NEW.Tag),
+                (SELECT ValueID FROM TagCacheValues WHERE Value = NEW.Value));
+        END;
+        CREATE TRIGGER TagCacheDelete INSTEAD OF DELETE ON TagCache
+        BEGIN
+            DELETE FROM TagCacheInstanceValues
+             WHERE InstanceID = (SELECT InstanceID FROM TagCacheInstances
+                                  WHERE SOPInstanceUID = OLD.SOPInstanceUID)
+               AND TagID = (SELECT TagID FROM TagCacheTags WHERE Tag = OLD.Tag);
+            -- series values are shared, so copy the remaining ones to the
+            -- instance before detaching it from its series
+            INSERT OR IGNORE INTO TagCacheInstanceValues
+                SELECT i.InstanceID, sv.TagID, sv.ValueID
+                  FROM TagCacheInstances i
+                  JOIN TagCacheSeriesValues sv ON sv.SeriesID = i.SeriesID
+                 WHERE i.SOPInstanceUID = OLD.SOPInstanceUID
+                   AND sv.TagID <> (SELECT TagID FROM TagCacheTags WHERE Tag = OLD.Tag);
+            UPDATE TagCacheInstances SET SeriesID = NULL
+             WHERE SOPInstanceUID = OLD.SOPInstanceUID;
+        END;
+    """
 
     def __init__(self, dbDirectory,
                  tagsToPrecache = (),
-                 tagsToExcludeFromStorage = ()):
+                 tagsToExcludeFromStorage = (),
+                 compactTagCache = False,
+                 inMemory = False):
         self.dbDirectory = dbDirectory
-        self.databaseFilePath = os.path.join(self.dbDirectory,
-                                             ctkSQLite.DatabaseFileName)
-        self.tagCacheFilePath = os.path.join(self.dbDirectory,
-                                             ctkSQLite.TagCacheDatabaseFileName)
+        self.inMemory = inMemory
+        self.memoryAnchors = []
+        self.memoryLock = threading.RLock()
+        if inMemory:
+            memoryID = uuid.uuid4().hex
+            self.databaseFilePath = ctkSQLite.MemoryDatabaseURI.format(name="ctkDICOM", id=memoryID)
+            self.tagCacheFilePath = ctkSQLite.MemoryDatabaseURI.format(name="ctkDICOMTagCache",
+                                                                       id=memoryID)
+            # an in-memory database is freed when its last connection closes
+            self.memoryAnchors = [self.sqliteConnection(path)
+                                  for path in (self.databaseFilePath, self.tagCacheFilePath)]
+        else:
+            self.databaseFilePath = os.path.join(self.dbDirectory,
+                                                 ctkSQLite.DatabaseFileName)
+            self.tagCacheFilePath = os.path.join(self.dbDirectory,
+                                                 ctkSQLite.TagCacheDatabaseFileName)
         self.tagsToPrecache = tagsToPrecache
         self.tagsToExcludeFromStorage = tagsToExcludeFromStorage
+        self.compactTagCache = compactTagCache
+        self.tagCacheIsCompact = False
         self.databaseInitialized = False
-        self.dbConnection = None
-        self.dbCursor = None
-        self.patientsThisBatch = {}
-        self.studiesThisBatch = []
-        self.seriesThisBatch = []
+        self.displayedFieldColumns = {}
+        self.tagCacheInitialized = False
+        self.initializationLock = threading.Lock()
+        # batches used by startBatchInsert/insert/endBatchInsert
+        self.threadBatches = threading.local()
+        # each thread's query connections, reopened when readGeneration changes
+        self.readConnections = threading.local()
+        self.readGeneration = 0
+        self.compileTagPlan()
+
+    def __getstate__(self):
+        """
+        Copies sent to worker processes leave out the locks, batches and
+        connections (so in those copies in-memory databases are empty)
+        """
+        state = dict(self.__dict__)
+        del state["initializationLock"]
+        del state["threadBatches"]
+        del state["readConnections"]
+        del state["memoryAnchors"]
+        del state["memoryLock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.initializationLock = threading.Lock()
+        self.threadBatches = threading.local()
+        self.readConnections = threading.local()
+        self.memoryAnchors = []
+        self.memoryLock = threading.RLock()
+
+    def exclusiveAccess(self):
+        """Context for using in-memory databases (nothing needed for files)"""
+        return self.memoryLock if self.inMemory else contextlib.nullcontext()
+
+    @staticmethod
+    def sqliteConnection(path, **kwargs):
+        """Connect to a database file or an in-memory database URI"""
+        return sqlite3.connect(path, uri=path.startswith("file:"), **kwargs)
+
+    def compileTagPlan(self):
+        """
+        Resolve the tags used by insert once rather than per instance:
+        requiredTagPlan is a list of (keyword, tag) and tagCachePlan is a list
+        of (TagCache tag string, tag, excluded from storage) where tag is
+        a pydicom BaseTag for direct dataset lookup.
+        """
+        self.requiredTagPlan = []
+        for keyword in dict.fromkeys(ctkSQLite.RequiredTags):
+            tag = pydicom.tag.Tag(pydicom.datadict.tag_for_keyword(keyword))
+            self.requiredTagPlan.append((keyword, tag))
+        extraTags = [DICOMDatabase.dicomTagWithComma(k) for k in ctkSQLite.ExtraKeys]
+        excludedTags = set([tag.upper() for tag in self.tagsToExcludeFromStorage])
+        self.tagCachePlan = []
+        for cacheTag in dict.fromkeys([tag.upper() for tag in self.tagsToPrecache] + extraTags):
+            tag = pydicom.tag.Tag(int(cacheTag.replace(',', ''), 16))
+            self.tagCachePlan.append((cacheTag, tag, cacheTag in excludedTags))
+        self.cachedTags = set([cacheTag for cacheTag, _, _ in self.tagCachePlan])
 
     def initializeDatabase(self):
-        if self.databaseInitialized:
-            return True
-        dbConnection  = sqlite3.connect(self.databaseFilePath)
+        with self.initializationLock, self.exclusiveAccess():
+            if not self.databaseInitialized:
+                self.databaseInitialized = self.initializeDatabaseSchema()
+                if self.databaseInitialized:
+                    self.initializeDisplayedFields()
+        return self.databaseInitialized
+
+    def initializeDatabaseSchema(self):
+        dbConnection  = ctkSQLite.sqliteConnection(self.databaseFilePath,
+                                                   timeout=ctkSQLite.BusyTimeout)
         cursor = dbConnection.cursor()
         # populate the schema if needed
         try:
@@ -95,9 +309,43 @@ class ctkSQLite(DICOMDatabase):
             schema = schemaResponse.content.decode()
             cursor.executescript(schema)
             dbConnection.commit()
-        self.databaseInitialized = True
+        finally:
+            dbConnection.close()
         return True
 
+    def initializeDisplayedFields(self):
+        """Find which display field columns the schema has and index their counts"""
+        connection = ctkSQLite.sqliteConnection(self.databaseFilePath,
+                                                timeout=ctkSQLite.BusyTimeout)
+        try:
+            connection.executescript(ctkSQLite.IndexSchema)
+            for table in ("Patients", "Studies", "Series", "Images"):
+                columns = connection.execute(f"PRAGMA table_info('{table}')").fetchall()
+                self.displayedFieldColumns[table] = set([column[1] for column in columns])
+        finally:
+            connection.close()
+
+    @staticmethod
+    def displayedPatientName(patientName):
+        """
+        Formats a DICOM person name as "Last, First Middle, Suffix (Prefix)"
+        like ctkDICOMDisplayedFieldGeneratorDefaultRule::humanReadablePatientName
+        """
+        components = [component.strip() for component in str(patientName).split("=")[0].split("^")]
+        last, first, middle, prefix, suffix = (components + [""] * 5)[:5]
+        name = last
+        if last and (first or middle):
+            name += ","
+        if first:
+            name += " " + first
+        if middle:
+            name += " " + middle
+        if suffix:
+            name += ", " + suffix
+        if prefix:
+            name += " (" + prefix + ")"
+        return name
+
     #staticmethod
     def uidsForDataset(ds):
         """
@@ -109,7 +357,7 @@ class ctkSQLite(DICOMDatabase):
         """
         if ds.PatientID == "" and ds.StudyInstanceUID != "":
             msg = f"Patient ID is empty, using studyInstanceUID"
-            msg += f"{ds.studyInstanceUID} (%1) as patient ID"
+            msg += f"{ds.StudyInstanceUID} as patient ID"
             logging.warn(msg)
             ds.PatientID = ds.StudyInstanceUID
         if ds.PatientName == "" and ds.PatientID != "":
@@ -140,64 +388,578 @@ class ctkSQLite(DICOMDatabase):
         return [str(value) for value in values]
 
 
+    def initializeTagCache(self):
+        """
+        Create the TagCache if needed, as a table or in compact form.
+        An existing tag cache is used in whatever form it was created.
+        """
+        with self.initializationLock, self.exclusiveAccess():
+            if self.tagCacheInitialized:
+                return
+            connection = ctkSQLite.sqliteConnection(self.tagCacheFilePath,
+                                                    timeout=ctkSQLite.BusyTimeout)
+            try:
+                cursor = connection.cursor()
+                cursor.execute("""
+                    SELECT type FROM sqlite_master WHERE name = 'TagCache'
+                """)
+                result = cursor.fetchone()
+                if result is None:
+                    logging.warn("Initializing TagCache")
+                    if self.compactTagCache:
+                        cursor.executescript(ctkSQLite.CompactTagCacheSchema)
+                    else:
+                        statement = "CREATE TABLE TagCache (SOPInstanceUID, Tag, Value, PRIMARY KEY (SOPInstanceUID, Tag))"
+                        cursor.execute(statement)
+                    connection.commit()
+                    self.tagCacheIsCompact = self.compactTagCache
+                else:
+                    self.tagCacheIsCompact = result[0] == "view"
+                    if self.compactTagCache and not self.tagCacheIsCompact:
+                        logging.warning("Existing TagCache is not compact, using it as is")
+            finally:
+                connection.close()
+            self.tagCacheInitialized = True
+
+    def connect(self):
+        """
+        Returns a new connection to the database with the tag cache
+        attached as "tagcache", so that one transaction covers both.
+        The connection is in autocommit mode; transactions are explicit.
+        displayedPatientName is available as an SQL function.
+        """
+        connection = ctkSQLite.sqliteConnection(self.databaseFilePath,
+                                                timeout=ctkSQLite.BusyTimeout,
+                                                isolation_level=None)
+        connection.execute("ATTACH DATABASE ? AS tagcache", [self.tagCacheFilePath])
+        connection.create_function("displayedPatientName", 1,
+                                   ctkSQLite.displayedPatientName, deterministic=True)
+        return connection
+
+    def batch(self):
+        """
+        Returns a context manager for inserting in one transaction:
+
+            with db.batch() as batch:
+                batch.insert(ds, frameURL)
+
+        The batch commits both the database and the tag cache atomically
+        when the block exits normally, rolls back if it raises, and always
+        closes its connection.  Each batch has its own connection and state,
+        so batches can be used concurrently from different threads.
+        """
+        return ctkSQLiteBatch(self)
+
     def startBatchInsert(self):
-        self.dbConnection  = sqlite3.connect(self.databaseFilePath)
-        self.cursor = self.dbConnection.cursor()
-        self.dbTagCacheConnection  = sqlite3.connect(self.tagCacheFilePath)
-        self.cursorTagCache = self.dbTagCacheConnection.cursor()
+        """Start a batch for insert calls made from the current thread"""
+        batch = self.batch()
+        batch.__enter__()
+        self.threadBatches.batch = batch
 
     def endBatchInsert(self):
-        self.dbConnection.commit()
-        self.dbTagCacheConnection.commit()
+        """Commit and close the current thread's batch"""
+        batch = self.threadBatches.batch
+        self.threadBatches.batch = None
+        batch.__exit__(None, None, None)
+
+    def datasetValues(self, ds):
+        """
+        Returns a namespace with the value of each of the RequiredTags,
+        using the empty string for tags not in the dataset.
+        """
+        values = types.SimpleNamespace()
+        for keyword, tag in self.requiredTagPlan:
+            element = ds.get(tag)
+            setattr(values, keyword, "" if element is None else element.value)
+        return values
+
+    def tagCacheValues(self, ds, sopInstanceUID, cacheAbsentTags=True):
+        """
+        Returns the (SOPInstanceUID, Tag, Value) TagCache rows for the dataset.
+        Without cacheAbsentTags, tags not in the dataset are left out rather
+        than cached as TagNotInInstance, for datasets (like QIDO-RS results)
+        that may hold only some of the instance's tags.
+        """
+        cacheTagValues = []
+        for cacheTag, tag, excluded in self.tagCachePlan:
+            if excluded:
+                value = ctkSQLite.ValueIsNotStored
+            else:
+                element = ds.get(tag)
+                if element is None:
+                    if not cacheAbsentTags:
+                        continue
+                    value = ctkSQLite.TagNotInInstance
+                else:
+                    value = element._value
+                    if value == "":
+                        value = ctkSQLite.ValueIsEmptyString
+                    elif element.VM > 1 and element.VR != 'SQ':
+                        value = "\\".join(map(str, list(value)))
+            cacheTagValues.append((sopInstanceUID, cacheTag, str(value)))
+        return cacheTagValues
+
+    def insert(self, ds, frameURL, filename="", cacheAbsentTags=True):
+        """
+        Insert dataset into database using the batch started
+        by startBatchInsert in the current thread.
+
+        Returns True if insert completed
+        """
+        batch = getattr(self.threadBatches, "batch", None)
+        if batch is None:
+            raise RuntimeError("insert called without startBatchInsert")
+        return batch.insert(ds, frameURL, filename, cacheAbsentTags)
+
+    #
+    # query api, modeled after the corresponding ctkDICOMDatabase methods
+    #
+
+    def readConnection(self, databaseFilePath):
+        """
+        Returns the current thread's connection for queries of the
+        database, opened when first needed, or None if the file does
+        not exist yet
+        """
+        local = self.readConnections
+        if getattr(local, "generation", None) != self.readGeneration:
+            for connection in getattr(local, "connections", {}).values():
+                connection.close()
+            local.connections = {}
+            local.generation = self.readGeneration
+        connection = local.connections.get(databaseFilePath)
+        if connection is None:
+            if not self.inMemory and not os.path.exists(databaseFilePath):
+                return None
+            connection = ctkSQLite.sqliteConnection(databaseFilePath,
+                                                    timeout=ctkSQLite.BusyTimeout)
+            local.connections[databaseFilePath] = connection
+        return connection
+
+    def query(self, databaseFilePath, statement, parameters=()):
+        """Run a read-only statement and return all result rows"""
+        with self.exclusiveAccess():
+            connection = self.readConnection(databaseFilePath)
+            if connection is None:
+                return []
+            try:
+                return connection.execute(statement, parameters).fetchall()
+            except sqlite3.OperationalError as error:
+                logging.debug(f"query failed: {error}")
+                return []
+
+    def patients(self):
+        rows = self.query(self.databaseFilePath, "SELECT UID FROM Patients")
+        return [row[0] for row in rows]
+
+    def studies(self):
+        rows = self.query(self.databaseFilePath,
+                          "SELECT StudyInstanceUID FROM Studies")
+        return [row[0] for row in rows]
+
+    def studiesForPatient(self, patientUID):
+        rows = self.query(self.databaseFilePath, """
+            SELECT StudyInstanceUID FROM Studies WHERE PatientsUID = ?
+        """, [str(patientUID)])
+        return [row[0] for row in rows]
+
+    def seriesForStudy(self, studyInstanceUID):
+        rows = self.query(self.databaseFilePath, """
+            SELECT SeriesInstanceUID FROM Series WHERE StudyInstanceUID = ?
+        """, [studyInstanceUID])
+        return [row[0] for row in rows]
+
+    def instancesForSeries(self, seriesInstanceUID):
+        rows = self.query(self.databaseFilePath, """
+            SELECT SOPInstanceUID FROM Images WHERE SeriesInstanceUID = ?
+        """, [seriesInstanceUID])
+        return [row[0] for row in rows]
+
+    def urlForInstance(self, sopInstanceUID):
+        rows = self.query(self.databaseFilePath, """
+            SELECT URL FROM Images WHERE SOPInstanceUID = ?
+        """, [sopInstanceUID])
+        return rows[0][0] if rows else None
+
+    def urlsForSeries(self, seriesInstanceUID):
+        """Returns a dictionary of frame URLs by SOPInstanceUID"""
+        rows = self.query(self.databaseFilePath, """
+            SELECT SOPInstanceUID, URL FROM Images WHERE SeriesInstanceUID = ?
+        """, [seriesInstanceUID])
+        return dict(rows)
+
+    def instanceValue(self, sopInstanceUID, tag):
+        """
+        Returns the raw TagCache string for the tag (in "gggg,eeee" form),
+        which may be one of the flag values like TagNotInInstance,
+        or None if the tag is not cached for the instance.
+        """
+        rows = self.query(self.tagCacheFilePath, """
+            SELECT Value FROM TagCache WHERE SOPInstanceUID = ? AND Tag = ?
+        """, [sopInstanceUID, tag.upper()])
+        return rows[0][0] if rows else None
+
+    def instanceValues(self, sopInstanceUID, tags):
+        """
+        Like instanceValue for several tags with one query.  Returns
+        a dictionary by tag of the values cached for the instance.
+        """
+        tags = [tag.upper() for tag in tags]
+        placeholders = ", ".join(["?"] * len(tags))
+        rows = self.query(self.tagCacheFilePath, f"""
+            SELECT Tag, Value FROM TagCache WHERE SOPInstanceUID = ? AND Tag IN ({placeholders})
+        """, [sopInstanceUID] + tags)
+        return dict(rows)
+
+    def statistics(self):
+        """Returns row counts and file sizes of the databases"""
+        statistics = {}
+        for table in ["Patients", "Studies", "Series", "Images"]:
+            rows = self.query(self.databaseFilePath,
+                              f"SELECT COUNT(*) FROM {table}")
+            statistics[table] = rows[0][0] if rows else 0
+        rows = self.query(self.tagCacheFilePath, "SELECT COUNT(*) FROM TagCache")
+        statistics["TagCache"] = rows[0][0] if rows else 0
+        for key,path in [("DatabaseBytes", self.databaseFilePath),
+                         ("TagCacheBytes", self.tagCacheFilePath)]:
+            if self.inMemory:
+                rows = self.query(path, "SELECT page_count * page_size "
+                                        "FROM pragma_page_count(), pragma_page_size()")
+                statistics[key] = rows[0][0] if rows else 0
+            else:
+                statistics[key] = os.path.getsize(path) if os.path.exists(path) else 0
+        return statistics
+
+    #
+    # copies on disk
+    #
+
+    def snapshot(self, directory):
+        """
+        Write a consistent copy of the database and tag cache to
+        ctkDICOM.sql and ctkDICOMTagCache.sql in directory (which can then
+        be opened as a ctkSQLite database) using the SQLite online backup.
+        Batches wait while the copies are made, so the two are from the
+        same moment, and each is written to a temporary file that then
+        replaces the old copy, so a reader never sees a partial file.
+        """
+        if not self.initializeDatabase():
+            raise RuntimeError(f"Cannot use database {self.databaseFilePath}")
+        self.initializeTagCache()
+        os.makedirs(directory, exist_ok=True)
+        with self.exclusiveAccess():
+            # in-memory databases are only written by this instance, which the
+            # exclusive access holds off, otherwise hold the write lock of both
+            # files (while the backup reads them through other connections)
+            writeLock = None
+            if not self.inMemory:
+                writeLock = self.connect()
+                writeLock.execute("BEGIN IMMEDIATE")
+            try:
+                for sourcePath,fileName in [(self.databaseFilePath, ctkSQLite.DatabaseFileName),
+                                            (self.tagCacheFilePath,
+                                             ctkSQLite.TagCacheDatabaseFileName)]:
+                    path = os.path.join(directory, fileName)
+                    temporaryPath = path + ".snapshot"
+                    source = ctkSQLite.sqliteConnection(sourcePath)
+                    target = sqlite3.connect(temporaryPath)
+                    try:
+                        source.backup(target)
+                    finally:
+                        source.close()
+                        target.close()
+                    os.replace(temporaryPath, path)
+            finally:
+                if writeLock is not None:
+                    writeLock.close()
+
+    def load(self, directory):
+        """
+        Replace the contents of this database with a copy (e.g. a snapshot)
+        in directory, typically to warm an in-memory database for queries
+        """
+        paths = [os.path.join(directory, ctkSQLite.DatabaseFileName),
+                 os.path.join(directory, ctkSQLite.TagCacheDatabaseFileName)]
+        for path in paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No database at {path}")
+        with self.initializationLock, self.exclusiveAccess():
+            for path,targetPath in zip(paths, [self.databaseFilePath, self.tagCacheFilePath]):
+                source = sqlite3.connect(f"{pathlib.Path(os.path.abspath(path)).as_uri()}?mode=ro",
+                                         uri=True)
+                target = ctkSQLite.sqliteConnection(targetPath, timeout=ctkSQLite.BusyTimeout)
+                try:
+                    source.backup(target)
+                finally:
+                    source.close()
+                    target.close()
+            # check the schema and the form of the tag cache again when next used
+            self.databaseInitialized = False
+            self.tagCacheInitialized = False
+            self.readGeneration += 1
+
+
+class ctkSQLiteBatch:
+    """
+    The connection and per-batch state for inserting into a ctkSQLite
+    database in a single transaction.  Use through ctkSQLite.batch().
+
+    The tag cache is attached to the database connection so both are
+    committed atomically (this relies on the default rollback journal;
+    SQLite does not make multi-database commits atomic in WAL mode).
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.connection = None
         self.cursor = None
-        self.cursorTagCache = None
-        self.dbConnection = None
-        self.dbTagCacheConnection = None
+        self.access = None
+        self.tagCacheIsCompact = False
+        self.timestamp = None
         self.patientsThisBatch = {}
-        self.studiesThisBatch = []
-        self.seriesThisBatch = []
+        self.studiesThisBatch = set()
+        self.seriesThisBatch = set()
+        self.tagCacheValuesBySeries = {}
+        self.compactIDs = {}
 
-    def cacheTags(self, cacheTagValues):
-        import slicer
-        slicer.modules.cacheTagValues = cacheTagValues
-        # TODO: remove duplicates?
+    def __enter__(self):
+        if not self.db.initializeDatabase():
+            raise RuntimeError(f"Cannot use database {self.db.databaseFilePath}")
+        self.db.initializeTagCache()
+        self.tagCacheIsCompact = self.db.tagCacheIsCompact
+        self.access = self.db.exclusiveAccess()
+        self.access.__enter__()
         try:
-            self.cursorTagCache.execute("SELECT * from TagCache LIMIT 1")
-        except sqlite3.OperationalError:
-            logging.warn("Initializing TagCache")
-            statement = "CREATE TABLE TagCache (SOPInstanceUID, Tag, Value, PRIMARY KEY (SOPInstanceUID, Tag))"
-            self.cursorTagCache.execute(statement)
-        self.cursorTagCache.executemany(f"""
-            INSERT OR REPLACE INTO TagCache VALUES(?,?,?)
+            self.connection = self.db.connect()
+            self.cursor = self.connection.cursor()
+            self.executeWithRetry("BEGIN IMMEDIATE")
+        except Exception:
+            self.close()
+            raise
+        self.timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        try:
+            if exceptionType is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+        return False
+
+    def executeWithRetry(self, statement):
+        """
+        Execute a transaction control statement, retrying with backoff when
+        another connection holds the lock beyond the busy timeout.
+        """
+        for attempt in range(ctkSQLite.LockRetries + 1):
+            try:
+                return self.cursor.execute(statement)
+            except sqlite3.OperationalError as error:
+                if "locked" not in str(error) or attempt == ctkSQLite.LockRetries:
+                    raise
+                delay = (2 ** attempt) * (0.5 + random.random())
+                logging.warning(f"{statement} waiting {delay:.1f}s for lock: {error}")
+                time.sleep(delay)
+
+    def commit(self):
+        if self.tagCacheIsCompact:
+            self.flushCompactTagCache()
+        self.updateDisplayedFields()
+        self.executeWithRetry("COMMIT")
+
+    def rollback(self):
+        if self.connection is not None and self.connection.in_transaction:
+            self.cursor.execute("ROLLBACK")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.cursor = None
+        if self.access is not None:
+            self.access.__exit__(None, None, None)
+            self.access = None
+
+    def updateDisplayedFields(self):
+        """
+        Fill in the display fields that ctkDICOMDatabase::updateDisplayedFields
+        would otherwise compute when the database is opened, for only the
+        patients, studies and series touched by this batch.  The rows get
+        the batch timestamp, so they are not considered out of date.
+        """
+        columns = self.db.displayedFieldColumns
+        touchedKeys = {"Series": [(str(uid),) for uid in self.seriesThisBatch],
+                       "Studies": [(str(uid),) for uid in self.studiesThisBatch],
+                       "Patients": [(uid,) for uid in self.patientsThisBatch.values()]}
+        for table, keys in touchedKeys.items():
+            self.cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS Batch{table} (UID PRIMARY KEY)")
+            self.cursor.execute(f"DELETE FROM temp.Batch{table}")
+            self.cursor.executemany(f"INSERT OR IGNORE INTO temp.Batch{table} VALUES (?)", keys)
+
+        for table, (keyColumn, expressions) in ctkSQLite.DisplayedFieldExpressions.items():
+            tableColumns = columns.get(table, ())
+            assignments = [f"{column} = {expression}"
+                           for column, expression in expressions.items() if column in tableColumns]
+            parameters = []
+            if "DisplayedFieldsUpdatedTimestamp" in tableColumns:
+                assignments.append("DisplayedFieldsUpdatedTimestamp = ?")
+                parameters.append(self.timestamp)
+            if assignments:
+                self.cursor.execute(f"""
+                    UPDATE {table} SET {", ".join(assignments)}
+                    WHERE {keyColumn} IN (SELECT UID FROM temp.Batch{table})
+                """, parameters)
+
+        if "DisplayedFieldsUpdatedTimestamp" in columns.get("Images", ()):
+            self.cursor.execute("""
+                UPDATE Images SET DisplayedFieldsUpdatedTimestamp = ?
+                WHERE SeriesInstanceUID IN (SELECT UID FROM temp.BatchSeries)
+                  AND DisplayedFieldsUpdatedTimestamp IS NULL
+            """, [self.timestamp])
+
+    def cacheTags(self, cacheTagValues, seriesInstanceUID=""):
+        if self.tagCacheIsCompact:
+            # stored when the batch ends, once it is known
+            # which values are constant over the series
+            seriesValues = self.tagCacheValuesBySeries.setdefault(seriesInstanceUID, [])
+            seriesValues += cacheTagValues
+            return
+        self.cursor.executemany(f"""
+            INSERT OR REPLACE INTO tagcache.TagCache VALUES(?,?,?)
         """, cacheTagValues)
 
-    def insert(self, ds, frameURL):
+    def compactID(self, table, idColumn, column, value):
+        """Returns the integer id for value in a compact tag cache table"""
+        ids = self.compactIDs.setdefault(table, {})
+        if value in ids:
+            return ids[value]
+        self.cursor.execute(f"""
+            SELECT {idColumn} FROM {table} WHERE {column} = ?
+        """, [value])
+        result = self.cursor.fetchone()
+        if result is None:
+            self.cursor.execute(f"""
+                INSERT INTO {table} ({column}) VALUES (?)
+            """, [value])
+            ids[value] = self.cursor.lastrowid
+        else:
+            ids[value] = result[0]
+        return ids[value]
+
+    def flushCompactTagCache(self):
+        """
+        Write the buffered tag values of each series into the compact tag cache.
+        A tag whose value is the same for every buffered instance is stored
+        at the series level if the series has no value for it yet and no
+        earlier instances, or if the series value is the same.  All other
+        values are stored per instance and take precedence in the view.
+        """
+        cursor = self.cursor
+        for seriesInstanceUID, cacheTagValues in self.tagCacheValuesBySeries.items():
+            seriesID = self.compactID("tagcache.TagCacheSeries", "SeriesID",
+                                      "SeriesInstanceUID", seriesInstanceUID)
+            cursor.execute("""
+                SELECT COUNT(*) FROM tagcache.TagCacheInstances WHERE SeriesID = ?
+            """, [seriesID])
+            priorInstanceCount = cursor.fetchone()[0]
+            cursor.execute("""
+                SELECT TagID, ValueID FROM tagcache.TagCacheSeriesValues WHERE SeriesID = ?
+            """, [seriesID])
+            seriesValueIDs = dict(cursor.fetchall())
+
+            instanceIDs = {}
+            reinsertedInstanceIDs = []
+            valuesByTag = {}
+            for sopInstanceUID, tag, value in cacheTagValues:
+                if sopInstanceUID not in instanceIDs:
+                    cursor.execute("""
+                        SELECT InstanceID FROM tagcache.TagCacheInstances WHERE SOPInstanceUID = ?
+                    """, [sopInstanceUID])
+                    result = cursor.fetchone()
+                    if result is None:
+                        cursor.execute("""
+                            INSERT INTO tagcache.TagCacheInstances (SOPInstanceUID, SeriesID)
+                            VALUES (?, ?)
+                        """, [sopInstanceUID, seriesID])
+                        instanceIDs[sopInstanceUID] = cursor.lastrowid
+                    else:
+                        cursor.execute("""
+                            UPDATE tagcache.TagCacheInstances SET SeriesID = ? WHERE InstanceID = ?
+                        """, [seriesID, result[0]])
+                        instanceIDs[sopInstanceUID] = result[0]
+                        reinsertedInstanceIDs.append(result[0])
+                valuesByTag.setdefault(tag, {})[sopInstanceUID] = value
+
+            instanceRows = []
+            seriesRows = []
+            staleRows = []
+            for tag, valuesBySOPInstanceUID in valuesByTag.items():
+                tagID = self.compactID("tagcache.TagCacheTags", "TagID", "Tag", tag)
+                distinctValues = set(valuesBySOPInstanceUID.values())
+                seriesLevel = False
+                if len(valuesBySOPInstanceUID) == len(instanceIDs) \
+                        and len(distinctValues) == 1:
+                    valueID = self.compactID("tagcache.TagCacheValues", "ValueID",
+                                             "Value", distinctValues.pop())
+                    if seriesValueIDs.get(tagID) == valueID:
+                        seriesLevel = True
+                    elif tagID not in seriesValueIDs and priorInstanceCount == 0:
+                        seriesRows.append((seriesID, tagID, valueID))
+                        seriesValueIDs[tagID] = valueID
+                        seriesLevel = True
+                if seriesLevel:
+                    staleRows += [(instanceID, tagID) for instanceID in reinsertedInstanceIDs]
+                    continue
+                for sopInstanceUID, value in valuesBySOPInstanceUID.items():
+                    valueID = self.compactID("tagcache.TagCacheValues", "ValueID", "Value", value)
+                    instanceRows.append((instanceIDs[sopInstanceUID], tagID, valueID))
+            cursor.executemany("""
+                DELETE FROM tagcache.TagCacheInstanceValues WHERE InstanceID = ? AND TagID = ?
+            """, staleRows)
+            cursor.executemany("""
+                INSERT OR REPLACE INTO tagcache.TagCacheSeriesValues VALUES (?, ?, ?)
+            """, seriesRows)
+            cursor.executemany("""
+                INSERT OR REPLACE INTO tagcache.TagCacheInstanceValues VALUES (?, ?, ?)
+            """, instanceRows)
+        self.tagCacheValuesBySeries = {}
+
+    def insert(self, ds, frameURL, filename="", cacheAbsentTags=True):
         """
-        Insert dataset into database
+        Insert dataset into database (see ctkSQLite.tagCacheValues
+        for cacheAbsentTags)
 
         Returns True if insert completed
         """
+        # required values are read once into a namespace so the dataset
+        # itself is not modified
+        values = self.db.datasetValues(ds)
+        cacheTagValues = self.db.tagCacheValues(ds, str(values.SOPInstanceUID),
+                                                cacheAbsentTags)
+        return self.insertValues(values, cacheTagValues, frameURL, filename)
 
-        timeFormat = "%Y-%m-%dT%H:%M:%S" # TODO: need three milliseconds?
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    def insertValues(self, values, cacheTagValues, frameURL, filename=""):
+        """
+        Insert an instance given the datasetValues and tagCacheValues
+        of its dataset, which can be prepared in another process.
 
-        for tag in ctkSQLite.RequiredTags:
-            if tag not in ds:
-                setattr(ds, tag, "")
+        Returns True if insert completed
+        """
 
-        if not ctkSQLite.uidsForDataset(ds):
-            # minimum information is missing, can't insert
-            return False
+        timestamp = self.timestamp
 
-        if not self.initializeDatabase():
-            # can't work with database
+        if not ctkSQLite.uidsForDataset(values):
+            # minimum information is missing, can't insert
             return False
 
         patientUID = ctkSQLite.compositePatientID(
-                            ds.PatientID, ds.PatientName, ds.PatientBirthDate)
+                            values.PatientID, values.PatientName, values.PatientBirthDate)
 
         # maybe insert patient
-        patientIdentifiers = (ds.PatientName, ds.PatientID)
+        patientIdentifiers = (values.PatientName, values.PatientID)
         if patientIdentifiers not in self.patientsThisBatch:
             self.cursor.execute(f"""
                 SELECT UID FROM Patients WHERE PatientsName = ? AND PatientID = ?
@@ -212,14 +974,14 @@ class ctkSQLite(DICOMDatabase):
                      'DisplayedPatientsName', 'DisplayedNumberOfStudies',
                      'DisplayedFieldsUpdatedTimestamp')
                     VALUES(NULL, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, NULL)
-                """, ctkSQLite.stringList(ds.PatientName, ds.PatientID,
-                                          ds.PatientBirthDate,
-                                          "", ds.PatientSex, "",
+                """, ctkSQLite.stringList(values.PatientName, values.PatientID,
+                                          values.PatientBirthDate,
+                                          "", values.PatientSex, "",
                                           "", timestamp))
                 # get the newly created dbPatientID
                 self.cursor.execute(f"""
                     SELECT UID FROM Patients WHERE PatientsName = ? AND PatientID = ?
-                """, [str(value) for value in [ds.PatientName, ds.PatientID]])
+                """, [str(value) for value in [values.PatientName, values.PatientID]])
                 dbResult = self.cursor.fetchone()
                 if dbResult is None:
                     logging.error("Error insterting patient")
@@ -236,45 +998,29 @@ class ctkSQLite(DICOMDatabase):
                 ("SOPInstanceUID", "Filename", "URL", "SeriesInstanceUID",
                  "InsertTimestamp", "DisplayedFieldsUpdatedTimestamp")
                 VALUES(?, ?, ?, ?, ?, NULL)
-            """, ctkSQLite.stringList(ds.SOPInstanceUID, "", frameURL,
-                            ds.SeriesInstanceUID, timestamp))
+            """, ctkSQLite.stringList(values.SOPInstanceUID, filename, frameURL,
+                            values.SeriesInstanceUID, timestamp))
         except sqlite3.IntegrityError as error:
-            logging.warn('ignoring duplicate instance error')
-            logging.warn(" ".join(error.args))
+            if filename:
+                # the instance was re-indexed, possibly from a moved file
+                self.cursor.execute(f"""
+                    UPDATE Images SET Filename = ?, URL = ? WHERE SOPInstanceUID = ?
+                """, ctkSQLite.stringList(filename, frameURL, values.SOPInstanceUID))
+            else:
+                logging.warn('ignoring duplicate instance error')
+                logging.warn(" ".join(error.args))
 
         # populate the tag cache
-        sopInstanceID = str(ds.SOPInstanceUID)
-        cacheTagValues = []
-        extraKeys = ["StudyInstanceUID", "BitsAllocated", "BitsStored",
-                     "PixelRepresentation", "WindowCenter", "WindowWidth",
-                     "RescaleIntercept", "RescaleSlope", "ContentDate",
-                     "Manufacturer", "PatientPosition"]
-        extraTags = [DICOMDatabase.dicomTagWithComma(k) for k in extraKeys]
-        tagsToCache = self.tagsToPrecache + tuple(extraTags)
-        for tag in tagsToCache:
-            # db uses comma, pydicom does not but is upper
-            dsTag = tag.replace(',','').upper()
-            if dsTag in ds:
-                value = ds[dsTag]._value
-                if value == "":
-                    value = ctkSQLite.ValueIsEmptyString
-                elif ds[dsTag].VR == 'DS' and ds[dsTag].VM > 1:
-                    value = "\\".join(map(str, list(value)))
-            else:
-                value = ctkSQLite.TagNotInInstance
-            if tag in self.tagsToExcludeFromStorage:
-                value = ctkSQLite.ValueIsNotStored
-            cacheTagValues.append((sopInstanceID, tag.upper(), str(value)))
-        self.cacheTags(cacheTagValues)
+        self.cacheTags(cacheTagValues, str(values.SeriesInstanceUID))
 
         # maybe insert Series
-        if ds.SeriesInstanceUID in self.seriesThisBatch:
+        if values.SeriesInstanceUID in self.seriesThisBatch:
             # series is there, so study will be too
             return True
         else:
             self.cursor.execute(f"""
                 SELECT * FROM Series WHERE SeriesInstanceUID = ?
-            """, [str(value) for value in [ds.SeriesInstanceUID]])
+            """, [str(value) for value in [values.SeriesInstanceUID]])
             if self.cursor.fetchone() is None:
                 self.cursor.execute(f"""
                     INSERT INTO Series
@@ -284,21 +1030,21 @@ class ctkSQLite(DICOMDatabase):
                      'AcquisitionNumber', 'ContrastAgent', 'ScanningSequence',
                      'EchoNumber', 'TemporalPosition', 'InsertTimestamp')
                     VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, ctkSQLite.stringList(ds.SeriesInstanceUID, ds.StudyInstanceUID,
-                                ds.SeriesNumber, ds.SeriesDate, ds.SeriesTime,
-                                ds.SeriesDescription, ds.Modality,
-                                ds.BodyPartExamined, ds.FrameOfReferenceUID,
-                                ds.AcquisitionNumber, ds.ContrastBolusAgent,
-                                ds.ScanningSequence, ds.EchoNumbers,
-                                ds.TemporalPositionIdentifier, timestamp))
+                """, ctkSQLite.stringList(values.SeriesInstanceUID, values.StudyInstanceUID,
+                                values.SeriesNumber, values.SeriesDate, values.SeriesTime,
+                                values.SeriesDescription, values.Modality,
+                                values.BodyPartExamined, values.FrameOfReferenceUID,
+                                values.AcquisitionNumber, values.ContrastBolusAgent,
+                                values.ScanningSequence, values.EchoNumbers,
+                                values.TemporalPositionIdentifier, timestamp))
             # series either already in db or was just inserted
-            self.seriesThisBatch.append(ds.SeriesInstanceUID)
+            self.seriesThisBatch.add(values.SeriesInstanceUID)
 
         # maybe insert Study
-        if ds.StudyInstanceUID not in self.studiesThisBatch:
+        if values.StudyInstanceUID not in self.studiesThisBatch:
             self.cursor.execute(f"""
                 SELECT * FROM Studies WHERE StudyInstanceUID = ?
-            """, [str(value) for value in [ds.StudyInstanceUID]])
+            """, [str(value) for value in [values.StudyInstanceUID]])
             if self.cursor.fetchone() is None:
                 self.cursor.execute(f"""
                     INSERT INTO Studies
@@ -309,11 +1055,11 @@ class ctkSQLite(DICOMDatabase):
                      'StudyDescription', 'InsertTimestamp',
                      'DisplayedNumberOfSeries', 'DisplayedFieldsUpdatedTimestamp')
                     VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)
-                """, ctkSQLite.stringList(ds.StudyInstanceUID, dbPatientID,
-                                ds.StudyID, ds.StudyDate, ds.StudyTime,
-                                ds.AccessionNumber, ds.ModalitiesInStudy,
-                                ds.InstitutionName, ds.ReferringPhysicianName,
-                                ds.PerformingPhysicianName, ds.StudyDescription,
+                """, ctkSQLite.stringList(values.StudyInstanceUID, dbPatientID,
+                                values.StudyID, values.StudyDate, values.StudyTime,
+                                values.AccessionNumber, values.ModalitiesInStudy,
+                                values.InstitutionName, values.ReferringPhysicianName,
+                                values.PerformingPhysicianName, values.StudyDescription,
                                 timestamp))
-            self.studiesThisBatch.append(ds.StudyInstanceUID)
+            self.studiesThisBatch.add(values.StudyInstanceUID)
         return True
@@ -1,4 +1,5 @@
 import copy
+import datetime
 import gzip
 import json
 import logging
@@ -6,27 +7,50 @@ import numpy as np
 import os
 import pydicom
 import requests
+import threading
 import time
 
 
 try:
     import boto3
 except ModuleNotFoundError:
-    import slicer
-    slicer.util.pip_install('boto3')
-    import boto3
+    try:
+        import slicer
+        slicer.util.pip_install('boto3')
+        import boto3
+    except ModuleNotFoundError:
+        boto3 = None
 
-import ahi_retrieve as ahi
+try:
+    import ahi_retrieve as ahi
+except ModuleNotFoundError:
+    ahi = None
 
+from DICOMLogic.stores.DICOMFrameBroker import DICOMFrameBroker
 from DICOMLogic.stores.DICOMStore import DICOMStore
 
 class DICOMAHIStore(DICOMStore):
+    """
+    Frames are retrieved through a DICOMFrameBroker, so a frame already on
+    its way is not requested again.  The responses of the ahi_retrieve
+    handler are collected by getFrames and, while frames are on their way,
+    by a thread every PumpInterval seconds so that subscriptions with
+    callbacks, futures or async iterators need no polling.
+    """
+
+    PumpInterval = 0.01
 
     def __init__(self, db, datastoreId=None):
+        if boto3 is None or ahi is None:
+            raise ModuleNotFoundError("DICOMAHIStore requires boto3 and ahi_retrieve")
         self.db = db
         self.datastoreId = datastoreId
 
-        self.retrievedFramesByURL = {}
+        self.urlsByImageFrameID = {}
+        self.broker = DICOMFrameBroker(self.requestFrames)
+        self.requests = self.broker.subscription()
+        self.handlerLock = threading.Lock()
+        self.pumpThread = None
 
         # Initialize the module
         config = ahi.AHIRetrieveConfig()
@@ -43,110 +67,158 @@ class DICOMAHIStore(DICOMStore):
         self.client = boto3.client("medical-imaging")
 
     def indexImageSet(self, imageSetMetadata):
-        self.db.startBatchInsert()
-        dataset = pydicom.Dataset()
-        levels = ['Patient', 'Study']
-        for level in levels:
-            for tagName,value in imageSetMetadata[level]['DICOM'].items():
-                vr = pydicom.datadict.dictionary_VR(tagName)
-                if vr != 'SQ':
-                    dataset[tagName] = pydicom.DataElement(tagName, vr, value)
-        for seriesUID in imageSetMetadata['Study']['Series']:
-            seriesMetadata = imageSetMetadata['Study']['Series'][seriesUID]
-            for tagName,value in seriesMetadata['DICOM'].items():
-                vr = pydicom.datadict.dictionary_VR(tagName)
-                if vr != 'SQ':
-                    dataset[tagName] = pydicom.DataElement(tagName, vr, value)
-            for instanceUID in seriesMetadata["Instances"]:
-                instanceDataset = copy.deepcopy(dataset)
-                instanceMetadata = seriesMetadata['Instances'][instanceUID]
-                instanceDICOMData = instanceMetadata['DICOM']
-                for tagName,value in instanceDICOMData.items():
-                    if pydicom.datadict.dictionary_has_tag(tagName):
-                        vr = pydicom.datadict.dictionary_VR(tagName)
-                        if vr != 'SQ':
-                            instanceDataset[tagName] = pydicom.DataElement(tagName, vr, value)
-                frameURL = f"ahi://{self.datastoreId}"
-                frameURL += f"/{imageSetMetadata['ImageSetID']}"
-                frameURL += f"/{instanceDataset.SeriesInstanceUID}"
-                frameURL += f"/{instanceDataset.SOPInstanceUID}"
-                if len(instanceMetadata['ImageFrames']) > 0:
-                    frameURL += f"/{instanceMetadata['ImageFrames'][0]['ID']}"
-                else:
-                    frameURL += "/TODO-non-image-instance"
-                self.db.insert(instanceDataset, frameURL)
-        self.db.endBatchInsert()
+        """
+        Insert the instances of the image set and return the number of instances
+        """
+        instanceCount = 0
+        with self.db.batch() as batch:
+            dataset = pydicom.Dataset()
+            levels = ['Patient', 'Study']
+            for level in levels:
+                for tagName,value in imageSetMetadata[level]['DICOM'].items():
+                    vr = pydicom.datadict.dictionary_VR(tagName)
+                    if vr != 'SQ':
+                        dataset[tagName] = pydicom.DataElement(tagName, vr, value)
+            for seriesUID in imageSetMetadata['Study']['Series']:
+                seriesMetadata = imageSetMetadata['Study']['Series'][seriesUID]
+                for tagName,value in seriesMetadata['DICOM'].items():
+                    vr = pydicom.datadict.dictionary_VR(tagName)
+                    if vr != 'SQ':
+                        dataset[tagName] = pydicom.DataElement(tagName, vr, value)
+                for instanceUID in seriesMetadata["Instances"]:
+                    instanceDataset = copy.deepcopy(dataset)
+                    instanceMetadata = seriesMetadata['Instances'][instanceUID]
+                    instanceDICOMData = instanceMetadata['DICOM']
+                    for tagName,value in instanceDICOMData.items():
+                        if pydicom.datadict.dictionary_has_tag(tagName):
+                            vr = pydicom.datadict.dictionary_VR(tagName)
+                            if vr != 'SQ':
+                                instanceDataset[tagName] = pydicom.DataElement(tagName, vr, value)
+                    frameURL = f"ahi://{self.datastoreId}"
+                    frameURL += f"/{imageSetMetadata['ImageSetID']}"
+                    frameURL += f"/{instanceDataset.SeriesInstanceUID}"
+                    frameURL += f"/{instanceDataset.SOPInstanceUID}"
+                    if len(instanceMetadata['ImageFrames']) > 0:
+                        frameURL += f"/{instanceMetadata['ImageFrames'][0]['ID']}"
+                    else:
+                        frameURL += "/TODO-non-image-instance"
+                    batch.insert(instanceDataset, frameURL)
+                    instanceCount += 1
+        return instanceCount
 
-    def indexDatastore(self):
+    def imageSetSummaries(self, pageSize=50):
         """
-        Get all image sets in the AHI DICOM datastore and
-        insert all the instances in to the database.
+        Generate the summaries of all image sets in the AHI DICOM datastore,
+        following the search pagination tokens.
         """
+        now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.00Z")
         searchCriteria= {
             "filters" : [{
                 "operator": "BETWEEN",
                 "values":[
                     {"createdAt": "1985-04-12T23:20:50.52Z"},
-                    {"createdAt": "2024-01-12T23:20:50.52Z"}
+                    {"createdAt": now}
             ]}
         ]}
-        response = self.client.search_image_sets(
-                    datastoreId=self.datastoreId,
-                    searchCriteria=searchCriteria)
-        for imageSetsMetadataSummary in response['imageSetsMetadataSummaries']:
-            metadataResponse = self.client.get_image_set_metadata(
-                    datastoreId = self.datastoreId,
-                    imageSetId = imageSetsMetadataSummary['imageSetId'])
-            gzippedMetadata = metadataResponse['imageSetMetadataBlob'].read()
-            imageSetJSON = gzip.decompress(gzippedMetadata)
-            imageSetMetadata = json.loads(imageSetJSON)
-            self.indexImageSet(imageSetMetadata)
+        nextToken = None
+        while True:
+            arguments = {"datastoreId": self.datastoreId,
+                         "searchCriteria": searchCriteria,
+                         "maxResults": pageSize}
+            if nextToken:
+                arguments["nextToken"] = nextToken
+            response = self.client.search_image_sets(**arguments)
+            for imageSetsMetadataSummary in response['imageSetsMetadataSummaries']:
+                yield imageSetsMetadataSummary
+            nextToken = response.get('nextToken')
+            if not nextToken:
+                break
 
-    def startRequest(self, urls):
-        """
-        Retrieve frames based on URLs
+    def imageSetMetadata(self, imageSetId):
+        metadataResponse = self.client.get_image_set_metadata(
+                datastoreId = self.datastoreId,
+                imageSetId = imageSetId)
+        gzippedMetadata = metadataResponse['imageSetMetadataBlob'].read()
+        imageSetJSON = gzip.decompress(gzippedMetadata)
+        return json.loads(imageSetJSON)
 
-        urls must all be from the same data store, study, and series.  I.e.
-        same image set.
+    def indexDatastore(self):
         """
+        Get all image sets in the AHI DICOM datastore and
+        insert all the instances in to the database.
+        """
+        for imageSetsMetadataSummary in self.imageSetSummaries():
+            imageSetMetadata = self.imageSetMetadata(
+                    imageSetsMetadataSummary['imageSetId'])
+            self.indexImageSet(imageSetMetadata)
+
+    def requestFrames(self, urls):
+        """Send the request for the frames the broker does not have on their way"""
         url0 = urls[0]
         _, _, datastoreId, imageSetId, seriesUID, sopInstanceID, imageFrameId = url0.split('/')
         ahiRequest = {}
         ahiRequest['DatastoreID'] = datastoreId
         ahiRequest['ImageSetID'] = imageSetId
         ahiRequest['Study'] = {'Series': {seriesUID: {'Instances': {}}}}
-        self.urlsByImageFrameID = {}
         for url in urls:
             _, _, datastoreId, imageSetId, seriesUID, sopInstanceID, imageFrameId = url.split('/')
             ahiRequest['Study']['Series'][seriesUID]['Instances'][sopInstanceID] = {}
             ahiRequest['Study']['Series'][seriesUID]['Instances'][sopInstanceID]['ImageFrames'] = []
             frames = ahiRequest['Study']['Series'][seriesUID]['Instances'][sopInstanceID]['ImageFrames']
             frames.append({"ID": imageFrameId, "FrameSizeInBytes": 0})
-            self.urlsByImageFrameID[imageFrameId] = url
         requestAsJSON = json.dumps(ahiRequest)
-        self.handler.request_frames(requestAsJSON)
+        with self.handlerLock:
+            for url in urls:
+                self.urlsByImageFrameID[url.split('/')[-1]] = url
+            self.handler.request_frames(requestAsJSON)
+            if self.pumpThread is None:
+                self.pumpThread = threading.Thread(target=self.pump, daemon=True)
+                self.pumpThread.start()
+
+    def pumpFrames(self):
+        """Pass any new frames from the handler to the broker"""
+        retrieved = []
+        with self.handlerLock:
+            responses = self.handler.get_frame_responses()
+            for i in responses:
+                data = np.array(i, copy = False)
+                url = self.urlsByImageFrameID.pop(i.imageFrameId, None)
+                if url is not None:
+                    retrieved.append((url, data))
+        for url,data in retrieved:
+            self.broker.deliver(url, data)
+
+    def pump(self):
+        while True:
+            self.pumpFrames()
+            with self.handlerLock:
+                if len(self.urlsByImageFrameID) == 0:
+                    self.pumpThread = None
+                    return
+            time.sleep(DICOMAHIStore.PumpInterval)
+
+    def startRequest(self, urls):
+        """
+        Retrieve frames based on URLs
+
+        urls must all be from the same data store, study, and series.  I.e.
+        same image set.
+        """
+        self.requests.add(urls)
+
+    def subscribe(self, urls, callback=None):
+        """Returns a DICOMFrameSubscription to the frames of the urls"""
+        return self.broker.subscription(urls, callback)
 
     def getFrames(self, requestedURLs):
         """
-        Returns any available frames corresponding to requested URLs.
+        Returns any available frames corresponding to requested URLs,
+        keeping the others for their requesters.
         TODO: handle any error codes
         """
-        # first, get any new frames that are available
-        # and add them to frame store for use now or later
-        responses = self.handler.get_frame_responses()
-        for i in responses:
-            data = np.array(i, copy = False)
-            url = self.urlsByImageFrameID[i.imageFrameId]
-            self.retrievedFramesByURL[url] = data
-            del(self.urlsByImageFrameID[i.imageFrameId])
-        # second, look for requested urls in store and return them
-        framesByURLForURLs = {}
-        for url in requestedURLs:
-            if url in self.retrievedFramesByURL:
-                framesByURLForURLs[url] = self.retrievedFramesByURL[url]
-                del(self.retrievedFramesByURL[url])
-        return(framesByURLForURLs)
+        self.pumpFrames()
+        return self.requests.take(requestedURLs)
 
     def requestFinished(self):
         # TODO: return self.handler.is_busy() == False
-        return len(self.urlsByImageFrameID) == 0
+        return self.broker.idle()
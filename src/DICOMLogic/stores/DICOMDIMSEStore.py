@@ -0,0 +1,386 @@
+import concurrent.futures
+import logging
+import numpy as np
+import pydicom
+import pydicom.encaps
+import queue
+import threading
+import urllib.parse
+
+try:
+    import pynetdicom
+    import pynetdicom.sop_class
+except ModuleNotFoundError:
+    pynetdicom = None
+
+from DICOMLogic.stores.DICOMFrameBroker import DICOMFrameBroker
+from DICOMLogic.stores.DICOMFrameDecoder import DICOMFrameDecoder
+from DICOMLogic.stores.DICOMStore import DICOMStore
+
+class DICOMDIMSEStore(DICOMStore):
+    """
+    Index and retrieve from a PACS over DIMSE with pynetdicom.
+
+    Studies are indexed with C-FIND queries at the image level for every
+    tag the database stores, one query per series.  The patient, study and
+    series attributes found by the study and series queries fill in those
+    the archive does not return at the image level.  Frame URLs look like
+    dimse://AETITLE@host:port/studies/{uid}/series/{uid}/instances/{uid}/frames/1
+
+    Frames are retrieved with C-GET, instancesPerGet instances per request,
+    over a pool of up to maxAssociations associations that are kept open
+    between requests, so that many requests run at once.  Each instance
+    is passed to the frame broker as soon as its C-STORE sub-operation
+    arrives, rather than when the C-GET completes.  Storage is negotiated
+    with the transferSyntaxes (names or UIDs as for DICOMwebStore) that
+    can be decoded, then Explicit and Implicit VR Little Endian.
+    Archives without list matching of SOPInstanceUID need instancesPerGet=1.
+    """
+
+    ImplicitVRLittleEndian = "1.2.840.10008.1.2"
+    BigEndianTransferSyntax = "1.2.840.10008.1.2.2"
+
+    # keys of the study and series level queries
+    StudyKeywords = ["PatientName", "PatientID", "PatientBirthDate", "PatientSex",
+                     "StudyID", "StudyDate", "StudyTime", "StudyDescription",
+                     "AccessionNumber", "ModalitiesInStudy", "ReferringPhysicianName"]
+    SeriesKeywords = ["SeriesNumber", "SeriesDate", "SeriesTime", "SeriesDescription",
+                      "Modality", "BodyPartExamined"]
+
+    def __init__(self, db, address, port, calledAETitle="ANY-SCP",
+                 callingAETitle="DICOMLOGIC", maxAssociations=4,
+                 instancesPerGet=50, transferSyntaxes=None, timeout=30):
+        if pynetdicom is None:
+            raise ModuleNotFoundError("DICOMDIMSEStore requires pynetdicom")
+        self.db = db
+        self.address = address
+        self.port = port
+        self.calledAETitle = calledAETitle
+        self.instancesPerGet = instancesPerGet
+        self.url = f"dimse://{calledAETitle}@{address}:{port}"
+
+        transferSyntaxUIDs = DICOMFrameDecoder.transferSyntaxUIDs(transferSyntaxes or [])
+        transferSyntaxUIDs.append(DICOMDIMSEStore.ImplicitVRLittleEndian)
+        self.ae = pynetdicom.AE(ae_title=callingAETitle)
+        self.ae.acse_timeout = timeout
+        self.ae.dimse_timeout = timeout
+        self.ae.network_timeout = timeout
+        self.ae.add_requested_context(
+                pynetdicom.sop_class.StudyRootQueryRetrieveInformationModelFind)
+        self.ae.add_requested_context(
+                pynetdicom.sop_class.StudyRootQueryRetrieveInformationModelGet)
+        # C-GET returns the instances over the same association, so this
+        # end takes the storage SCP role for every storage SOP class
+        self.roles = []
+        for context in pynetdicom.StoragePresentationContexts:
+            self.ae.add_requested_context(context.abstract_syntax, transferSyntaxUIDs)
+            self.roles.append(pynetdicom.build_role(context.abstract_syntax, scp_role=True))
+
+        self.maxAssociations = maxAssociations
+        self.idleAssociations = queue.LifoQueue()
+        self.associationSlots = threading.BoundedSemaphore(maxAssociations)
+        self.executor = concurrent.futures.ThreadPoolExecutor(maxAssociations)
+        self.lock = threading.Lock()
+        # SOPInstanceUID -> (the C-GET that retrieves it, urls of its frames)
+        self.urlsByInstance = {}
+        self.broker = DICOMFrameBroker(self.requestFrames)
+        self.requests = self.broker.subscription()
+
+    def shutdown(self):
+        """
+        Stop retrieving, failing the frames of C-GETs that had not
+        started, and release the open associations
+        """
+        self.executor.shutdown(cancel_futures=True)
+        with self.lock:
+            cancelledURLs = [url for _, urls in self.urlsByInstance.values() for url in urls]
+            self.urlsByInstance = {}
+        for url in cancelledURLs:
+            self.broker.fail(url, ConnectionAbortedError(f"{self.url} store was shut down"))
+        while True:
+            try:
+                self.idleAssociations.get_nowait().release()
+            except queue.Empty:
+                break
+
+    #
+    # association pool
+    #
+
+    def association(self):
+        """
+        Returns an established association from the pool, opening a new one
+        if all are in use and there are fewer than maxAssociations
+        """
+        self.associationSlots.acquire()
+        while True:
+            try:
+                association = self.idleAssociations.get_nowait()
+            except queue.Empty:
+                break
+            if association.is_established:
+                return association
+        try:
+            association = self.ae.associate(self.address, self.port,
+                                            ae_title=self.calledAETitle, ext_neg=self.roles,
+                                            evt_handlers=[(pynetdicom.evt.EVT_C_STORE,
+                                                           self.handleStore)])
+        except Exception:
+            self.associationSlots.release()
+            raise
+        if not association.is_established:
+            self.associationSlots.release()
+            raise ConnectionError(f"Association with {self.url} was not established")
+        return association
+
+    def releaseAssociation(self, association):
+        """Return the association to the pool, or drop it if it failed"""
+        if association.is_established:
+            self.idleAssociations.put(association)
+        self.associationSlots.release()
+
+    #
+    # indexing
+    #
+
+    def find(self, identifier):
+        """Returns the identifiers matching a C-FIND query"""
+        association = self.association()
+        try:
+            responses = association.send_c_find(
+                    identifier, pynetdicom.sop_class.StudyRootQueryRetrieveInformationModelFind)
+            results = []
+            for status, result in responses:
+                if "Status" not in status:
+                    raise ConnectionError(f"C-FIND to {self.url} failed")
+                if status.Status in (0xFF00, 0xFF01) and result is not None:
+                    results.append(result)
+                elif status.Status != 0x0000:
+                    raise RuntimeError(f"C-FIND to {self.url} failed with status "
+                                       f"0x{status.Status:04X}")
+            return results
+        finally:
+            self.releaseAssociation(association)
+
+    def queryIdentifier(self, level, keys, keywords=None):
+        """
+        A C-FIND identifier matching the keys and returning the keywords,
+        by default every tag the database stores
+        """
+        identifier = pydicom.Dataset()
+        if keywords is not None:
+            tags = [pydicom.tag.Tag(keyword) for keyword in keywords]
+        elif hasattr(self.db, "requiredTagPlan"):
+            tags = [tag for _, tag in self.db.requiredTagPlan]
+            tags += [tag for _, tag, _ in self.db.tagCachePlan]
+        else:
+            keywords = DICOMDIMSEStore.StudyKeywords + DICOMDIMSEStore.SeriesKeywords
+            tags = [pydicom.tag.Tag(keyword) for keyword in keywords + ["SOPInstanceUID"]]
+        for tag in dict.fromkeys(tags):
+            try:
+                vr = pydicom.datadict.dictionary_VR(tag)
+            except KeyError:
+                continue
+            if vr != "SQ":
+                identifier.add_new(tag, vr, None)
+        identifier.QueryRetrieveLevel = level
+        for keyword,value in keys.items():
+            setattr(identifier, keyword, value)
+        return identifier
+
+    def studyInstanceUIDs(self):
+        """Returns the StudyInstanceUIDs of every study in the archive"""
+        identifier = pydicom.Dataset()
+        identifier.QueryRetrieveLevel = "STUDY"
+        identifier.StudyInstanceUID = ""
+        return [str(result.StudyInstanceUID) for result in self.find(identifier)]
+
+    def studyInstances(self, studyInstanceUID):
+        """Returns a dataset of the indexed attributes of each instance in the study"""
+        studyKeys = {"StudyInstanceUID": studyInstanceUID}
+        studies = self.find(self.queryIdentifier("STUDY", studyKeys,
+                                                 DICOMDIMSEStore.StudyKeywords))
+        if not studies:
+            return []
+        instanceDatasets = []
+        seriesResults = self.find(self.queryIdentifier(
+                "SERIES", studyKeys, DICOMDIMSEStore.SeriesKeywords + ["SeriesInstanceUID"]))
+        for series in seriesResults:
+            seriesKeys = dict(studyKeys, SeriesInstanceUID=str(series.SeriesInstanceUID))
+            for instance in self.find(self.queryIdentifier("IMAGE", seriesKeys)):
+                dataset = pydicom.Dataset()
+                for level in (studies[0], series, instance):
+                    for element in level:
+                        if element.tag != 0x00080052 and not element.is_empty:
+                            dataset[element.tag] = element
+                instanceDatasets.append(dataset)
+        return instanceDatasets
+
+    def frameURL(self, instanceDataset, frame=1):
+        frameURL = f"{self.url}/studies/{instanceDataset.StudyInstanceUID}"
+        frameURL += f"/series/{instanceDataset.SeriesInstanceUID}"
+        frameURL += f"/instances/{instanceDataset.SOPInstanceUID}/frames/{frame}"
+        return frameURL
+
+    def indexInstances(self, instanceDatasets):
+        """Insert the instances in one batch and return the number of instances"""
+        with self.db.batch() as batch:
+            for instanceDataset in instanceDatasets:
+                batch.insert(instanceDataset, self.frameURL(instanceDataset))
+        return len(instanceDatasets)
+
+    def indexStudy(self, studyInstanceUID):
+        return self.indexInstances(self.studyInstances(studyInstanceUID))
+
+    #
+    # retrieval
+    #
+
+    @staticmethod
+    def urlParts(url):
+        """Returns the (study, series, instance, frame) of a frame URL"""
+        path = urllib.parse.urlparse(url).path.split("/")
+        return path[2], path[4], path[6], int(path[8])
+
+    @staticmethod
+    def framesFromDataset(ds, frames):
+        """Returns the listed frames (numbered from 1) of the dataset as one dimensional arrays"""
+        transferSyntaxUID = str(ds.file_meta.TransferSyntaxUID)
+        frameInfo = {"rows": ds.get("Rows", 0), "columns": ds.get("Columns", 0),
+                     "samplesPerPixel": ds.get("SamplesPerPixel", 1),
+                     "bitsAllocated": ds.get("BitsAllocated", 16),
+                     "bitsStored": ds.get("BitsStored", 16),
+                     "pixelRepresentation": ds.get("PixelRepresentation", 0)}
+        numberOfFrames = int(ds.get("NumberOfFrames", 1) or 1)
+        if transferSyntaxUID in (DICOMFrameDecoder.ExplicitVRLittleEndian,
+                                 DICOMDIMSEStore.ImplicitVRLittleEndian,
+                                 DICOMDIMSEStore.BigEndianTransferSyntax) \
+                and frameInfo["bitsAllocated"] % 8 == 0:
+            dtype = DICOMFrameDecoder.dtype(frameInfo)
+            if transferSyntaxUID == DICOMDIMSEStore.BigEndianTransferSyntax:
+                dtype = dtype.newbyteorder(">")
+            pixels = np.frombuffer(ds.PixelData, dtype=dtype)
+            allFrames = pixels[:pixels.size - pixels.size % numberOfFrames]
+            allFrames = allFrames.reshape(numberOfFrames, -1)
+            return [allFrames[frame-1] for frame in frames]
+        if ds.file_meta.TransferSyntaxUID.is_encapsulated:
+            if hasattr(pydicom.encaps, "generate_frames"):
+                encodedFrames = pydicom.encaps.generate_frames(ds.PixelData,
+                                                               number_of_frames=numberOfFrames)
+            else:
+                encodedFrames = pydicom.encaps.generate_pixel_data_frame(ds.PixelData,
+                                                                         numberOfFrames)
+            encodedFrames = list(encodedFrames)
+            return [DICOMFrameDecoder.decodeFrame(transferSyntaxUID,
+                                                  encodedFrames[frame-1], frameInfo)
+                    for frame in frames]
+        pixels = ds.pixel_array.reshape(numberOfFrames, -1)
+        return [pixels[frame-1] for frame in frames]
+
+    def handleStore(self, event):
+        """C-STORE sub-operation of a C-GET: pass the requested frames to the broker"""
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        sopInstanceUID = str(ds.SOPInstanceUID)
+        with self.lock:
+            _, urls = self.urlsByInstance.pop(sopInstanceUID, (None, []))
+        if not urls:
+            return 0x0000
+        try:
+            frames = DICOMDIMSEStore.framesFromDataset(
+                    ds, [DICOMDIMSEStore.urlParts(url)[3] for url in urls])
+        except Exception as error:
+            logging.error(f"Could not read frames of {sopInstanceUID}: {error}")
+            for url in urls:
+                self.broker.fail(url, error)
+            return 0x0000
+        for url,frame in zip(urls, frames):
+            self.broker.deliver(url, frame)
+        return 0x0000
+
+    def get(self, token, studyInstanceUID, seriesInstanceUID, sopInstanceUIDs):
+        """
+        Send one C-GET, then fail the frames of any instance that did not
+        arrive, other than those since requested from another C-GET
+        (identified by token)
+        """
+        identifier = pydicom.Dataset()
+        identifier.QueryRetrieveLevel = "IMAGE"
+        identifier.StudyInstanceUID = studyInstanceUID
+        identifier.SeriesInstanceUID = seriesInstanceUID
+        identifier.SOPInstanceUID = sopInstanceUIDs
+        error = None
+        try:
+            association = self.association()
+            try:
+                for status, _ in association.send_c_get(
+                        identifier, pynetdicom.sop_class.StudyRootQueryRetrieveInformationModelGet):
+                    if "Status" not in status:
+                        error = ConnectionError(f"C-GET from {self.url} failed")
+                    elif status.Status not in (0x0000, 0xFF00, 0xB000):
+                        error = RuntimeError(f"C-GET from {self.url} failed with status "
+                                             f"0x{status.Status:04X}")
+            finally:
+                self.releaseAssociation(association)
+        except Exception as caught:
+            error = caught
+        missingURLs = []
+        with self.lock:
+            for sopInstanceUID in sopInstanceUIDs:
+                getToken, urls = self.urlsByInstance.get(sopInstanceUID, (None, []))
+                if getToken is token:
+                    del self.urlsByInstance[sopInstanceUID]
+                    missingURLs += urls
+        if missingURLs:
+            logging.error(f"C-GET of {len(missingURLs)} frames from {self.url} failed: {error}")
+        for url in missingURLs:
+            self.broker.fail(url, error or LookupError(f"{url} was not sent by {self.url}"))
+
+    def requestFrames(self, urls):
+        """Start C-GETs for the frames the broker does not have on their way"""
+        instancesBySeries = {}
+        with self.lock:
+            for url in urls:
+                studyInstanceUID, seriesInstanceUID, sopInstanceUID, _ = \
+                        DICOMDIMSEStore.urlParts(url)
+                if sopInstanceUID in self.urlsByInstance:
+                    # another frame of an instance already being retrieved
+                    self.urlsByInstance[sopInstanceUID][1].append(url)
+                    continue
+                series = instancesBySeries.setdefault((studyInstanceUID, seriesInstanceUID), [])
+                series.append(sopInstanceUID)
+                self.urlsByInstance[sopInstanceUID] = (None, [url])
+            gets = []
+            for (studyInstanceUID, seriesInstanceUID),sopInstanceUIDs in instancesBySeries.items():
+                for start in range(0, len(sopInstanceUIDs), self.instancesPerGet):
+                    token = object()
+                    chunk = sopInstanceUIDs[start:start+self.instancesPerGet]
+                    for sopInstanceUID in chunk:
+                        self.urlsByInstance[sopInstanceUID] = \
+                                (token, self.urlsByInstance[sopInstanceUID][1])
+                    gets.append((token, studyInstanceUID, seriesInstanceUID, chunk))
+        for get in gets:
+            self.executor.submit(self.get, *get)
+
+    def startRequest(self, urls):
+        """
+        Retrieve frames based on URLs
+
+        The C-GETs run in the background; frames are available to
+        getFrames as their instances arrive.
+        """
+        self.requests.add(urls)
+
+    def subscribe(self, urls, callback=None):
+        """Returns a DICOMFrameSubscription to the frames of the urls"""
+        return self.broker.subscription(urls, callback)
+
+    def getFrames(self, requestedURLs):
+        """
+        Returns any available frames corresponding to requested URLs,
+        keeping the others for their requesters.
+        """
+        return self.requests.take(requestedURLs)
+
+    def requestFinished(self):
+        return self.broker.idle()
@@ -0,0 +1,326 @@
+import collections
+import concurrent.futures
+import logging
+import numpy as np
+import os
+import pathlib
+import pydicom
+import pydicom.encaps
+import time
+import urllib.parse
+import uuid
+
+from DICOMLogic.stores.DICOMFrameBroker import DICOMFrameBroker
+from DICOMLogic.stores.DICOMFrameDecoder import DICOMFrameDecoder
+from DICOMLogic.stores.DICOMStore import DICOMStore
+
+class DICOMFileStore(DICOMStore):
+    """
+    Index and load DICOM part 10 files from local directories.
+
+    Headers are read in a pool of worker processes, stopping before the
+    pixel data and parsing only the tags the database stores.  Each
+    instance is inserted with its path in Images.Filename and a file://
+    URL, optionally with a ?frame=N query for other than the first frame.
+
+    The size and modification time of every file seen is kept in a small
+    sqlite file next to the database so re-indexing only reads files
+    that are new or changed.  For an in-memory database it is kept in
+    memory too.
+
+    Frames of uncompressed files are returned as read-only views of a
+    memory map of the file, so no pixel data is copied until used.
+    Encapsulated frames are decoded with DICOMFrameDecoder.
+    """
+
+    FileIndexFileName = "DICOMFileStore.sql"
+    PixelDataTag = pydicom.tag.Tag(0x7FE00010)
+    UncompressedTransferSyntaxes = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1",
+                                    "1.2.840.10008.1.2.2")
+
+    # header lookups of files whose frames were recently requested
+    LayoutCacheSize = 1000
+
+    def __init__(self, db, fileIndexPath=None):
+        self.db = db
+        self.fileIndexAnchor = None
+        if fileIndexPath:
+            self.fileIndexPath = fileIndexPath
+        elif getattr(db, "inMemory", False):
+            self.fileIndexPath = db.MemoryDatabaseURI.format(name="DICOMFileStore",
+                                                             id=uuid.uuid4().hex)
+            self.fileIndexAnchor = db.sqliteConnection(self.fileIndexPath)
+        else:
+            self.fileIndexPath = os.path.join(db.dbDirectory, DICOMFileStore.FileIndexFileName)
+        self.broker = DICOMFrameBroker(self.requestFrames)
+        self.requests = self.broker.subscription()
+        self.layoutsByPath = collections.OrderedDict()
+        self.initializeFileIndex()
+
+    #
+    # indexing
+    #
+
+    def initializeFileIndex(self):
+        connection = self.db.sqliteConnection(self.fileIndexPath)
+        try:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS Files (Filename TEXT PRIMARY KEY,
+                                                  Size INTEGER, ModifiedTime REAL,
+                                                  SOPInstanceUID TEXT)
+            """)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def headerTags(self):
+        """The tags read from each file: everything insert can store"""
+        tags = [tag for _, tag in self.db.requiredTagPlan]
+        tags += [tag for _, tag, _ in self.db.tagCachePlan]
+        tags.append(pydicom.tag.Tag(pydicom.datadict.tag_for_keyword("NumberOfFrames")))
+        return list(dict.fromkeys(tags))
+
+    @staticmethod
+    def walk(directory):
+        """Yields (path, size, modified time) of every file in the tree"""
+        pending = [directory]
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except OSError as error:
+                logging.warning(f"Cannot read directory: {error}")
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    yield os.path.abspath(entry.path), stat.st_size, stat.st_mtime
+
+    @staticmethod
+    def readHeaders(paths, tags, db):
+        """
+        Returns (path, (datasetValues, tagCacheValues)) for each path, with
+        None for files that are not DICOM.  Runs in the worker processes,
+        so only the values to insert are sent back rather than datasets.
+        """
+        headers = []
+        for path in paths:
+            try:
+                ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=tags)
+                if "SOPInstanceUID" in ds:
+                    values = db.datasetValues(ds)
+                    header = (values, db.tagCacheValues(ds, str(values.SOPInstanceUID)))
+                else:
+                    header = None
+            except Exception as error:
+                logging.debug(f"Not indexing {path}: {error}")
+                header = None
+            headers.append((path, header))
+        return headers
+
+    @staticmethod
+    def fileURL(path, frame=1):
+        url = pathlib.Path(path).as_uri()
+        return url if frame == 1 else f"{url}?frame={frame}"
+
+    @staticmethod
+    def pathAndFrame(url):
+        """Returns (path, frame number) for a file URL"""
+        parsed = urllib.parse.urlparse(url)
+        query = urllib.parse.parse_qs(parsed.query)
+        frame = int(query.get("frame", ["1"])[0])
+        return urllib.parse.unquote(parsed.path), frame
+
+    def changedFiles(self, files):
+        """The files that are not in the file index with the same size and time"""
+        connection = self.db.sqliteConnection(self.fileIndexPath)
+        try:
+            indexed = {}
+            for filename, size, modifiedTime in connection.execute(
+                    "SELECT Filename, Size, ModifiedTime FROM Files"):
+                indexed[filename] = (size, modifiedTime)
+        finally:
+            connection.close()
+        return [(path, size, modifiedTime) for path, size, modifiedTime in files
+                if indexed.get(path) != (size, modifiedTime)]
+
+    def recordFiles(self, fileRows):
+        connection = self.db.sqliteConnection(self.fileIndexPath)
+        try:
+            connection.executemany("""
+                INSERT OR REPLACE INTO Files VALUES (?, ?, ?, ?)
+            """, fileRows)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def indexHeaders(self, headers, filesByPath):
+        """Insert one database batch of headers and record the files as indexed"""
+        fileRows = []
+        with self.db.batch() as batch:
+            for path, header in headers:
+                sopInstanceUID = None
+                if header is not None:
+                    values, cacheTagValues = header
+                    if batch.insertValues(values, cacheTagValues,
+                                          DICOMFileStore.fileURL(path), path):
+                        sopInstanceUID = str(values.SOPInstanceUID)
+                size, modifiedTime = filesByPath[path]
+                fileRows.append((path, size, modifiedTime, sopInstanceUID))
+        self.recordFiles(fileRows)
+        return len([row for row in fileRows if row[3] is not None])
+
+    def indexDirectory(self, directory, workers=None, chunkSize=64, batchSize=1000):
+        """
+        Index every DICOM file under directory, skipping files that were
+        indexed before and have not changed.  Headers are read in chunks of
+        chunkSize files by that many worker processes (one less than the
+        processors by default, 0 to read in this process) and inserted
+        batchSize at a time.
+        Returns a dictionary of counts and the elapsed time.
+        """
+        startTime = time.time()
+        files = list(DICOMFileStore.walk(directory))
+        changed = self.changedFiles(files)
+        filesByPath = {path: (size, modifiedTime) for path, size, modifiedTime in changed}
+        paths = list(filesByPath.keys())
+        chunks = [paths[start:start+chunkSize] for start in range(0, len(paths), chunkSize)]
+        tags = self.headerTags()
+
+        if workers is None:
+            # leave one processor for inserting
+            workers = (os.cpu_count() or 1) - 1
+        instanceCount = 0
+        pending = []
+        if workers == 0:
+            results = (DICOMFileStore.readHeaders(chunk, tags, self.db) for chunk in chunks)
+            executor = None
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+            results = executor.map(DICOMFileStore.readHeaders, chunks,
+                                   [tags] * len(chunks), [self.db] * len(chunks))
+        try:
+            for headers in results:
+                pending += headers
+                if len(pending) >= batchSize:
+                    instanceCount += self.indexHeaders(pending, filesByPath)
+                    pending = []
+            if pending:
+                instanceCount += self.indexHeaders(pending, filesByPath)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+        return {"files": len(files),
+                "skipped": len(files) - len(changed),
+                "read": len(changed),
+                "instances": instanceCount,
+                "seconds": time.time() - startTime}
+
+    #
+    # frame access
+    #
+
+    def pixelLayout(self, path):
+        """
+        Returns a dictionary describing where the frames of the file are:
+        transferSyntaxUID, frameInfo, numberOfFrames and, for uncompressed
+        files, the byte offset and dtype of the pixel data.
+        """
+        if path in self.layoutsByPath:
+            self.layoutsByPath.move_to_end(path)
+            return self.layoutsByPath[path]
+        # large values are left unread, recording only their file offset
+        ds = pydicom.dcmread(path, defer_size=1024)
+        transferSyntaxUID = str(ds.file_meta.TransferSyntaxUID)
+        frameInfo = {"rows": ds.get("Rows", 0), "columns": ds.get("Columns", 0),
+                     "samplesPerPixel": ds.get("SamplesPerPixel", 1),
+                     "bitsAllocated": ds.get("BitsAllocated", 16),
+                     "bitsStored": ds.get("BitsStored", 16),
+                     "pixelRepresentation": ds.get("PixelRepresentation", 0)}
+        layout = {"transferSyntaxUID": transferSyntaxUID,
+                  "frameInfo": frameInfo,
+                  "numberOfFrames": int(ds.get("NumberOfFrames", 1) or 1),
+                  "dataset": None}
+        try:
+            pixelElement = ds.get_item(DICOMFileStore.PixelDataTag, keep_deferred=True)
+        except TypeError:
+            # before pydicom 3 deferred elements were always kept raw
+            pixelElement = ds.get_item(DICOMFileStore.PixelDataTag)
+        valueOffset = getattr(pixelElement, "value_tell", None)
+        if transferSyntaxUID in DICOMFileStore.UncompressedTransferSyntaxes \
+                and frameInfo["bitsAllocated"] % 8 == 0 and valueOffset is not None:
+            dtype = DICOMFrameDecoder.dtype(frameInfo)
+            if transferSyntaxUID == "1.2.840.10008.1.2.2":
+                dtype = dtype.newbyteorder(">")
+            layout["offset"] = valueOffset
+            layout["dtype"] = dtype
+        else:
+            # encapsulated or otherwise not mappable, e.g. deflated
+            layout["dataset"] = ds
+        self.layoutsByPath[path] = layout
+        while len(self.layoutsByPath) > DICOMFileStore.LayoutCacheSize:
+            self.layoutsByPath.popitem(last=False)
+        return layout
+
+    def frameFromFile(self, path, frame):
+        layout = self.pixelLayout(path)
+        frameInfo = layout["frameInfo"]
+        numberOfFrames = layout["numberOfFrames"]
+        if frame < 1 or frame > numberOfFrames:
+            raise IndexError(f"{path} has no frame {frame}")
+        if "offset" in layout:
+            pixelsPerFrame = frameInfo["rows"] * frameInfo["columns"] * frameInfo["samplesPerPixel"]
+            frames = np.memmap(path, dtype=layout["dtype"], mode="r",
+                               offset=layout["offset"], shape=(numberOfFrames, pixelsPerFrame))
+            return frames[frame-1]
+        ds = layout["dataset"]
+        if ds.file_meta.TransferSyntaxUID.is_encapsulated:
+            if hasattr(pydicom.encaps, "generate_frames"):
+                encodedFrames = pydicom.encaps.generate_frames(ds.PixelData,
+                                                               number_of_frames=numberOfFrames)
+            else:
+                encodedFrames = pydicom.encaps.generate_pixel_data_frame(ds.PixelData,
+                                                                         numberOfFrames)
+            for index,encodedFrame in enumerate(encodedFrames):
+                if index == frame - 1:
+                    return DICOMFrameDecoder.decodeFrame(layout["transferSyntaxUID"],
+                                                         encodedFrame, frameInfo)
+        pixels = ds.pixel_array
+        if numberOfFrames > 1:
+            pixels = pixels[frame-1]
+        return pixels.reshape(-1)
+
+    def requestFrames(self, urls):
+        for url in urls:
+            path, frame = DICOMFileStore.pathAndFrame(url)
+            try:
+                frameArray = self.frameFromFile(path, frame)
+            except Exception as error:
+                logging.error(f"failed for {url}: {error}")
+                self.broker.fail(url, error)
+                continue
+            self.broker.deliver(url, frameArray)
+
+    def startRequest(self, urls):
+        """
+        Retrieve frames based on URLs
+
+        Frames are read synchronously, so they are available to
+        getFrames as soon as this returns.
+        """
+        self.requests.add(urls)
+
+    def subscribe(self, urls, callback=None):
+        """Returns a DICOMFrameSubscription to the frames of the urls, read before returning"""
+        return self.broker.subscription(urls, callback)
+
+    def getFrames(self, requestedURLs):
+        """
+        Returns any available frames corresponding to requested URLs,
+        keeping the others for their requesters.
+        """
+        return self.requests.take(requestedURLs)
+
+    def requestFinished(self):
+        return self.broker.idle()
@@ -0,0 +1,248 @@
+import asyncio
+import concurrent.futures
+import threading
+
+class DICOMFrameSubscription:
+    """
+    The frames one requester is waiting for from a DICOMFrameBroker.
+
+    Each URL is reference counted, so a URL added twice stays subscribed
+    until it has been taken or removed twice.  Frames are delivered by
+    any of:
+
+    * polling: frames() returns and removes every frame that has arrived
+      (take(urls) does the same for only some URLs)
+    * callback: callback(url, frame) is called in the delivering thread
+      (a subscription with a callback does not also buffer frames for polling)
+    * futures: future(url) returns a concurrent.futures.Future for the frame
+    * asyncio: "async for url, frame in subscription" until all have arrived
+
+    Cost is proportional to the number of frames delivered or returned.
+    """
+
+    def __init__(self, broker, callback=None):
+        self.broker = broker
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.pending = set()
+        self.ready = {}
+        self.failed = {}
+        self.futures = {}
+        self.notify = None
+
+    def add(self, urls):
+        """Subscribe to the frames of the urls, requesting the ones not yet on their way"""
+        newURLs = []
+        with self.lock:
+            for url in urls:
+                self.counts[url] = self.counts.get(url, 0) + 1
+                if url not in self.pending and url not in self.ready:
+                    self.pending.add(url)
+                    self.failed.pop(url, None)
+                    newURLs.append(url)
+        self.broker.subscribe(self, newURLs)
+        return self
+
+    def remove(self, urls=None):
+        """Drop one reference to each of the urls, or all of them"""
+        droppedURLs = []
+        with self.lock:
+            for url in list(self.counts.keys()) if urls is None else urls:
+                count = 0 if urls is None else self.counts.get(url, 0) - 1
+                if count > 0:
+                    self.counts[url] = count
+                    continue
+                self.counts.pop(url, None)
+                self.ready.pop(url, None)
+                if url in self.pending:
+                    self.pending.discard(url)
+                    droppedURLs.append(url)
+                future = self.futures.pop(url, None)
+                if future is not None:
+                    future.cancel()
+        self.broker.unsubscribe(self, droppedURLs)
+        if self.notify:
+            self.notify()
+
+    def cancel(self):
+        self.remove()
+
+    def done(self):
+        """True when every subscribed frame has arrived or failed"""
+        with self.lock:
+            return len(self.pending) == 0
+
+    #
+    # delivery, called by the broker
+    #
+
+    def deliver(self, url, frame):
+        with self.lock:
+            if url not in self.pending:
+                return
+            self.pending.discard(url)
+            if self.callback is None:
+                self.ready[url] = frame
+            else:
+                self.counts.pop(url, None)
+            future = self.futures.get(url)
+            notify = self.notify
+        if future is not None and not future.done():
+            future.set_result(frame)
+        if self.callback is not None:
+            self.callback(url, frame)
+        if notify:
+            notify()
+
+    def fail(self, url, error):
+        with self.lock:
+            if url not in self.pending:
+                return
+            self.pending.discard(url)
+            self.counts.pop(url, None)
+            self.failed[url] = error
+            future = self.futures.get(url)
+            notify = self.notify
+        if future is not None and not future.done():
+            future.set_exception(error)
+        if notify:
+            notify()
+
+    #
+    # consumption
+    #
+
+    def frames(self):
+        """Returns and removes every frame that has arrived"""
+        with self.lock:
+            ready = self.ready
+            self.ready = {}
+            for url in ready:
+                self.counts.pop(url, None)
+                self.futures.pop(url, None)
+        return ready
+
+    def take(self, urls):
+        """
+        Returns the arrived frames of the urls, removing one reference
+        to each.  The cost is proportional to the number of urls, or when
+        urls is a set to the smaller of that and the frames that have arrived.
+        """
+        framesByURL = {}
+        with self.lock:
+            if isinstance(urls, (set, frozenset, dict)) and len(self.ready) < len(urls):
+                arrived = [url for url in self.ready if url in urls]
+            else:
+                arrived = [url for url in urls if url in self.ready]
+            for url in arrived:
+                if url in framesByURL:
+                    continue
+                framesByURL[url] = self.ready[url]
+                self.counts[url] -= 1
+                if self.counts[url] <= 0:
+                    del self.counts[url]
+                    del self.ready[url]
+                    self.futures.pop(url, None)
+        return framesByURL
+
+    def future(self, url):
+        """Returns a concurrent.futures.Future for the frame of a subscribed url"""
+        with self.lock:
+            if url not in self.futures:
+                future = concurrent.futures.Future()
+                if url in self.ready:
+                    future.set_result(self.ready[url])
+                elif url in self.failed:
+                    future.set_exception(self.failed[url])
+                elif url not in self.pending:
+                    raise KeyError(f"{url} is not subscribed")
+                self.futures[url] = future
+            return self.futures[url]
+
+    def __aiter__(self):
+        return self.arrivals()
+
+    async def arrivals(self):
+        """Yields (url, frame) as frames arrive until none are pending"""
+        loop = asyncio.get_running_loop()
+        wakeups = asyncio.Queue()
+        with self.lock:
+            self.notify = lambda: loop.call_soon_threadsafe(wakeups.put_nowait, None)
+        try:
+            while True:
+                for url, frame in self.frames().items():
+                    yield url, frame
+                if self.done():
+                    for url, frame in self.frames().items():
+                        yield url, frame
+                    return
+                await wakeups.get()
+        finally:
+            with self.lock:
+                self.notify = None
+
+
+class DICOMFrameBroker:
+    """
+    Shared bookkeeping of frame requests for a DICOMStore.
+
+    Subscriptions register interest in frame URLs; a URL that is already
+    being retrieved for any subscription is not requested again.  The
+    store's requestFrames(urls) is called for the URLs that need to be
+    retrieved, and the store reports each result with deliver(url, frame)
+    or fail(url, error), from any thread.
+    """
+
+    def __init__(self, requestFrames):
+        self.requestFrames = requestFrames
+        self.lock = threading.Lock()
+        self.subscriptionsByURL = {}
+        self.inFlight = set()
+
+    def subscription(self, urls=(), callback=None):
+        """Returns a new DICOMFrameSubscription to the urls"""
+        return DICOMFrameSubscription(self, callback).add(urls)
+
+    def subscribe(self, subscription, urls):
+        toRequest = []
+        with self.lock:
+            for url in urls:
+                self.subscriptionsByURL.setdefault(url, set()).add(subscription)
+                if url not in self.inFlight:
+                    self.inFlight.add(url)
+                    toRequest.append(url)
+        if toRequest:
+            self.requestFrames(toRequest)
+
+    def unsubscribe(self, subscription, urls):
+        """
+        Frames already requested are still retrieved (the store
+        cannot cancel them) but are dropped if nobody wants them.
+        """
+        with self.lock:
+            for url in urls:
+                subscriptions = self.subscriptionsByURL.get(url)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self.subscriptionsByURL[url]
+
+    def deliver(self, url, frame):
+        with self.lock:
+            self.inFlight.discard(url)
+            subscriptions = self.subscriptionsByURL.pop(url, ())
+        for subscription in subscriptions:
+            subscription.deliver(url, frame)
+
+    def fail(self, url, error):
+        with self.lock:
+            self.inFlight.discard(url)
+            subscriptions = self.subscriptionsByURL.pop(url, ())
+        for subscription in subscriptions:
+            subscription.fail(url, error)
+
+    def idle(self):
+        """True when no requested frame is still on its way"""
+        with self.lock:
+            return len(self.inFlight) == 0
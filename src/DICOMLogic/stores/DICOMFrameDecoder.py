@@ -0,0 +1,271 @@
+import numpy as np
+import os
+import requests
+import threading
+
+try:
+    import imagecodecs
+except ModuleNotFoundError:
+    imagecodecs = None
+
+class DICOMFrameDecoder:
+    """
+    Negotiation and decoding of DICOMweb (WADO-RS) frames in compressed
+    transfer syntaxes.
+
+    JPEG-LS, JPEG 2000 and HTJ2K frames are decoded with imagecodecs when
+    it is installed, RLE Lossless is decoded here (using the imagecodecs
+    PackBits codec when available).  Deflate is negotiated at the HTTP
+    level with Content-Encoding, which both requests and Qt handle
+    transparently, so it applies to any transfer syntax.
+
+    The methods are static so that they can be run in a process pool.
+    Frame geometry comes from a frameInfo dictionary with rows, columns,
+    samplesPerPixel, bitsAllocated, bitsStored and pixelRepresentation;
+    without bitsAllocated uncompressed frames are read as int16 as before.
+    """
+
+    ExplicitVRLittleEndian = "1.2.840.10008.1.2.1"
+    RLELossless = "1.2.840.10008.1.2.5"
+
+    # frame media type of each transfer syntax, in order of preference
+    MediaTypes = {
+        "1.2.840.10008.1.2.4.201": "image/jphc",  # HTJ2K Lossless
+        "1.2.840.10008.1.2.4.202": "image/jphc",  # HTJ2K Lossless RPCL
+        "1.2.840.10008.1.2.4.80": "image/jls",    # JPEG-LS Lossless
+        "1.2.840.10008.1.2.4.90": "image/jp2",    # JPEG 2000 Lossless
+        "1.2.840.10008.1.2.5": "image/dicom-rle", # RLE Lossless
+        "1.2.840.10008.1.2.4.203": "image/jphc",  # HTJ2K
+        "1.2.840.10008.1.2.4.81": "image/jls",    # JPEG-LS Near-Lossless
+        "1.2.840.10008.1.2.4.91": "image/jp2",    # JPEG 2000
+        "1.2.840.10008.1.2.1": "application/octet-stream",
+    }
+
+    # transfer syntax assumed for parts without a transfer-syntax parameter
+    DefaultTransferSyntaxes = {
+        "image/jphc": "1.2.840.10008.1.2.4.201",
+        "image/jls": "1.2.840.10008.1.2.4.80",
+        "image/jp2": "1.2.840.10008.1.2.4.90",
+        "image/dicom-rle": "1.2.840.10008.1.2.5",
+        "application/octet-stream": "1.2.840.10008.1.2.1",
+    }
+
+    # short names that can be used instead of transfer syntax UIDs
+    Names = {
+        "htj2k": ["1.2.840.10008.1.2.4.201", "1.2.840.10008.1.2.4.202", "1.2.840.10008.1.2.4.203"],
+        "jpegls": ["1.2.840.10008.1.2.4.80", "1.2.840.10008.1.2.4.81"],
+        "jpeg2000": ["1.2.840.10008.1.2.4.90", "1.2.840.10008.1.2.4.91"],
+        "rle": ["1.2.840.10008.1.2.5"],
+        "uncompressed": ["1.2.840.10008.1.2.1"],
+    }
+
+    threadState = threading.local()
+
+    #
+    # negotiation
+    #
+
+    @staticmethod
+    def decoders():
+        """Returns the decoding function of each transfer syntax that can be decoded"""
+        decoders = {
+            DICOMFrameDecoder.ExplicitVRLittleEndian: DICOMFrameDecoder.decodeUncompressed,
+            DICOMFrameDecoder.RLELossless: DICOMFrameDecoder.decodeRLE,
+        }
+        if imagecodecs is not None:
+            codecs = {"jpegls": ("JPEGLS", "jpegls_decode"),
+                      "jpeg2000": ("JPEG2K", "jpeg2k_decode"),
+                      "htj2k": ("HTJ2K", "htj2k_decode")}
+            for name,(codecName,functionName) in codecs.items():
+                codec = getattr(imagecodecs, codecName, None)
+                if codec is not None and codec.available:
+                    for transferSyntaxUID in DICOMFrameDecoder.Names[name]:
+                        decoders[transferSyntaxUID] = getattr(imagecodecs, functionName)
+        return decoders
+
+    @staticmethod
+    def transferSyntaxUIDs(transferSyntaxes):
+        """
+        Expand names like "jpegls" into transfer syntax UIDs and drop the ones
+        that cannot be decoded here.  Explicit VR Little Endian is always
+        included last so every server has something to send.
+        """
+        decoders = DICOMFrameDecoder.decoders()
+        requested = []
+        for transferSyntax in transferSyntaxes:
+            requested += DICOMFrameDecoder.Names.get(transferSyntax, [transferSyntax])
+        uids = []
+        for uid in requested + [DICOMFrameDecoder.ExplicitVRLittleEndian]:
+            if uid in decoders and uid not in uids:
+                uids.append(uid)
+        if DICOMFrameDecoder.ExplicitVRLittleEndian in uids:
+            uids.remove(DICOMFrameDecoder.ExplicitVRLittleEndian)
+            uids.append(DICOMFrameDecoder.ExplicitVRLittleEndian)
+        return uids
+
+    @staticmethod
+    def acceptHeader(transferSyntaxUIDs):
+        """Accept header for frames in any of the transfer syntaxes, most preferred first"""
+        mediaRanges = []
+        count = len(transferSyntaxUIDs)
+        for index,uid in enumerate(transferSyntaxUIDs):
+            mediaType = DICOMFrameDecoder.MediaTypes[uid]
+            quality = round(1 - index / max(count, 2), 2)
+            mediaRanges.append(f'multipart/related; type="{mediaType}"; '
+                               f'transfer-syntax={uid}; q={quality}')
+        return ", ".join(mediaRanges)
+
+    #
+    # response parsing
+    #
+
+    @staticmethod
+    def contentTypeParameters(contentType):
+        """Returns (media type, parameters) of a Content-Type header value"""
+        fields = contentType.split(";")
+        parameters = {}
+        for field in fields[1:]:
+            if "=" in field:
+                name, value = field.split("=", 1)
+                parameters[name.strip().lower()] = value.strip().strip('"')
+        return fields[0].strip().lower(), parameters
+
+    @staticmethod
+    def framePart(content, contentType=""):
+        """
+        Returns (transfer syntax UID, frame bytes) from the body of a
+        frames response, which is normally a single part multipart/related
+        message but may also be the bare frame.
+        """
+        mediaType, parameters = DICOMFrameDecoder.contentTypeParameters(contentType)
+        if content.startswith(b"--") or mediaType.startswith("multipart/"):
+            delimiter = content[:content.find(b"\r\n")]
+            headerEnd = content.find(b"\r\n\r\n")
+            frameStart = headerEnd + 4
+            frameEnd = content.rfind(b"\r\n" + delimiter)
+            if headerEnd < 0 or frameEnd < frameStart:
+                raise ValueError("Malformed multipart frame response")
+            for header in content[len(delimiter):headerEnd].split(b"\r\n"):
+                name, _, value = header.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-type":
+                    mediaType, parameters = DICOMFrameDecoder.contentTypeParameters(value)
+            content = content[frameStart:frameEnd]
+        transferSyntaxUID = parameters.get("transfer-syntax")
+        if transferSyntaxUID is None:
+            transferSyntaxUID = DICOMFrameDecoder.DefaultTransferSyntaxes.get(
+                    mediaType, DICOMFrameDecoder.ExplicitVRLittleEndian)
+        return transferSyntaxUID, content
+
+    #
+    # decoding
+    #
+
+    @staticmethod
+    def dtype(frameInfo):
+        bitsAllocated = frameInfo.get("bitsAllocated")
+        if not bitsAllocated:
+            return np.dtype("int16")
+        signed = frameInfo.get("pixelRepresentation") == 1
+        kind = "i" if signed else "u"
+        return np.dtype(f"<{kind}{max(1, bitsAllocated // 8)}")
+
+    @staticmethod
+    def decodeUncompressed(frameContent, frameInfo):
+        if frameInfo.get("bitsAllocated") == 1:
+            bits = np.unpackbits(np.frombuffer(frameContent, dtype="uint8"), bitorder="little")
+            pixelCount = frameInfo.get("rows", 0) * frameInfo.get("columns", 0)
+            return bits[:pixelCount] if pixelCount else bits
+        return np.frombuffer(frameContent, dtype=DICOMFrameDecoder.dtype(frameInfo))
+
+    @staticmethod
+    def packBitsDecode(segment):
+        if imagecodecs is not None and imagecodecs.PACKBITS.available:
+            return imagecodecs.packbits_decode(segment)
+        decoded = bytearray()
+        index = 0
+        while index < len(segment):
+            header = segment[index]
+            index += 1
+            if header < 128:
+                decoded += segment[index:index + header + 1]
+                index += header + 1
+            elif header > 128:
+                decoded += segment[index:index+1] * (257 - header)
+                index += 1
+        return bytes(decoded)
+
+    @staticmethod
+    def decodeRLE(frameContent, frameInfo):
+        """
+        RLE Lossless (PS3.5 Annex G): a 64 byte header of segment offsets
+        followed by one PackBits segment per byte of each sample, most
+        significant byte first.  Returns pixel interleaved samples.
+        """
+        header = np.frombuffer(frameContent[:64], dtype="<u4")
+        segmentCount = int(header[0])
+        offsets = [int(offset) for offset in header[1:1+segmentCount]] + [len(frameContent)]
+        samplesPerPixel = frameInfo.get("samplesPerPixel") or 1
+        dtype = DICOMFrameDecoder.dtype(frameInfo)
+        if segmentCount != samplesPerPixel * dtype.itemsize:
+            raise ValueError(f"{segmentCount} RLE segments do not match frame info {frameInfo}")
+        pixelCount = frameInfo.get("rows", 0) * frameInfo.get("columns", 0)
+        segments = []
+        for index in range(segmentCount):
+            segment = DICOMFrameDecoder.packBitsDecode(frameContent[offsets[index]:offsets[index+1]])
+            segment = np.frombuffer(segment, dtype="uint8")
+            segments.append(segment[:pixelCount] if pixelCount else segment)
+        # (samples, bytes most significant first, pixels) -> little endian pixels
+        planes = np.stack(segments).reshape(samplesPerPixel, dtype.itemsize, -1)
+        interleaved = np.ascontiguousarray(planes[:, ::-1, :].transpose(2, 0, 1))
+        return interleaved.view(dtype).reshape(-1)
+
+    @staticmethod
+    def signed(frame, frameInfo):
+        """Sign extend samples that a codec returned as unsigned"""
+        if frameInfo.get("pixelRepresentation") != 1 or frame.dtype.kind != "u":
+            return frame
+        bitsStored = frameInfo.get("bitsStored") or frame.dtype.itemsize * 8
+        signedFrame = frame.astype(f"i{frame.dtype.itemsize}")
+        if bitsStored < frame.dtype.itemsize * 8:
+            shift = frame.dtype.itemsize * 8 - bitsStored
+            signedFrame = (signedFrame << shift) >> shift
+        return signedFrame
+
+    @staticmethod
+    def decode(content, frameInfo={}, contentType=""):
+        """Returns the frame in a frames response as a one dimensional array"""
+        transferSyntaxUID, frameContent = DICOMFrameDecoder.framePart(content, contentType)
+        return DICOMFrameDecoder.decodeFrame(transferSyntaxUID, frameContent, frameInfo)
+
+    @staticmethod
+    def decodeFrame(transferSyntaxUID, frameContent, frameInfo={}):
+        """Returns the encoded frame bytes as a one dimensional array"""
+        decoders = DICOMFrameDecoder.decoders()
+        if transferSyntaxUID not in decoders:
+            raise ValueError(f"No decoder for transfer syntax {transferSyntaxUID}")
+        decoder = decoders[transferSyntaxUID]
+        if decoder in (DICOMFrameDecoder.decodeUncompressed, DICOMFrameDecoder.decodeRLE):
+            frame = decoder(frameContent, frameInfo)
+        else:
+            frame = DICOMFrameDecoder.signed(np.asarray(decoder(frameContent)), frameInfo)
+        return frame.reshape(-1)
+
+    @staticmethod
+    def session():
+        """
+        A requests session per thread (and so per worker) to reuse connections.
+        Forked worker processes must not share the parent's connections.
+        """
+        threadState = DICOMFrameDecoder.threadState
+        if getattr(threadState, "pid", None) != os.getpid():
+            threadState.session = requests.Session()
+            threadState.pid = os.getpid()
+        return threadState.session
+
+    @staticmethod
+    def fetch(url, headers, frameInfo={}):
+        """Retrieve and decode one frame, for use without Qt"""
+        response = DICOMFrameDecoder.session().get(url, headers=headers)
+        response.raise_for_status()
+        return DICOMFrameDecoder.decode(response.content, frameInfo,
+                                        response.headers.get("Content-Type", ""))
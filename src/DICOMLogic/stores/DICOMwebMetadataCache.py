@@ -0,0 +1,216 @@
+import collections
+import gzip
+import hashlib
+import json
+import os
+import requests
+import threading
+import time
+
+import DICOMLogic
+
+class DICOMwebMetadataCache:
+    """
+    Cache of DICOMweb series metadata (the json from .../series/{uid}/metadata)
+    organized by SOPInstanceUID.
+
+    Lookups are answered from memory (the most recently used series),
+    then from gzip compressed files in an optional on-disk directory that
+    persists across processes and restarts, and only then from the network.
+    On-disk entries older than ttl seconds are revalidated with the server
+    using their ETag or Last-Modified header, and the least recently used
+    entries are evicted when the directory grows beyond maxBytes.
+
+    One cache can be shared by several DICOMwebStores.
+
+    bytesSaved counts the size of each series metadata loaded from disk,
+    fresh or revalidated, instead of being fetched from the network.
+    """
+
+    def __init__(self, directory=None, maxBytes=2**30, ttl=24*60*60, memorySeries=100):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.memorySeries = memorySeries
+        self.lock = threading.RLock()
+        self.instanceMetadataBySeriesURL = collections.OrderedDict()
+        self.diskBytes = None
+        self.statistics = {
+            "tagCacheHits": 0,
+            "memoryHits": 0,
+            "diskHits": 0,
+            "revalidations": 0,
+            "networkFetches": 0,
+            "bytesFromNetwork": 0,
+            "bytesSaved": 0,
+        }
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.statistics[key] += amount
+
+    def hitRatio(self):
+        """Fraction of lookups answered without a network request"""
+        hits = self.statistics["tagCacheHits"] + self.statistics["memoryHits"] \
+                + self.statistics["diskHits"]
+        lookups = hits + self.statistics["networkFetches"]
+        return hits / lookups if lookups else 0
+
+    def report(self):
+        statistics = dict(self.statistics)
+        statistics["hitRatio"] = round(self.hitRatio(), 3)
+        return statistics
+
+    #
+    # on-disk tier
+    #
+
+    def entryPaths(self, seriesURL):
+        key = hashlib.sha1(seriesURL.encode()).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path + ".json.gz", path + ".info"
+
+    def readEntry(self, seriesURL):
+        """Returns (content, info) from disk, or (None, None)"""
+        contentPath, infoPath = self.entryPaths(seriesURL)
+        try:
+            with open(infoPath) as fp:
+                info = json.load(fp)
+            with open(contentPath, "rb") as fp:
+                content = gzip.decompress(fp.read())
+        except (OSError, ValueError):
+            return None, None
+        if info.get("url") != seriesURL:
+            return None, None
+        return content, info
+
+    def writeEntry(self, seriesURL, content, info):
+        contentPath, infoPath = self.entryPaths(seriesURL)
+        compressed = gzip.compress(content)
+        try:
+            replacedBytes = os.path.getsize(contentPath)
+        except OSError:
+            replacedBytes = 0
+        # write to temporary files and rename so concurrent readers
+        # in other processes never see partial entries
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(contentPath + suffix, "wb") as fp:
+            fp.write(compressed)
+        with open(infoPath + suffix, "w") as fp:
+            json.dump(info, fp)
+        os.replace(contentPath + suffix, contentPath)
+        os.replace(infoPath + suffix, infoPath)
+        with self.lock:
+            if self.diskBytes is not None:
+                self.diskBytes += len(compressed) - replacedBytes
+        self.evict()
+
+    def touchEntry(self, seriesURL, info=None):
+        contentPath, infoPath = self.entryPaths(seriesURL)
+        if info is not None:
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(infoPath + suffix, "w") as fp:
+                json.dump(info, fp)
+            os.replace(infoPath + suffix, infoPath)
+        try:
+            os.utime(contentPath)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove least recently used entries while over maxBytes"""
+        with self.lock:
+            if self.diskBytes is not None and self.diskBytes <= self.maxBytes:
+                return
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json.gz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            self.diskBytes = sum([size for _, size, _ in entries])
+            entries.sort()
+            while self.diskBytes > self.maxBytes and entries:
+                _, size, contentPath = entries.pop(0)
+                infoPath = contentPath[:-len(".json.gz")] + ".info"
+                for path in (contentPath, infoPath):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.diskBytes -= size
+
+    #
+    # lookup
+    #
+
+    def fetch(self, seriesURL, headers, info=None):
+        """
+        Request the series metadata, conditionally if info from a previous
+        response is given.  Returns (content, info), with content None
+        if the server reports the cached copy is still valid.
+        """
+        requestHeaders = dict(headers)
+        if info is not None:
+            if info.get("etag"):
+                requestHeaders["If-None-Match"] = info["etag"]
+            if info.get("lastModified"):
+                requestHeaders["If-Modified-Since"] = info["lastModified"]
+        response = requests.get(seriesURL, headers=requestHeaders)
+        if info is not None and response.status_code == 304:
+            info["fetched"] = time.time()
+            return None, info
+        response.raise_for_status()
+        content = response.content
+        self.count("networkFetches")
+        self.count("bytesFromNetwork", len(content))
+        info = {"url": seriesURL,
+                "etag": response.headers.get("ETag"),
+                "lastModified": response.headers.get("Last-Modified"),
+                "fetched": time.time(),
+                "bytes": len(content)}
+        return content, info
+
+    def seriesContent(self, seriesURL, headers):
+        """Returns the raw json content of the series metadata"""
+        if self.directory:
+            content, info = self.readEntry(seriesURL)
+            if content is not None:
+                if time.time() - info.get("fetched", 0) < self.ttl:
+                    self.count("diskHits")
+                    self.count("bytesSaved", len(content))
+                    self.touchEntry(seriesURL)
+                    return content
+                self.count("revalidations")
+                newContent, newInfo = self.fetch(seriesURL, headers, info)
+                if newContent is None:
+                    self.count("diskHits")
+                    self.count("bytesSaved", len(content))
+                    self.touchEntry(seriesURL, newInfo)
+                    return content
+                self.writeEntry(seriesURL, newContent, newInfo)
+                return newContent
+        content, info = self.fetch(seriesURL, headers)
+        if self.directory:
+            self.writeEntry(seriesURL, content, info)
+        return content
+
+    def seriesMetadata(self, seriesURL, headers={}):
+        """Returns the instance json metadata of the series by SOPInstanceUID"""
+        with self.lock:
+            if seriesURL in self.instanceMetadataBySeriesURL:
+                self.instanceMetadataBySeriesURL.move_to_end(seriesURL)
+                self.count("memoryHits")
+                return self.instanceMetadataBySeriesURL[seriesURL]
+        seriesMetadata = json.loads(self.seriesContent(seriesURL, headers))
+        tag = DICOMLogic.databases.DICOMDatabase.dicomTagNoComma("SOPInstanceUID")
+        instanceMetadataByUID = {}
+        for metadata in seriesMetadata:
+            instanceUID = metadata[tag]["Value"][0]
+            instanceMetadataByUID[instanceUID] = metadata
+        with self.lock:
+            self.instanceMetadataBySeriesURL[seriesURL] = instanceMetadataByUID
+            while len(self.instanceMetadataBySeriesURL) > self.memorySeries:
+                self.instanceMetadataBySeriesURL.popitem(last=False)
+        return instanceMetadataByUID
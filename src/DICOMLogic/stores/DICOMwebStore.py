@@ -1,9 +1,9 @@
-import functools
+import concurrent.futures
 import json
 import logging
-import numpy as np
 import pydicom
 import requests
+import threading
 
 try:
     import qt
@@ -11,15 +11,77 @@ except ModuleNotFoundError:
     pass
 
 import DICOMLogic
+from DICOMLogic.stores.DICOMFrameBroker import DICOMFrameBroker
+from DICOMLogic.stores.DICOMFrameDecoder import DICOMFrameDecoder
 from DICOMLogic.stores.DICOMStore import DICOMStore
+from DICOMLogic.stores.DICOMwebMetadataCache import DICOMwebMetadataCache
 
 class DICOMwebStore(DICOMStore):
+    """
+    transferSyntaxes is an optional list of transfer syntax UIDs or names
+    (see DICOMFrameDecoder.Names) to request frames in, most preferred first.
+    Only the ones that can be decoded with the installed codecs are sent
+    in the Accept header, followed by Explicit VR Little Endian.
 
-    def __init__(self, db, url, headers={}):
+    With decodeWorkers, frames are decoded (and without Qt also retrieved)
+    in a pool of that many threads or, if decodeExecutor is "process",
+    processes, so decoding does not hold up the network or the caller.
+
+    Frames are retrieved through a DICOMFrameBroker, so a frame already on
+    its way is not requested again.  Besides startRequest and getFrames,
+    subscribe returns a DICOMFrameSubscription that delivers frames to a
+    callback, futures or an async iterator.
+
+    With minimalMetadata, studies are indexed from a QIDO-RS instance query
+    asking only for the fields the database stores (see indexFields)
+    rather than from the full WADO-RS metadata, in pages of queryPageSize
+    instances.  Other tags are read by fileValue from the series metadata,
+    which is then fetched when first needed.  Servers may return only some
+    of the fields, so tags missing from the results are not cached as
+    absent, and a series with instances missing any ExpectedFields is
+    indexed from its series metadata instead.
+    """
+
+    FrameInfoTags = {"rows": "0028,0010", "columns": "0028,0011",
+                     "samplesPerPixel": "0028,0002", "bitsAllocated": "0028,0100",
+                     "bitsStored": "0028,0101", "pixelRepresentation": "0028,0103"}
+
+    # indexed tags every instance has in practice, and those every image
+    # has, so a QIDO-RS result without one was left incomplete by the server
+    ExpectedFields = ["PatientName", "PatientID", "StudyInstanceUID",
+                      "SeriesInstanceUID", "Modality", "SOPInstanceUID"]
+    ExpectedImageFields = ["Rows", "Columns", "SamplesPerPixel", "BitsAllocated",
+                           "BitsStored", "PixelRepresentation"]
+    NonImageModalities = ("SR", "KO", "PR", "DOC")
+
+    def __init__(self, db, url, headers={}, metadataCache=None,
+                 transferSyntaxes=None, decodeWorkers=0, decodeExecutor="thread",
+                 minimalMetadata=False, queryPageSize=1000):
         self.db = db
         self.url = url
         self.headers = headers
-        self.framesByURL = {}
+        self.minimalMetadata = minimalMetadata
+        self.queryPageSize = queryPageSize
+        self.metadataCache = metadataCache or DICOMwebMetadataCache()
+        self.broker = DICOMFrameBroker(self.requestFrames)
+        self.requests = self.broker.subscription()
+        self.acceptHeader = None
+        if transferSyntaxes:
+            self.transferSyntaxUIDs = DICOMFrameDecoder.transferSyntaxUIDs(transferSyntaxes)
+            self.acceptHeader = DICOMFrameDecoder.acceptHeader(self.transferSyntaxUIDs)
+        else:
+            self.transferSyntaxUIDs = [DICOMFrameDecoder.ExplicitVRLittleEndian]
+        self.lock = threading.Lock()
+        self.pendingDecodes = {}
+        self.failedURLs = []
+        self.decodeExecutor = None
+        if decodeWorkers:
+            if decodeExecutor == "process":
+                self.decodeExecutor = concurrent.futures.ProcessPoolExecutor(decodeWorkers)
+            elif decodeExecutor == "thread":
+                self.decodeExecutor = concurrent.futures.ThreadPoolExecutor(decodeWorkers)
+            else:
+                raise ValueError(f"Unknown decodeExecutor {decodeExecutor}")
         try:
             import qt
             self.networkAccessManager = qt.QNetworkAccessManager()
@@ -28,49 +90,237 @@ class DICOMwebStore(DICOMStore):
             self.http2Allowed = True
             self._haveQT = True
         except ModuleNotFoundError:
-            self._haveQT = True
+            self._haveQT = False
 
-    def indexInstance(self, instanceDataset):
+    def shutdown(self):
+        """Stop the decoding workers, if any"""
+        if self.decodeExecutor:
+            self.decodeExecutor.shutdown(cancel_futures=True)
+            self.decodeExecutor = None
+
+    def indexInstance(self, instanceDataset, batch=None, cacheAbsentTags=True):
+        """Insert into the batch if given, else into the db's current batch"""
         frameURL = f"{self.url}/studies/{instanceDataset.StudyInstanceUID}"
         frameURL += f"/series/{instanceDataset.SeriesInstanceUID}"
         frameURL += f"/instances/{instanceDataset.SOPInstanceUID}/frames/1"
-        self.db.insert(instanceDataset, frameURL)
+        (batch or self.db).insert(instanceDataset, frameURL, cacheAbsentTags=cacheAbsentTags)
 
-    def indexStudy(self, studyInstanceUID):
+    def studyInstanceUIDs(self, limit=100, offset=0):
         """
-        TODO: headers
-        studyMetadataRequest = requests.get(metadataRequest, headers=self.headers)
+        Returns one page of StudyInstanceUIDs from a QIDO-RS study query.
+        An empty list means there are no more studies.
         """
-        self.db.startBatchInsert()
+        studiesURL = f"{self.url}/studies?limit={limit}&offset={offset}"
+        studiesRequest = requests.get(studiesURL, headers=self.headers)
+        studiesRequest.raise_for_status()
+        if studiesRequest.content == b'':
+            return []
+        studyInstanceUIDs = []
+        for study in json.loads(studiesRequest.content):
+            studyDataset = pydicom.Dataset.from_json(study)
+            studyInstanceUIDs.append(studyDataset.StudyInstanceUID)
+        return studyInstanceUIDs
+
+    def studyMetadata(self, studyInstanceUID):
+        """Returns the WADO-RS json metadata of every instance in the study"""
         metadataRequest = f"{self.url}/studies/{studyInstanceUID}/metadata"
         studyMetadataRequest = requests.get(metadataRequest, headers=self.headers)
-        studyMetadata = json.loads(studyMetadataRequest.content)
-        for instanceData in studyMetadata:
-            instanceDataset = pydicom.Dataset.from_json(instanceData)
-            self.indexInstance(instanceDataset)
-        self.db.endBatchInsert()
-
-    def frameFromReplyContent(self, url, content):
-        delimiter = b"\r\n\r\n"
-        frameStart = content.find(delimiter) + len(delimiter)
-        delimiter = b"\r\n"
-        frameEnd = content.rfind(delimiter, 0, content.rfind(delimiter))
-        frameContent = content[frameStart:frameEnd]
+        studyMetadataRequest.raise_for_status()
+        return json.loads(studyMetadataRequest.content)
+
+    def indexFields(self):
+        """
+        The tags the database stores for each instance, as QIDO-RS
+        includefield values: the RequiredTags, the tags to precache
+        and the ExtraKeys
+        """
+        if hasattr(self.db, "requiredTagPlan"):
+            tags = [tag for _, tag in self.db.requiredTagPlan]
+            tags += [tag for _, tag, _ in self.db.tagCachePlan]
+        else:
+            keywords = DICOMLogic.databases.ctkSQLite.RequiredTags \
+                        + DICOMLogic.databases.ctkSQLite.ExtraKeys
+            tags = [pydicom.tag.Tag(keyword) for keyword in keywords]
+        return [f"{tag:08X}" for tag in dict.fromkeys(tags)]
+
+    def studyInstances(self, studyInstanceUID, fields, limit=1000, offset=0):
+        """
+        Returns one page of the QIDO-RS json of the study's instances with
+        the given fields.  An empty list means there are no more instances.
+        """
+        instancesURL = f"{self.url}/studies/{studyInstanceUID}/instances"
+        parameters = [("includefield", field) for field in fields]
+        parameters += [("limit", limit), ("offset", offset)]
+        instancesRequest = requests.get(instancesURL, params=parameters, headers=self.headers)
+        instancesRequest.raise_for_status()
+        if instancesRequest.content == b'':
+            return []
+        return json.loads(instancesRequest.content)
+
+    def studyIndexFields(self, studyInstanceUID):
+        """
+        Returns the QIDO-RS json of every instance in the study with only
+        the indexFields, querying a page at a time until one has no new
+        instances (servers may return fewer than the limit per page, or
+        ignore the offset).  Instances of series the server left fields
+        out of are replaced by their series metadata.
+        """
+        fields = self.indexFields()
+        sopInstanceUIDTag = DICOMLogic.databases.DICOMDatabase.dicomTagNoComma("SOPInstanceUID")
+        instancesByUID = {}
+        while True:
+            page = self.studyInstances(studyInstanceUID, fields,
+                                       limit=self.queryPageSize, offset=len(instancesByUID))
+            pageCount = len(instancesByUID)
+            for instance in page:
+                instanceUID = instance.get(sopInstanceUIDTag, {}).get("Value", [None])[0]
+                instancesByUID.setdefault(instanceUID, instance)
+            if len(instancesByUID) == pageCount:
+                break
+        instances = list(instancesByUID.values())
+        for seriesInstanceUID in self.incompleteSeries(instances, fields):
+            seriesURL = f"{self.url}/studies/{studyInstanceUID}/series/{seriesInstanceUID}/metadata"
+            instanceMetadataByUID = self.seriesMetadata(seriesURL)
+            for index,instance in enumerate(instances):
+                instanceUID = instance.get(sopInstanceUIDTag, {}).get("Value", [None])[0]
+                if instanceUID in instanceMetadataByUID:
+                    instances[index] = dict(instance, **instanceMetadataByUID[instanceUID])
+        return instances
+
+    def incompleteSeries(self, instances, fields):
+        """
+        The SeriesInstanceUIDs of the QIDO-RS instances that are missing
+        any of the ExpectedFields asked for in fields
+        """
+        requested = set(fields)
+        tagOf = DICOMLogic.databases.DICOMDatabase.dicomTagNoComma
+        expected = [tagOf(keyword) for keyword in DICOMwebStore.ExpectedFields]
+        expected = [tag for tag in expected if tag in requested]
+        expectedImage = [tagOf(keyword) for keyword in DICOMwebStore.ExpectedImageFields]
+        expectedImage = expected + [tag for tag in expectedImage if tag in requested]
+        modalityTag = tagOf("Modality")
+        seriesTag = tagOf("SeriesInstanceUID")
+        seriesInstanceUIDs = set()
+        for instance in instances:
+            modality = instance.get(modalityTag, {}).get("Value", [""])[0]
+            tags = expected if modality in DICOMwebStore.NonImageModalities else expectedImage
+            seriesInstanceUID = instance.get(seriesTag, {}).get("Value", [None])[0]
+            if seriesInstanceUID and any([tag not in instance for tag in tags]):
+                seriesInstanceUIDs.add(seriesInstanceUID)
+        return seriesInstanceUIDs
+
+    def studyIndexMetadata(self, studyInstanceUID):
+        """The json to index the study from, as chosen by minimalMetadata"""
+        if self.minimalMetadata:
+            return self.studyIndexFields(studyInstanceUID)
+        return self.studyMetadata(studyInstanceUID)
+
+    def indexStudyMetadata(self, studyMetadata):
+        """
+        Insert the instances described by the study metadata (or
+        QIDO-RS instance results) and return the number of instances.
+        With minimalMetadata, tags missing from an instance are not
+        cached, so fileValue looks them up in the series metadata.
+        """
+        with self.db.batch() as batch:
+            for instanceData in studyMetadata:
+                instanceDataset = pydicom.Dataset.from_json(instanceData)
+                self.indexInstance(instanceDataset, batch,
+                                   cacheAbsentTags=not self.minimalMetadata)
+        return len(studyMetadata)
+
+    def indexStudy(self, studyInstanceUID):
+        return self.indexStudyMetadata(self.studyIndexMetadata(studyInstanceUID))
+
+    def frameHeaders(self):
+        """The current headers plus the negotiated Accept header"""
+        headers = dict(self.headers)
+        if self.acceptHeader:
+            headers["Accept"] = self.acceptHeader
+        return headers
+
+    def frameInfo(self, url):
+        """Frame geometry and sample type of the instance from the TagCache"""
+        if not hasattr(self.db, "instanceValues"):
+            return {}
+        instanceUID = url[url.find("instances/"):].split("/")[1]
+        values = self.db.instanceValues(instanceUID, DICOMwebStore.FrameInfoTags.values())
+        frameInfo = {}
+        for key,tag in DICOMwebStore.FrameInfoTags.items():
+            try:
+                frameInfo[key] = int(values[tag])
+            except (KeyError, ValueError):
+                pass
+        return frameInfo
+
+    def frameFromReplyContent(self, url, content, contentType=""):
         try:
-            frame = np.frombuffer(frameContent, dtype='int16')
-            self.framesByURL[url] = frame
-            return True
-        except ValueError:
+            frame = DICOMFrameDecoder.decode(content, self.frameInfo(url), contentType)
+        except ValueError as error:
+            logging.debug(f"Could not decode {url}: {error}")
             return False
+        self.broker.deliver(url, frame)
+        return True
+
+    def submitDecode(self, url, function, *args):
+        """Run the fetch or decode function in the pool, collecting the frame when done"""
+        future = self.decodeExecutor.submit(function, *args)
+        with self.lock:
+            self.pendingDecodes[future] = url
+        future.add_done_callback(self.decodeFinished)
+
+    def decodeFinished(self, future):
+        with self.lock:
+            url = self.pendingDecodes.pop(future, None)
+        if url is None or future.cancelled():
+            return
+        try:
+            frame = future.result()
+        except Exception as error:
+            logging.debug(f"Failed to retrieve {url}: {error}")
+            if self._haveQT:
+                with self.lock:
+                    self.failedURLs.append(url)
+            else:
+                print(f"failed for {url}")
+                self.broker.fail(url, error)
+            return
+        self.broker.deliver(url, frame)
+
+    def retryFailed(self):
+        """Resend Qt requests that failed to decode, from the calling thread"""
+        with self.lock:
+            failedURLs = self.failedURLs
+            self.failedURLs = []
+        for url in failedURLs:
+            logging.debug(f"Resending request for {url}")
+            self.makeQtRequest(url)
 
     def makeQtRequest(self, url):
         request = qt.QNetworkRequest(qt.QUrl(url))
         request.setAttribute(request.HTTP2AllowedAttribute, self.http2Allowed)
-        for name,value in self.headers.items():
+        for name,value in self.frameHeaders().items():
             request.setRawHeader(name, value)
         reply = self.networkAccessManager.get(request)
         self.urlsByReply[reply] = url
 
+    def requestFrames(self, urls):
+        """Send the requests for the frames the broker does not have on their way"""
+        for url in urls:
+            if self._haveQT:
+                self.makeQtRequest(url)
+            elif self.decodeExecutor:
+                self.submitDecode(url, DICOMFrameDecoder.fetch,
+                                  url, self.frameHeaders(), self.frameInfo(url))
+            else:
+                try:
+                    frame = DICOMFrameDecoder.fetch(url, self.frameHeaders(), self.frameInfo(url))
+                except (requests.RequestException, ValueError) as error:
+                    print(f"failed for {url}")
+                    self.broker.fail(url, error)
+                    continue
+                self.broker.deliver(url, frame)
+
     def startRequest(self, urls):
         """
         Retrieve frames based on URLs
@@ -78,16 +328,14 @@ class DICOMwebStore(DICOMStore):
         urls must all be from the same data store, study, and series.  I.e.
         same image set.
         """
-        for url in urls:
-            if self._haveQT:
-                self.makeQtRequest(url)
-            else:
-                urlResponse = requests.get(url, headers=self.headers)
-                content = urlResponse.content
-                try:
-                    self.frameFromReplyContent(url, content)
-                except:
-                    print(f"failed for {url}")
+        self.requests.add(urls)
+
+    def subscribe(self, urls, callback=None):
+        """
+        Returns a DICOMFrameSubscription to the frames of the urls.
+        Without Qt, frames retrieved synchronously arrive before this returns.
+        """
+        return self.broker.subscription(urls, callback)
 
     def handleQtReply(self, reply):
         if reply in self.urlsByReply:
@@ -96,7 +344,11 @@ class DICOMwebStore(DICOMStore):
             url = self.urlsByReply[reply]
             del(self.urlsByReply[reply])
             content = reply.readAll().data()
-            if not self.frameFromReplyContent(url, content):
+            contentType = str(reply.header(qt.QNetworkRequest.ContentTypeHeader) or "")
+            if self.decodeExecutor:
+                self.submitDecode(url, DICOMFrameDecoder.decode,
+                                  content, self.frameInfo(url), contentType)
+            elif not self.frameFromReplyContent(url, content, contentType):
                 logging.debug(f"Resending request for {url}")
                 self.makeQtRequest(url)
 
@@ -105,57 +357,61 @@ class DICOMwebStore(DICOMStore):
         Returns any available frames corresponding to requested URLs.
         Because the frames may have been requested by multiple requesters,
         only return the frames corresponding to the ones in the urls parameter
-        and save the others for later.  Remove the urls for returned frames
-        from the list of frames by url.
+        and save the others for later (see DICOMFrameSubscription.take).
         TODO: handle any error codes
         """
-        framesByURLForURLs = {}
-        for url in self.framesByURL.keys():
-            if url in requestedURLs:
-                framesByURLForURLs[url] = self.framesByURL[url]
-        for url in framesByURLForURLs:
-            del(self.framesByURL[url])
-        return(framesByURLForURLs)
+        self.retryFailed()
+        return self.requests.take(requestedURLs)
 
     def requestFinished(self):
-        if self._haveQT:
-            return len(self.urlsByReply) == 0
-        else:
-            # for sync requests
-            return True
+        self.retryFailed()
+        return self.broker.idle()
 
     #
     # infrastructure for getting instance metadata from dicom store
     # here, file is really a frameURL since we are mocking the ctkDICOMDatabase API
-    # so we use the method provide by the DICOMStore to fetch metadata
-    # and store it here for faster access
+    # so values come from the database's TagCache when the tag is precached,
+    # otherwise from the series metadata, which the metadataCache keeps
+    # in memory and optionally on disk so it is only fetched when needed
     #
 
-    @functools.lru_cache(maxsize=100)
     def seriesMetadata(self, seriesURL):
-        seriesRequest = requests.get(seriesURL, headers=self.headers)
-        seriesMetadata = json.loads(seriesRequest.content)
-        tag = DICOMLogic.databases.DICOMDatabase.dicomTagNoComma("SOPInstanceUID")
-        instanceMetadataByUID = {}
-        for metadata in seriesMetadata:
-            instanceUID = metadata[tag]["Value"][0]
-            instanceMetadataByUID[instanceUID] = metadata
-        return(instanceMetadataByUID)
-
-    @functools.lru_cache(maxsize=10000)
+        return self.metadataCache.seriesMetadata(seriesURL, self.headers)
+
     def instanceMetadata(self, frameURL):
         seriesURL = frameURL[:frameURL.find("instances")] + "metadata"
         instanceMetadataByUID = self.seriesMetadata(seriesURL)
         instanceUID = frameURL[frameURL.find("instances/"):].split("/")[1]
         return(instanceMetadataByUID[instanceUID])
 
-    @functools.lru_cache(maxsize=10000)
+    def tagCacheValue(self, file, tag):
+        """
+        Returns the value from the database TagCache, or None if
+        it is not cached there for the instance
+        """
+        cacheTag = f"{tag[0:4]},{tag[4:8]}"
+        if cacheTag not in getattr(self.db, "cachedTags", ()):
+            return None
+        instanceUID = file[file.find("instances/"):].split("/")[1]
+        value = self.db.instanceValue(instanceUID, cacheTag)
+        if value in (self.db.TagNotInInstance, self.db.ValueIsEmptyString):
+            return ""
+        if value == self.db.ValueIsNotStored:
+            return None
+        return value
+
     def fileValue(self, file, tag):
-        metadata = self.instanceMetadata(file)
         tag = tag.replace(",", "").upper()
+        value = self.tagCacheValue(file, tag)
+        if value is not None:
+            self.metadataCache.count("tagCacheHits")
+            return(value)
+        metadata = self.instanceMetadata(file)
         value = ""
-        if tag in metadata:
+        if tag in metadata and "Value" in metadata[tag]:
             value = metadata[tag]["Value"]
+            # person names are objects in the json model
+            value = [v.get("Alphabetic", "") if isinstance(v, dict) else v for v in value]
             if len(value) == 1:
                 value = str(value[0])
             else:
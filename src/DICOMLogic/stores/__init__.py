@@ -1,9 +1,20 @@
 from .DICOMStore import *
+from .DICOMFrameBroker import *
+from .DICOMFrameDecoder import *
 from .DICOMwebStore import *
+from .DICOMwebMetadataCache import *
+from .DICOMFileStore import *
+from .DICOMDIMSEStore import *
 from .DICOMAHIStore import *
 
 __all__ = [
         "DICOMStore",
+        "DICOMFrameBroker",
+        "DICOMFrameSubscription",
+        "DICOMFrameDecoder",
         "DICOMwebStore",
+        "DICOMwebMetadataCache",
+        "DICOMFileStore",
+        "DICOMDIMSEStore",
         "DICOMAHIStore"
 ]
@@ -45,11 +45,6 @@ startTime = time.time()
 slicer.dicomDatabase.openDatabase(dbDirectory + "/ctkDICOM.sql")
 print(f"Opening time = {time.time() - startTime}")
 
-print("Updating Display:")
-startTime = time.time()
-slicer.dicomDatabase.updateDisplayedFields()
-print(f"Updating time = {time.time() - startTime}")
-
 print("Selecting module:")
 startTime = time.time()
 slicer.util.selectModule("DICOM")
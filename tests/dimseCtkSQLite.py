@@ -0,0 +1,215 @@
+"""
+Index and retrieve synthetic studies from a local pynetdicom SCP
+with DICOMDIMSEStore, checking the database and the frames, then time
+retrieval with different numbers of pooled associations.
+
+  python dimseCtkSQLite.py [studyCount] [instancesPerSeries]
+
+The SCP waits getLatency seconds before answering each C-GET, like
+an archive reading from storage, which concurrent C-GETs overlap.
+getDelays can give the (before, after) sending delays of the next C-GETs.
+
+Note: creating the ctkDICOM database downloads the schema, so network
+access is needed.
+"""
+import numpy as np
+import pydicom
+import pydicom.uid
+import sys
+import time
+
+import pynetdicom
+import pynetdicom.sop_class
+from pynetdicom import evt
+
+import DICOMLogic
+from DICOMLogic.stores import DICOMDIMSEStore
+
+studyCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+instancesPerSeries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+seriesPerStudy = 2
+getLatency = 0.05
+getDelays = []
+port = 11113
+
+#
+# synthetic archive
+#
+
+def instance(studyIndex, seriesIndex, index):
+    ds = pydicom.Dataset()
+    ds.PatientName = f"Patient^{studyIndex}"
+    ds.PatientID = f"P{studyIndex}"
+    ds.StudyInstanceUID = f"1.2.3.{studyIndex}"
+    ds.StudyDescription = f"Study {studyIndex}"
+    ds.SeriesInstanceUID = f"1.2.3.{studyIndex}.{seriesIndex}"
+    ds.SeriesDescription = f"Series {seriesIndex}"
+    ds.SeriesNumber = str(seriesIndex)
+    ds.Modality = "CT"
+    ds.SOPInstanceUID = f"1.2.3.{studyIndex}.{seriesIndex}.{index}"
+    ds.SOPClassUID = pydicom.uid.CTImageStorage
+    ds.InstanceNumber = str(index)
+    ds.ImagePositionPatient = ["0", "0", str(index)]
+    ds.Rows = 256
+    ds.Columns = 256
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = np.full((256, 256), index - 500, dtype="<i2").tobytes()
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    return ds
+
+def multiframeInstance(studyIndex):
+    ds = instance(studyIndex, seriesPerStudy, 0)
+    ds.SOPClassUID = pydicom.uid.EnhancedCTImageStorage
+    ds.NumberOfFrames = 3
+    ds.PixelData = np.repeat(np.array([1, 2, 3], dtype="<i2"), 256 * 256).tobytes()
+    return ds
+
+datasets = []
+for studyIndex in range(studyCount):
+    for seriesIndex in range(seriesPerStudy):
+        datasets += [instance(studyIndex, seriesIndex, index)
+                     for index in range(instancesPerSeries)]
+    datasets.append(multiframeInstance(studyIndex))
+
+def matches(ds, identifier):
+    for keyword in ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"):
+        if keyword in identifier and identifier[keyword].value not in (None, ""):
+            value = identifier[keyword].value
+            values = [value] if isinstance(value, str) else list(value)
+            if ds.get(keyword) not in values:
+                return False
+    return True
+
+def handleFind(event):
+    identifier = event.identifier
+    level = identifier.QueryRetrieveLevel
+    levelKeyword = {"STUDY": "StudyInstanceUID", "SERIES": "SeriesInstanceUID",
+                    "IMAGE": "SOPInstanceUID"}[level]
+    found = set()
+    for ds in datasets:
+        if not matches(ds, identifier) or ds.get(levelKeyword) in found:
+            continue
+        found.add(ds.get(levelKeyword))
+        response = pydicom.Dataset()
+        for element in identifier:
+            if element.tag in ds:
+                response[element.tag] = ds[element.tag]
+            else:
+                response[element.tag] = element
+        response.QueryRetrieveLevel = level
+        yield 0xFF00, response
+
+def handleGet(event):
+    before, after = getDelays.pop(0) if getDelays else (getLatency, 0)
+    time.sleep(before)
+    matching = [ds for ds in datasets if matches(ds, event.identifier)]
+    yield len(matching)
+    for ds in matching:
+        yield 0xFF00, ds
+    time.sleep(after)
+
+scp = pynetdicom.AE(ae_title="TEST-SCP")
+scp.add_supported_context(pynetdicom.sop_class.StudyRootQueryRetrieveInformationModelFind)
+scp.add_supported_context(pynetdicom.sop_class.StudyRootQueryRetrieveInformationModelGet)
+for context in pynetdicom.StoragePresentationContexts:
+    scp.add_supported_context(context.abstract_syntax, scp_role=True, scu_role=False)
+server = scp.start_server(("127.0.0.1", port), block=False,
+                          evt_handlers=[(evt.EVT_C_FIND, handleFind),
+                                        (evt.EVT_C_GET, handleGet)])
+
+#
+# indexing
+#
+
+db = DICOMLogic.databases.ctkSQLite(None, inMemory=True)
+store = DICOMDIMSEStore(db, "127.0.0.1", port, calledAETitle="TEST-SCP")
+
+print("Indexing:")
+startTime = time.time()
+studyInstanceUIDs = store.studyInstanceUIDs()
+instanceCount = sum([store.indexStudy(uid) for uid in studyInstanceUIDs])
+print(f"Indexing time = {time.time() - startTime}")
+statistics = db.statistics()
+print(statistics)
+assert len(studyInstanceUIDs) == studyCount
+assert statistics["Images"] == len(datasets) == instanceCount
+assert statistics["Series"] == studyCount * (seriesPerStudy + 1)
+assert db.studiesForPatient(db.patients()[0])
+
+#
+# retrieval
+#
+
+print("Retrieving:")
+seriesInstanceUID = "1.2.3.0.0"
+urls = list(db.urlsForSeries(seriesInstanceUID).values())
+multiframeURL = db.urlForInstance(f"1.2.3.0.{seriesPerStudy}.0")
+multiframeURLs = [multiframeURL.replace("frames/1", f"frames/{frame}") for frame in (1, 2, 3)]
+future = store.subscribe(multiframeURLs).future(multiframeURLs[2])
+overlapping = store.subscribe(urls[:10])
+store.startRequest(urls)
+framesByURL = {}
+while len(framesByURL) < len(urls):
+    framesByURL.update(store.getFrames(urls))
+    time.sleep(0.001)
+while not store.requestFinished():
+    time.sleep(0.01)
+for url,frame in framesByURL.items():
+    instanceNumber = int(url.split("/instances/")[1].split("/")[0].split(".")[-1])
+    assert frame.shape == (256 * 256,) and frame.dtype == np.int16
+    assert frame[0] == instanceNumber - 500, url
+assert len(overlapping.frames()) == 10
+assert future.result()[0] == 3
+store.shutdown()
+print("Frames match")
+
+# another frame of an instance whose C-GET is still finishing is
+# retrieved by a second C-GET, which the first must not fail
+store = DICOMDIMSEStore(db, "127.0.0.1", port, calledAETitle="TEST-SCP")
+getDelays[:] = [(0, 0.3), (0.6, 0)]
+assert store.subscribe(multiframeURLs[:1]).future(multiframeURLs[0]).result()[0] == 1
+assert store.subscribe(multiframeURLs[1:2]).future(multiframeURLs[1]).result()[0] == 2
+store.shutdown()
+
+# shutting down fails the frames of C-GETs that had not started
+store = DICOMDIMSEStore(db, "127.0.0.1", port, calledAETitle="TEST-SCP",
+                        maxAssociations=1, instancesPerGet=10)
+getDelays[:] = [(0.3, 0)]
+subscription = store.subscribe(urls)
+store.shutdown()
+assert store.requestFinished() and subscription.done()
+assert len(subscription.frames()) == 10 and len(subscription.failed) == len(urls) - 10
+print("Overlapping and cancelled requests finish")
+
+#
+# throughput
+#
+
+urls = []
+for seriesInstanceUID in [uid for studyInstanceUID in studyInstanceUIDs
+                          for uid in db.seriesForStudy(studyInstanceUID)]:
+    urls += db.urlsForSeries(seriesInstanceUID).values()
+for maxAssociations in (1, 2, 4, 8):
+    store = DICOMDIMSEStore(db, "127.0.0.1", port, calledAETitle="TEST-SCP",
+                            maxAssociations=maxAssociations, instancesPerGet=25)
+    startTime = time.time()
+    store.startRequest(urls)
+    framesByURL = {}
+    while len(framesByURL) < len(urls) and not store.requestFinished():
+        framesByURL.update(store.getFrames(urls))
+        time.sleep(0.001)
+    framesByURL.update(store.getFrames(urls))
+    elapsed = time.time() - startTime
+    frameBytes = sum([frame.nbytes for frame in framesByURL.values()])
+    print(f"{maxAssociations} associations: {len(framesByURL) / elapsed:7.1f} frames/s, "
+          f"{frameBytes / elapsed / 1e6:6.1f} MB/s")
+    store.shutdown()
+
+server.shutdown()
+print("Finish")
@@ -0,0 +1,134 @@
+"""
+Exercise DICOMFrameBroker and DICOMFrameSubscription with a stand-in
+store that records the frame requests and delivers frames when told:
+coalescing of requests, reference counts, failures, polling, callbacks,
+futures and asyncio delivery, and the cost of polling with take.
+
+  python frameBroker.py [frameCount]
+"""
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import time
+
+from DICOMLogic.stores import DICOMFrameBroker
+
+frameCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+requested = []
+broker = DICOMFrameBroker(requested.extend)
+urls = [f"http://example.org/frames/{index}" for index in range(10)]
+
+#
+# coalescing
+#
+
+first = broker.subscription(urls[:6])
+second = broker.subscription(urls[3:])
+assert requested == urls[:6] + urls[6:]
+first.add(urls[:2])
+assert len(requested) == len(urls) and not broker.idle()
+for url in urls[:5]:
+    broker.deliver(url, url[-1])
+assert set(first.frames()) == set(urls[:5]) and set(second.frames()) == set(urls[3:5])
+broker.deliver(urls[3], "again")
+assert first.frames() == {} and second.frames() == {}
+print("Requests coalesce")
+
+#
+# reference counts
+#
+
+third = broker.subscription(urls[6:8])
+third.add(urls[6:7])
+broker.deliver(urls[6], "6")
+assert third.take([urls[6]]) == {urls[6]: "6"}
+assert third.take({urls[6], urls[7]}) == {urls[6]: "6"}
+assert third.take([urls[6]]) == {}
+third.add([urls[6]])
+assert requested.count(urls[6]) == 2
+third.remove([urls[7]])
+assert urls[7] in broker.subscriptionsByURL
+second.remove()
+for url in urls[7:]:
+    broker.deliver(url, url[-1])
+assert third.frames() == {} and second.frames() == {}
+broker.deliver(urls[6], "6 again")
+assert third.frames() == {urls[6]: "6 again"}
+print("References are counted")
+
+#
+# failures
+#
+
+future = first.future(urls[5])
+broker.fail(urls[5], ConnectionError("refused"))
+assert isinstance(future.exception(), ConnectionError)
+assert isinstance(first.failed[urls[5]], ConnectionError)
+assert isinstance(first.future(urls[5]).exception(), ConnectionError)
+assert first.done()
+try:
+    first.future(urls[9])
+    raise AssertionError("future of an unsubscribed url")
+except KeyError:
+    pass
+first.add([urls[5]])
+assert urls[5] not in first.failed and requested.count(urls[5]) == 2
+broker.deliver(urls[5], "5")
+assert first.frames() == {urls[5]: "5"} and broker.idle()
+print("Failures propagate")
+
+#
+# callbacks, futures and asyncio
+#
+
+requested.clear()
+calls = []
+called = broker.subscription(urls[:2], callback=lambda url, frame: calls.append(url))
+waited = broker.subscription(urls)
+futures = [waited.future(url) for url in urls]
+
+def deliverAll():
+    for url in requested[:]:
+        time.sleep(0.001)
+        broker.deliver(url, url[-1])
+
+async def arrivals(subscription):
+    return [url async for url, frame in subscription]
+
+thread = threading.Thread(target=deliverAll)
+thread.start()
+arrived = asyncio.run(arrivals(waited))
+thread.join()
+assert sorted(arrived) == sorted(urls) and waited.done() and broker.idle()
+done, _ = concurrent.futures.wait(futures, timeout=1)
+assert len(done) == len(urls) and [f.result() for f in futures] == [url[-1] for url in urls]
+assert calls == urls[:2] and called.frames() == {} and called.done()
+print("Callbacks, futures and asyncio deliver")
+
+#
+# polling cost
+#
+
+requested.clear()
+manyURLs = [f"http://example.org/frames/{index}" for index in range(frameCount)]
+subscription = broker.subscription(manyURLs)
+for url in manyURLs[:10]:
+    broker.deliver(url, url)
+wanted = set(manyURLs)
+startTime = time.time()
+for poll in range(100):
+    subscription.take(wanted)
+fewArrived = (time.time() - startTime) / 100
+for url in manyURLs[10:]:
+    broker.deliver(url, url)
+startTime = time.time()
+for index in range(10, 110):
+    assert len(subscription.take({manyURLs[index]})) == 1
+manyArrived = (time.time() - startTime) / 100
+taken = subscription.take(manyURLs)
+assert len(taken) == frameCount - 110 and subscription.frames() == {}
+print(f"take: {1e6 * fewArrived:.1f} us for a set of {frameCount} urls with 10 frames arrived, "
+      f"{1e6 * manyArrived:.1f} us for one url with {frameCount} arrived")
+print("Finish")